@@ -0,0 +1,379 @@
+"""
+Resident aggregation service.
+
+    python aggregation_daemon.py --quorum 3 --deadline 3600
+
+Keeps one FederatedServer alive and watches the round
+ledger. A round is closed as soon as `quorum` uploads have passed
+validation, or once `deadline` seconds have gone by since the previous
+global model was published and at least `min_clients` are valid. The new
+global_round_N.* is published without anyone clicking a button.
+
+Progress is written to global_models/daemon_status.json for observers
+(the dashboard); dropping an aggregate_now.json next to it closes the
+current round on the next poll. Run it with the server's FL_METRICS_DIR
+to have its aggregation timings show up in the server's /metrics.
+
+    python aggregation_daemon.py --async --buffer-size 10 --max-staleness 10
+
+runs without round barriers instead (see utils.async_fl): every
+`buffer-size` valid uploads, whichever version they were trained on,
+publish the next global version.
+
+    python aggregation_daemon.py --keep-rounds 20 --keep-every 10 --keep-materialized 3
+
+turns on checkpoint retention: the policy is saved to
+global_models/retention.json and every process pruning the store follows
+it. Without --keep-* flags the saved policy is left as it is (none: keep
+every round).
+"""
+import os
+import json
+import time
+import argparse
+
+from server import FederatedServer
+from models.unetr_model import get_unetr
+from utils.fed_utils import AGGREGATORS, get_aggregator
+from utils.round_ledger import STATUS_INVALID, STATUS_PENDING, STATUS_VALID, get_ledger
+from utils.locks import file_lock, tmp_path_for
+from utils.checkpoint_utils import LATEST_POINTER, read_latest_pointer
+from utils.checkpoint_store import CheckpointStore, read_retention, write_retention
+from utils.async_fl import (
+    BUFFER_SIZE, MAX_STALENESS, STALENESS_EXPONENT,
+    buffered_entries, clear_async_config, write_async_config,
+)
+
+DAEMON_STATUS = "daemon_status.json"
+AGGREGATE_REQUEST = "aggregate_now.json"
+AGGREGATION_LOCK = "aggregation.lock"
+
+
+# --- Status / trigger files shared with the dashboard ---
+def _write_json(path, data):
+    tmp_path = tmp_path_for(path)
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_daemon_status(global_model_dir="global_models"):
+    """Last status written by a running daemon, or None if it is not alive."""
+    status = _read_json(os.path.join(global_model_dir, DAEMON_STATUS))
+    if status is None:
+        return None
+    # a daemon that stopped polling is treated as gone
+    if time.time() - status.get("updated", 0) > 3 * status.get("poll_interval", 5) + 10:
+        return None
+    return status
+
+
+def request_aggregation(round_num, global_model_dir="global_models"):
+    """Ask the daemon to close `round_num` on its next poll."""
+    _write_json(
+        os.path.join(global_model_dir, AGGREGATE_REQUEST),
+        {"round": int(round_num), "requested": time.time()},
+    )
+
+
+def published_round(global_model_dir="global_models"):
+    latest = read_latest_pointer(global_model_dir)
+    return latest["round"] if latest else None
+
+
+def round_counts(entries):
+    counts = {"valid": 0, "pending": 0, "invalid": 0}
+    for entry in entries:
+        status = entry.get("status")
+        if status in (None, STATUS_VALID):
+            counts["valid"] += 1
+        elif status == STATUS_PENDING:
+            counts["pending"] += 1
+        elif status == STATUS_INVALID:
+            counts["invalid"] += 1
+    return counts
+
+
+def run_aggregation(server, round_num, num_workers=1, aggregator=None, async_config=None):
+    """
+    Aggregate `round_num` on `server` unless another process already
+    published it. Returns True if this call published the round.
+    With `async_config` the buffered uploads of any recent version are
+    applied instead (FederatedServer.aggregate_async).
+    """
+    with file_lock(os.path.join(server.global_model_dir, AGGREGATION_LOCK)):
+        published = published_round(server.global_model_dir)
+        if published is not None and published >= round_num:
+            print(f"[Daemon] Round {round_num} already published")
+            return False
+
+        server.cur_round = round_num
+        if async_config is not None:
+            return server.aggregate_async(async_config)
+        return server.aggregate(num_workers=num_workers, aggregator=aggregator)
+
+
+# --- Daemon ---
+class AggregationDaemon:
+
+    def __init__(self, model_fn=get_unetr, quorum=3, deadline=3600, min_clients=1,
+                 pending_grace=60, poll_interval=5, num_workers=1, device=None, store=None,
+                 test_loader=None, eval_workers=1, sw_batch_size=4, aggregator="fedavg",
+                 async_config=None):
+        self.quorum = quorum
+        self.deadline = deadline
+        self.min_clients = min_clients
+        self.pending_grace = pending_grace
+        self.poll_interval = poll_interval
+        self.num_workers = num_workers
+        self.aggregator = aggregator  # name or Aggregator, see fed_utils.AGGREGATORS
+
+        self.global_model_dir = "global_models"
+        self.ledger = get_ledger()
+
+        # async mode: {buffer_size, max_staleness, server_lr, staleness_exponent},
+        # published for the backend; a full buffer plays the role of the quorum
+        os.makedirs(self.global_model_dir, exist_ok=True)
+        if async_config is not None:
+            self.async_config = write_async_config(self.global_model_dir, **async_config)
+            self.quorum = self.async_config["buffer_size"]
+        else:
+            self.async_config = None
+            clear_async_config(self.global_model_dir)
+
+        # built once; every round reuses the same server and process
+        published = published_round(self.global_model_dir)
+        self.server = FederatedServer(
+            model_fn=model_fn,
+            cur_round=0 if published is None else published + 1,
+            test_loader=test_loader,
+            device=device,
+            store=store,
+            eval_workers=eval_workers,
+            sw_batch_size=sw_batch_size,
+        )
+
+        self.last_result = None
+        self.last_duration = None
+        self._failed = None  # (round, counts) of the last failed attempt
+
+    def round_opened_at(self):
+        """Rounds open when the previous global model is published."""
+        path = os.path.join(self.global_model_dir, LATEST_POINTER)
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return time.time()
+
+    def take_request(self, round_num):
+        path = os.path.join(self.global_model_dir, AGGREGATE_REQUEST)
+        req = _read_json(path)
+        if req is None:
+            return False
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        if req.get("round") != round_num:
+            print(f"[Daemon] Ignoring aggregation request for round {req.get('round')}")
+            return False
+        return True
+
+    def decide(self, counts, opened_at, requested, now):
+        """Reason to close the round now, or None to keep waiting."""
+        valid = counts["valid"]
+
+        if requested and valid:
+            return "requested"
+
+        if valid >= self.quorum:
+            return "quorum"
+
+        if self.deadline and now >= opened_at + self.deadline and valid >= self.min_clients:
+            # give uploads still being validated a moment before closing without them
+            if not counts["pending"] or now >= opened_at + self.deadline + self.pending_grace:
+                return "deadline"
+
+        return None
+
+    def write_status(self, state, round_num, counts, opened_at):
+        _write_json(os.path.join(self.global_model_dir, DAEMON_STATUS), {
+            "state": state,
+            "mode": "async" if self.async_config else "sync",
+            "round": round_num,
+            "counts": counts,
+            "quorum": self.quorum,
+            "max_staleness": self.async_config["max_staleness"] if self.async_config else None,
+            "min_clients": self.min_clients,
+            "deadline_at": opened_at + self.deadline if self.deadline else None,
+            "last_result": self.last_result,
+            "last_duration_sec": self.last_duration,
+            "poll_interval": self.poll_interval,
+            "pid": os.getpid(),
+            "updated": time.time(),
+        })
+
+    def poll(self):
+        """One pass: inspect the open round and aggregate it if it is due."""
+        published = published_round(self.global_model_dir)
+        round_num = 1 if published is None else published + 1
+        opened_at = self.round_opened_at()
+
+        if self.async_config:
+            entries = buffered_entries(self.ledger, published, self.async_config["max_staleness"],
+                                       valid_only=False)
+        else:
+            entries = self.ledger.round_entries(round_num)
+        counts = round_counts(entries)
+        requested = self.take_request(round_num)
+        reason = self.decide(counts, opened_at, requested, time.time())
+
+        # don't retry a failed round until its uploads change
+        if reason is None or (reason != "requested" and self._failed == (round_num, counts)):
+            self.write_status("waiting", round_num, counts, opened_at)
+            return False
+
+        print(f"[Daemon] Closing round {round_num} ({reason}): "
+              f"{counts['valid']} valid, {counts['pending']} pending, {counts['invalid']} invalid")
+        self.write_status("aggregating", round_num, counts, opened_at)
+
+        start = time.time()
+        try:
+            success = run_aggregation(self.server, round_num, self.num_workers, self.aggregator,
+                                      self.async_config)
+        except Exception as e:
+            print(f"[Daemon] Aggregation of round {round_num} failed: {e}")
+            success = False
+            self.last_result = {"round": round_num, "success": False, "reason": reason, "error": str(e)}
+        else:
+            self.last_result = {"round": round_num, "success": success, "reason": reason}
+        self.last_duration = round(time.time() - start, 3)
+
+        if success:
+            print(f"[Daemon] Published round {round_num} in {self.last_duration}s")
+            self._failed = None
+        else:
+            self._failed = (round_num, counts)
+        self.write_status("published" if success else "failed", round_num, counts, opened_at)
+        return success
+
+    def run_forever(self):
+        if self.async_config:
+            print(f"[Daemon] Async mode: a version every {self.quorum} updates, "
+                  f"max staleness {self.async_config['max_staleness']}, deadline={self.deadline}s, "
+                  f"poll every {self.poll_interval}s")
+        else:
+            print(f"[Daemon] Watching rounds: quorum={self.quorum}, deadline={self.deadline}s, "
+                  f"min_clients={self.min_clients}, poll every {self.poll_interval}s")
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                # a transient ledger/filesystem error must not stop the service
+                print(f"[Daemon] Poll failed: {e}")
+            time.sleep(self.poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Close FL rounds automatically")
+    parser.add_argument("--quorum", type=int, default=3,
+                        help="validated uploads that close a round immediately")
+    parser.add_argument("--deadline", type=float, default=3600,
+                        help="seconds after a round opens before it closes with fewer clients (0 = never)")
+    parser.add_argument("--min-clients", type=int, default=1,
+                        help="validated uploads required to close a round at the deadline")
+    parser.add_argument("--pending-grace", type=float, default=60,
+                        help="extra seconds to wait for pending validations after the deadline")
+    parser.add_argument("--poll", type=float, default=5, help="seconds between ledger checks")
+    parser.add_argument("--workers", type=int, default=1, help="processes for parallel aggregation")
+    parser.add_argument("--aggregator", choices=list(AGGREGATORS), default="fedavg",
+                        help="aggregation strategy (robust ones ignore the running sum)")
+    parser.add_argument("--trim", type=float, default=0.1,
+                        help="fraction trimmed from each end by trimmed_mean")
+    parser.add_argument("--krum-f", type=int, default=None,
+                        help="Byzantine clients tolerated by krum (default: the most it allows)")
+    parser.add_argument("--krum-m", type=int, default=1,
+                        help="clients averaged after Krum selection (multi-Krum)")
+    parser.add_argument("--async", dest="async_mode", action="store_true",
+                        help="no round barriers: publish a version every --buffer-size updates")
+    parser.add_argument("--buffer-size", type=int, default=BUFFER_SIZE,
+                        help="async: buffered updates that publish the next version")
+    parser.add_argument("--max-staleness", type=int, default=MAX_STALENESS,
+                        help="async: accept updates trained on up to this many versions ago")
+    parser.add_argument("--server-lr", type=float, default=1.0,
+                        help="async: step size applied to the averaged update")
+    parser.add_argument("--staleness-exponent", type=float, default=STALENESS_EXPONENT,
+                        help="async: updates weigh (1 + staleness) ** -exponent")
+    parser.add_argument("--keep-rounds", type=int, default=None,
+                        help="newest rounds kept in the checkpoint store (0 = all)")
+    parser.add_argument("--keep-every", type=int, default=None,
+                        help="also keep every Nth round (0 = none)")
+    parser.add_argument("--keep-materialized", type=int, default=None,
+                        help="newest rounds that keep full .pth/.flat files (0 = all)")
+    parser.add_argument("--eval", action="store_true",
+                        help="score every new global model on the test set (global_metrics.csv)")
+    parser.add_argument("--eval-workers", type=int, default=1, help="processes for evaluation")
+    parser.add_argument("--sw-batch-size", type=int, default=4,
+                        help="sliding-window patches per forward pass during evaluation")
+    args = parser.parse_args()
+
+    aggregator_args = {
+        "trimmed_mean": {"trim": args.trim},
+        "krum": {"f": args.krum_f, "m": args.krum_m},
+    }.get(args.aggregator, {})
+
+    # retention is shared with the backend and the dashboard through retention.json
+    retention = read_retention("global_models")
+    for key, value in (("keep_last", args.keep_rounds), ("keep_every", args.keep_every),
+                       ("keep_materialized", args.keep_materialized)):
+        if value is not None:
+            retention[key] = value
+
+    async_config = None
+    if args.async_mode:
+        async_config = {
+            "buffer_size": args.buffer_size,
+            "max_staleness": args.max_staleness,
+            "server_lr": args.server_lr,
+            "staleness_exponent": args.staleness_exponent,
+        }
+        # stale updates are applied against their own base version
+        if retention["keep_last"] and retention["keep_last"] <= args.max_staleness:
+            print(f"[Daemon] Keeping {args.max_staleness + 1} rounds so stale updates find their base")
+            retention["keep_last"] = args.max_staleness + 1
+    if retention != read_retention("global_models"):
+        write_retention("global_models", **retention)
+        print(f"[Daemon] Checkpoint retention: {retention}")
+
+    test_loader = None
+    if args.eval:
+        from datasets.brain_tumor_dataset import get_client_data
+        test_loader = get_client_data()[2]
+
+    daemon = AggregationDaemon(
+        quorum=args.quorum,
+        deadline=args.deadline,
+        min_clients=args.min_clients,
+        pending_grace=args.pending_grace,
+        poll_interval=args.poll,
+        num_workers=args.workers,
+        aggregator=get_aggregator(args.aggregator, **aggregator_args),
+        test_loader=test_loader,
+        eval_workers=args.eval_workers,
+        sw_batch_size=args.sw_batch_size,
+        async_config=async_config,
+        store=CheckpointStore("global_models"),
+    )
+    daemon.run_forever()
+
+
+if __name__ == "__main__":
+    main()
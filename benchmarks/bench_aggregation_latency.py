@@ -0,0 +1,82 @@
+"""
+End-to-end aggregation latency: FederatedServer construction, reading the
+client files, FedAvg and publishing global_round_N.*, with and without
+instantiating the UNETR.
+
+    python -m benchmarks.bench_aggregation_latency --clients 4
+
+"with model" forces the model to be built and loaded like before (model_fn
++ load_state_dict), "model-free" publishes the averaged tensors directly
+after checking them against the manifest. Runs in a scratch directory.
+"""
+import os
+import gc
+import time
+import shutil
+import argparse
+import tempfile
+
+import torch
+
+from server import FederatedServer
+from models.unetr_model import get_unetr
+from utils.fed_utils import client_weights_path
+from utils.round_ledger import STATUS_VALID, get_ledger
+from utils.weight_format import FLAT_EXT, load_weights, save_weights
+
+
+def make_clients(num_clients, ext):
+    base = load_weights(os.path.join("global_models", "global_round_0" + FLAT_EXT))
+    ledger = get_ledger()
+    for i in range(num_clients):
+        client_id = f"bench_{i}"
+        state_dict = {k: v + torch.randn_like(v) * 0.01 if v.is_floating_point() else v.clone()
+                      for k, v in base.items()}
+        save_weights(state_dict, client_weights_path("uploaded_client_weights", client_id, 1, ext))
+        ledger.record_upload(1, client_id, 100 + 7 * i, status=STATUS_VALID)
+
+
+def run(with_model):
+    gc.collect()
+    start = time.perf_counter()
+    server = FederatedServer(model_fn=get_unetr, cur_round=1, test_loader=None, device="cpu")
+    if with_model:
+        server.model  # build it, aggregate() then loads the result into it
+    built = time.perf_counter()
+    if not server.aggregate():
+        raise RuntimeError("aggregation failed")
+    end = time.perf_counter()
+    return built - start, end - built, end - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--format", choices=["flat", "pth"], default="flat",
+                        help="client upload format")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fl_bench_agg_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        FederatedServer(model_fn=get_unetr, cur_round=0, test_loader=None, device="cpu")
+        make_clients(args.clients, FLAT_EXT if args.format == "flat" else ".pth")
+
+        print(f"{args.clients} clients ({args.format}), best of {args.repeats}")
+        print(f"{'path':>12} {'setup':>9} {'aggregate':>10} {'total':>9}")
+        results = {}
+        for label, with_model in (("with model", True), ("model-free", False)):
+            best = min((run(with_model) for _ in range(args.repeats)), key=lambda t: t[2])
+            results[label] = best
+            print(f"{label:>12} {best[0]:8.3f}s {best[1]:9.3f}s {best[2]:8.3f}s")
+
+        print(f"speedup: {results['with model'][2] / results['model-free'][2]:.2f}x")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
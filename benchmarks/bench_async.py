@@ -0,0 +1,129 @@
+"""
+Synchronous rounds vs asynchronous buffered mode with clients of very
+different speeds.
+
+    python -m benchmarks.bench_async --clients 8 --slowdown 10 --duration 20
+
+Each simulated client trains a toy model towards its own target, taking
+between 1x and `slowdown`x the base step time, and uploads through the
+round ledger like the backend does. The aggregation daemon runs both modes
+on the same clients for `duration` seconds; reported are client
+utilization (time spent training / wall time), published versions,
+applied updates and the relative distance of the final model to the
+optimum. Fast clients contribute more updates in async mode, so with very
+non-IID clients (--heterogeneity) the model drifts towards them.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import contextlib
+
+import torch
+
+from benchmarks.load_test import REPO_DIR, Blob
+
+
+def run_mode(workdir, args, async_mode):
+    os.chdir(workdir)
+    from aggregation_daemon import AggregationDaemon, published_round
+    from utils.checkpoint_utils import global_round_path
+    from utils.fed_utils import client_weights_path
+    from utils.round_ledger import STATUS_VALID, get_ledger
+    from utils.weight_format import load_weights, save_weights
+
+    torch.manual_seed(0)
+    common = torch.randn(args.numel)
+    targets = [common + args.heterogeneity * torch.randn(args.numel) for _ in range(args.clients)]
+    sizes = [10 + 5 * i for i in range(args.clients)]
+    optimum = sum(t * n for t, n in zip(targets, sizes)) / sum(sizes)
+    step_sec = [args.step * (1 + (args.slowdown - 1) * i / max(1, args.clients - 1)) for i in range(args.clients)]
+
+    daemon = AggregationDaemon(
+        model_fn=lambda device: Blob(args.numel),
+        quorum=args.clients,
+        deadline=0,
+        poll_interval=0.02,
+        async_config={"buffer_size": args.buffer_size, "max_staleness": args.clients} if async_mode else None,
+    )
+    ledger = get_ledger()
+    stop = threading.Event()
+    busy = [0.0] * args.clients
+    uploads = [0] * args.clients
+
+    def client(i):
+        while not stop.is_set():
+            version = published_round("global_models")
+            tag = version + 1
+            if not async_mode and ledger.get_entry(tag, f"c{i}") is not None:
+                time.sleep(0.005)  # barrier: wait for the round to close
+                continue
+
+            start = time.perf_counter()
+            weights = load_weights(global_round_path("global_models", version, ".pth"))["weight"]
+            time.sleep(step_sec[i])  # local training
+            weights = weights + args.local_lr * (targets[i] - weights)
+            path = client_weights_path("uploaded_client_weights", f"c{i}", tag, ".pth")
+            save_weights({"weight": weights}, path)
+            ledger.record_upload(tag, f"c{i}", sizes[i], status=STATUS_VALID)
+            busy[i] += time.perf_counter() - start
+            uploads[i] += 1
+
+    def aggregator():
+        while not stop.is_set():
+            daemon.poll()
+            time.sleep(daemon.poll_interval)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    threads.append(threading.Thread(target=aggregator))
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+    wall = time.perf_counter() - start
+
+    version = published_round("global_models")
+    final = load_weights(global_round_path("global_models", version, ".pth"))["weight"]
+    return {
+        "mode": "async" if async_mode else "sync",
+        "versions": version,
+        "uploads": sum(uploads),
+        "utilization": round(sum(busy) / (wall * args.clients), 3),
+        "fastest_client_uploads": uploads[0],
+        "slowest_client_uploads": uploads[-1],
+        "distance_to_optimum": round((final - optimum).norm().item() / optimum.norm().item(), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--step", type=float, default=0.1, help="training time of the fastest client")
+    parser.add_argument("--slowdown", type=float, default=10, help="slowest / fastest client")
+    parser.add_argument("--buffer-size", type=int, default=3)
+    parser.add_argument("--local-lr", type=float, default=0.5)
+    parser.add_argument("--heterogeneity", type=float, default=0.1,
+                        help="spread of the client targets around a shared optimum (non-IID-ness)")
+    parser.add_argument("--numel", type=int, default=1 << 18)
+    parser.add_argument("--duration", type=float, default=20)
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIR)
+    cwd = os.getcwd()
+    try:
+        report = [run_mode(tempfile.mkdtemp(prefix=f"fl_{mode}_"), args, mode == "async")
+                  for mode in ("sync", "async")]
+    finally:
+        os.chdir(cwd)
+    print(json.dumps({"config": vars(args), "results": report}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Upload bytes versus aggregation error for the delta codec on the UNETR layout.
+
+    python -m benchmarks.bench_delta_codec --clients 4 --update-scale 1e-3
+
+Each simulated client is the base model plus a Gaussian update. Error is the
+max / mean absolute difference between FedAvg over decoded uploads and exact
+FedAvg over the original weights.
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import torch
+
+from models.unetr_model import get_unetr
+from utils.fed_utils import StreamingFedAvg
+from utils.delta_codec import save_delta, decode_delta
+
+ENCODINGS = [
+    ("int8", None),
+    ("fp16", None),
+    ("int8", 0.1),
+    ("fp16", 0.1),
+    ("int8", 0.01),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--update-scale", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    base = get_unetr("cpu").state_dict()
+    sizes = [100 + 10 * i for i in range(args.clients)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        full_path = os.path.join(tmp, "full.pth")
+        torch.save(base, full_path)
+        full_bytes = os.path.getsize(full_path)
+        print(f"Full .pth upload: {full_bytes / 1e6:.1f} MB")
+        print(f"{'encoding':>14} {'MB':>8} {'ratio':>7} {'encode':>8} {'decode':>8} {'max err':>10} {'mean err':>10}")
+
+        generator = torch.Generator().manual_seed(0)
+        clients = []
+        exact = StreamingFedAvg()
+        for size in sizes:
+            sd = {k: v + torch.randn(v.shape, generator=generator) * args.update_scale
+                  if v.is_floating_point() else v for k, v in base.items()}
+            clients.append(sd)
+            exact.add(sd, size)
+        exact = exact.result()
+
+        for quant, topk in ENCODINGS:
+            path = os.path.join(tmp, "delta.flat")
+            approx = StreamingFedAvg()
+            encode_time = decode_time = 0.0
+            nbytes = 0
+
+            for sd, size in zip(clients, sizes):
+                start = time.perf_counter()
+                save_delta(sd, base, 0, path, quant=quant, topk=topk)
+                encode_time += time.perf_counter() - start
+                nbytes += os.path.getsize(path)
+
+                start = time.perf_counter()
+                approx.add(decode_delta(path, base), size)
+                decode_time += time.perf_counter() - start
+
+            approx = approx.result()
+            max_err = max((approx[k] - exact[k]).abs().max().item() for k in exact)
+            mean_err = sum((approx[k] - exact[k]).abs().sum().item() for k in exact) / \
+                sum(v.numel() for v in exact.values())
+
+            label = f"{quant}" + (f"/top{topk:g}" if topk else "")
+            mb = nbytes / len(clients) / 1e6
+            print(f"{label:>14} {mb:8.1f} {full_bytes * len(clients) / nbytes:6.1f}x "
+                  f"{encode_time / len(clients):7.2f}s {decode_time / len(clients):7.2f}s "
+                  f"{max_err:10.2e} {mean_err:10.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark fed_avg() against the flat-buffer engine on the real UNETR layout.
+
+    python -m benchmarks.bench_fed_avg --clients 2 8 32 128
+
+Client state dicts are drawn from a small pool of distinct copies so that
+128 clients do not need 128 x 400 MB of RAM; the arithmetic is the same.
+"""
+import argparse
+import time
+import torch
+
+from models.unetr_model import get_unetr
+from utils.fed_utils import fed_avg
+from utils.flat_utils import flat_fed_avg
+
+
+def make_pool(pool_size):
+    base = get_unetr("cpu").state_dict()
+    pool = [base]
+    for _ in range(pool_size - 1):
+        pool.append({k: v + torch.randn_like(v) * 0.01 if v.is_floating_point() else v.clone()
+                     for k, v in base.items()})
+    return pool
+
+
+def timed(fn, repeats):
+    best = float("inf")
+    result = None
+    for _ in range(repeats):
+        result = None
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def max_abs_diff(a, b):
+    return max((a[k].float() - b[k].float()).abs().max().item() for k in a)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, nargs="+", default=[2, 8, 32, 128])
+    parser.add_argument("--pool", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--matmul-max-gb", type=float, default=8.0,
+                        help="skip the stacked matmul when K x model exceeds this")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    pool = make_pool(args.pool)
+    numel = sum(v.numel() for v in pool[0].values())
+    print(f"UNETR layout: {len(pool[0])} tensors, {numel / 1e6:.1f}M parameters")
+    print(f"{'clients':>8} {'fed_avg':>10} {'flat add':>10} {'flat mm':>10} {'speedup':>8} {'max err':>10}")
+
+    for k in args.clients:
+        state_dicts = [pool[i % len(pool)] for i in range(k)]
+        sizes = [100 + 7 * i for i in range(k)]
+
+        t_ref, ref = timed(lambda: fed_avg(state_dicts, sizes), args.repeats)
+        t_add, out = timed(lambda: flat_fed_avg(state_dicts, sizes, method="add"), args.repeats)
+        err = max_abs_diff(ref, out)
+        del out
+
+        if k * numel * 4 / 1e9 <= args.matmul_max_gb:
+            t_mm, out = timed(lambda: flat_fed_avg(state_dicts, sizes, method="matmul"), args.repeats)
+            err = max(err, max_abs_diff(ref, out))
+            del out
+            mm = f"{t_mm:9.3f}s"
+        else:
+            mm = f"{'skipped':>10}"
+        del ref
+
+        print(f"{k:>8} {t_ref:9.3f}s {t_add:9.3f}s {mm} {t_ref / t_add:7.2f}x {err:10.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Microbenchmarks: the vectorized metrics against the original per-volume
+DiceMetric / per-slice loop implementations.
+
+    python -m benchmarks.bench_metrics --shape 128 160 160 --volumes 8
+
+Masks are random with a blob of foreground so Dice is not trivially 0.
+"""
+import argparse
+import time
+
+import torch
+from monai.metrics import DiceMetric
+
+from utils.metrics import MetricAccumulator, confusion_counts
+from utils.predict_eval_utils import evaluate, evaluate_per_slice
+
+
+# --- Original implementations (before utils.metrics) ---
+def loop_evaluate(pred_mask, true_mask):
+    pred_mask = pred_mask.unsqueeze(0).unsqueeze(0).float()
+    true_mask = true_mask.unsqueeze(0).unsqueeze(0).float()
+
+    dice_metric = DiceMetric(include_background=False, reduction="mean")
+    dice_metric(y_pred=pred_mask, y=true_mask)
+    dice_score = dice_metric.aggregate().item()
+    dice_metric.reset()
+
+    correct = (pred_mask == true_mask).float().sum()
+    pixel_acc = (correct / true_mask.numel()).item()
+    return dice_score, pixel_acc
+
+
+def loop_evaluate_per_slice(pred_mask, mask):
+    dice_scores = []
+    for i in range(pred_mask.shape[-1]):
+        pred_slice = pred_mask[..., i]
+        mask_slice = mask[..., i]
+        intersection = (pred_slice * mask_slice).sum()
+        dice = (2. * intersection) / (pred_slice.sum() + mask_slice.sum() + 1e-8)
+        dice_scores.append(dice.item())
+    return dice_scores
+
+
+def make_masks(volumes, shape, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    target = torch.zeros(volumes, *shape)
+    h, w, d = shape
+    target[:, h // 4: 3 * h // 4, w // 4: 3 * w // 4, d // 4: 3 * d // 4] = 1
+    noise = torch.rand(volumes, *shape, generator=g) < 0.1
+    pred = (target.bool() ^ noise).float()
+    return pred, target
+
+
+def timed(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", type=int, nargs=3, default=[128, 160, 160])
+    parser.add_argument("--volumes", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    pred, target = make_masks(args.volumes, args.shape)
+    print(f"{args.volumes} volumes of {tuple(args.shape)}, best of {args.repeats}")
+    print(f"{'metric':>16} {'original':>10} {'vectorized':>11} {'speedup':>8} {'max diff':>10}")
+
+    def row(name, t_old, t_new, diff):
+        print(f"{name:>16} {t_old:9.4f}s {t_new:10.4f}s {t_old / t_new:7.1f}x {diff:10.2e}")
+
+    # volume Dice + pixel accuracy, one volume at a time
+    t_old, old = timed(lambda: [loop_evaluate(p, t) for p, t in zip(pred, target)], args.repeats)
+    t_new, new = timed(lambda: [evaluate(p, t) for p, t in zip(pred, target)], args.repeats)
+    row("evaluate", t_old, t_new, max(abs(a - b) for o, n in zip(old, new) for a, b in zip(o, n)))
+
+    # per-slice Dice
+    t_old, old = timed(lambda: [loop_evaluate_per_slice(p, t) for p, t in zip(pred, target)], args.repeats)
+    t_new, new = timed(lambda: [evaluate_per_slice(p, t) for p, t in zip(pred, target)], args.repeats)
+    row("per-slice dice", t_old, t_new, max(abs(a - b) for o, n in zip(old, new) for a, b in zip(o, n)))
+
+    # everything at once for the whole batch, streamed into one accumulator
+    def fused():
+        acc = MetricAccumulator()
+        acc.update(pred.unsqueeze(1), target.unsqueeze(1))
+        return acc.compute()
+
+    t_old, _ = timed(lambda: [(loop_evaluate(p, t), loop_evaluate_per_slice(p, t))
+                              for p, t in zip(pred, target)], args.repeats)
+    t_new, result = timed(fused, args.repeats)
+    row("all (batched)", t_old, t_new, 0.0)
+
+    counts = confusion_counts(pred.unsqueeze(1), target.unsqueeze(1))
+    print(f"counts tensor {tuple(counts.shape)}: "
+          f"dice {result['dice']:.4f}, global dice {result['global_dice']:.4f}, "
+          f"pixel acc {result['pixel_acc']:.4f}, slice dice {result['slice_dice']:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Idle clients waiting for the next round: polling vs long-poll vs SSE.
+
+    python -m benchmarks.bench_round_events --clients 100 --idle 10
+
+For each mode a fresh serve.py gets `clients` waiting clients for `idle`
+seconds, then a new global model is published from this process (like the
+aggregation daemon would). Reported are the server's CPU seconds while
+the clients idled, the requests they sent and how long each client took
+to notice the new version.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+
+import requests
+
+from benchmarks.load_test import REPO_DIR, start_server
+
+
+def server_cpu_sec(master_pid):
+    """utime + stime of the gunicorn master and its workers."""
+    pids = [master_pid]
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master_pid:
+            pids.append(int(name))
+
+    ticks = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            ticks += int(fields[11]) + int(fields[12])
+        except OSError:
+            pass
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def publish_next(workdir, version):
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        from server import FederatedServer
+        from utils.weight_format import load_weights
+        from utils.checkpoint_utils import global_round_path
+
+        state = load_weights(global_round_path("global_models", version, ".pth"))
+        FederatedServer(model_fn=None, cur_round=None, test_loader=None).publish_global_model(version + 1, state)
+    finally:
+        os.chdir(cwd)
+
+
+def client(mode, url, after, interval, stop, seen, requests_sent, rejected):
+    session = requests.Session()
+    if mode == "poll":
+        while not stop.is_set():
+            requests_sent.append(1)
+            if session.get(url + "/api/get-current-round").json()["version"] > after:
+                seen.append(time.perf_counter())
+                return
+            time.sleep(interval)
+    elif mode == "long_poll":
+        while not stop.is_set():
+            requests_sent.append(1)
+            r = session.get(url + "/api/wait-for-round", params={"after": after, "timeout": 30})
+            if r.status_code == 200:
+                seen.append(time.perf_counter())
+                return
+            if "Retry-After" in r.headers:
+                rejected.append(1)
+            time.sleep(float(r.headers.get("Retry-After", 0)))
+    else:
+        while not stop.is_set():
+            requests_sent.append(1)
+            with session.get(url + "/api/round-events", stream=True) as r:
+                if r.status_code == 503:
+                    rejected.append(1)
+                    time.sleep(float(r.headers.get("Retry-After", 0)))
+                    continue
+                for line in r.iter_lines():
+                    if line.startswith(b"data:") and json.loads(line[5:])["version"] > after:
+                        seen.append(time.perf_counter())
+                        return
+
+
+def run_mode(mode, args, port):
+    workdir = tempfile.mkdtemp(prefix=f"fl_events_{mode}_")
+    proc, url = start_server(workdir, port, args.workers, args.threads, 1,
+                             ["--round-waiters", str(args.round_waiters or args.clients)])
+    try:
+        stop = threading.Event()
+        seen, requests_sent, rejected = [], [], []
+        threads = [threading.Thread(target=client, args=(mode, url, 0, args.interval, stop, seen, requests_sent, rejected),
+                                    daemon=True) for _ in range(args.clients)]
+        for t in threads:
+            t.start()
+        time.sleep(1)  # let every client connect
+
+        cpu_start, sent_start = server_cpu_sec(proc.pid), len(requests_sent)
+        time.sleep(args.idle)
+        idle_cpu = server_cpu_sec(proc.pid) - cpu_start
+        idle_requests = len(requests_sent) - sent_start
+
+        published = time.perf_counter()
+        publish_next(workdir, 0)
+        for t in threads:
+            t.join(timeout=60)
+        stop.set()
+        latencies = sorted(t - published for t in seen)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    return {
+        "mode": mode,
+        "clients": args.clients,
+        "idle_server_cpu_sec": round(idle_cpu, 3),
+        "idle_requests_per_sec": round(idle_requests / args.idle, 1),
+        "rejected_waits": len(rejected),
+        "notified": len(latencies),
+        "notify_p50_sec": round(latencies[len(latencies) // 2], 3) if latencies else None,
+        "notify_max_sec": round(latencies[-1], 3) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--idle", type=float, default=10, help="seconds the clients wait before the publish")
+    parser.add_argument("--interval", type=float, default=1.0, help="polling interval of the poll mode")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--round-waiters", type=int, default=0,
+                        help="waiter slots per worker (default: --clients, so none are turned away)")
+    parser.add_argument("--modes", default="poll,long_poll,sse")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIR)
+    report = [run_mode(mode, args, args.port + i) for i, mode in enumerate(args.modes.split(","))]
+    print(json.dumps({"config": vars(args), "results": report}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Load test for the production server (serve.py).
+
+    python -m benchmarks.load_test --uploads 100 --downloads 100 --size-mb 20
+
+Starts serve.py in a scratch directory with a synthetic global model,
+fires the uploads and downloads at the same time and reports aggregate
+throughput and latency percentiles. Use --url to target a running server
+instead (its global model is used as is). --anonymous sends requests like
+the stock client: client_id only in the upload form, downloads without one.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import torch
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Blob(torch.nn.Module):
+    def __init__(self, numel):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.randn(numel))
+
+
+def start_server(workdir, port, workers, threads, size_mb, extra_args=()):
+    sys.path.insert(0, REPO_DIR)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        from server import FederatedServer
+        numel = int(size_mb * 1024 * 1024 / 4)
+        FederatedServer(lambda device: Blob(numel), 0, None, device="cpu")
+    finally:
+        os.chdir(cwd)
+
+    return launch_server(workdir, port, workers, threads, extra_args)
+
+
+def launch_server(workdir, port, workers, threads, extra_args=()):
+    """serve.py in `workdir` (which already holds a global model); returns (process, url)."""
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, "serve.py"), "--port", str(port),
+         "--workers", str(workers), "--threads", str(threads), *extra_args],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with code {proc.returncode} (port {port} in use?)")
+        try:
+            requests.get(url + "/api/get-current-round", timeout=5)
+            return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def run_transfers(url, payload, uploads, downloads, cur_round=1, client_prefix="load", anonymous=False):
+    """
+    Fire `uploads` uploads of `payload` and `downloads` downloads of the
+    global model all at once; returns wall time plus throughput and
+    latency percentiles per kind. Like a well-behaved client, requests
+    turned away with 503 are retried after their Retry-After. `anonymous`
+    leaves client_id out of query strings.
+    """
+    def with_retries(send):
+        retries = 0
+        while True:
+            try:
+                r, nbytes = send()
+            except requests.ConnectionError:
+                # refused before the body was sent: the connection was closed under us
+                r, nbytes = None, 0
+            if r is not None and r.status_code != 503:
+                return r.status_code, nbytes, retries
+            retries += 1
+            if retries > 100:
+                raise RuntimeError("server kept refusing the transfer")
+            time.sleep(float(r.headers.get("Retry-After", 1)) if r is not None else 1)
+
+    def upload(i):
+        start = time.perf_counter()
+        client_id = f"{client_prefix}{i}"
+
+        def send():
+            r = requests.post(
+                url + "/api/upload-client-weights",
+                params=None if anonymous else {"client_id": client_id, "cur_round": str(cur_round)},
+                files={"file": ("weights.pth", payload)},
+                data={"client_id": client_id, "dataset_size": "10", "cur_round": str(cur_round)},
+                timeout=900,
+            )
+            return r, len(payload)
+
+        status, nbytes, retries = with_retries(send)
+        return "upload", status, nbytes, time.perf_counter() - start, retries
+
+    def download(i):
+        start = time.perf_counter()
+
+        def send():
+            nbytes = 0
+            params = None if anonymous else {"client_id": f"{client_prefix}-dl{i}"}
+            with requests.get(url + "/api/get-global-model", params=params, stream=True, timeout=900) as r:
+                for chunk in r.iter_content(1024 * 1024):
+                    nbytes += len(chunk)
+            return r, nbytes
+
+        status, nbytes, retries = with_retries(send)
+        return "download", status, nbytes, time.perf_counter() - start, retries
+
+    jobs = [(upload, i) for i in range(uploads)] + [(download, i) for i in range(downloads)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        results = list(pool.map(lambda job: job[0](job[1]), jobs))
+    wall = time.perf_counter() - start
+
+    report = {"wall_sec": round(wall, 3)}
+    for kind in ("upload", "download"):
+        rows = [r for r in results if r[0] == kind]
+        if not rows:
+            continue
+        latencies = [r[3] for r in rows]
+        nbytes = sum(r[2] for r in rows)
+        report[kind] = {
+            "count": len(rows),
+            "ok": sum(1 for r in rows if r[1] == 200),
+            "retries": sum(r[4] for r in rows),
+            "mb_per_sec": round(nbytes / (1024 * 1024) / wall, 1),
+            "p50_sec": round(percentile(latencies, 0.5), 3),
+            "p95_sec": round(percentile(latencies, 0.95), 3),
+            "max_sec": round(max(latencies), 3),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--uploads", type=int, default=100)
+    parser.add_argument("--downloads", type=int, default=100)
+    parser.add_argument("--size-mb", type=float, default=20)
+    parser.add_argument("--round", type=int, default=1)
+    parser.add_argument("--max-uploads", type=int, default=None, help="serve.py admission cap (0 = none)")
+    parser.add_argument("--max-downloads", type=int, default=None, help="serve.py admission cap (0 = none)")
+    parser.add_argument("--anonymous", action="store_true", help="no client_id in query strings (stock clients)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    proc = None
+    workdir = tempfile.mkdtemp(prefix="fl_load_")
+    url = args.url
+    if url is None:
+        extra_args = []
+        for flag, value in (("--max-uploads", args.max_uploads), ("--max-downloads", args.max_downloads)):
+            if value is not None:
+                extra_args += [flag, str(value)]
+        proc, url = start_server(workdir, args.port, args.workers, args.threads, args.size_mb, extra_args)
+
+    buf = io.BytesIO()
+    torch.save({"weight": torch.randn(int(args.size_mb * 1024 * 1024 / 4))}, buf)
+
+    try:
+        report = run_transfers(url, buf.getvalue(), args.uploads, args.downloads, args.round,
+                               anonymous=args.anonymous)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    report["payload_mb"] = args.size_mb
+    wall = report["wall_sec"]
+    jobs = args.uploads + args.downloads
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{jobs} transfers in {wall:.2f}s ({args.size_mb} MB each)")
+        for kind in ("upload", "download"):
+            if kind in report:
+                r = report[kind]
+                print(f"  {kind:>8}: {r['ok']}/{r['count']} ok ({r['retries']} retries), {r['mb_per_sec']} MB/s, "
+                      f"p50 {r['p50_sec']}s, p95 {r['p95_sec']}s, max {r['max_sec']}s")
+
+
+if __name__ == "__main__":
+    main()
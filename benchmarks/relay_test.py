@@ -0,0 +1,152 @@
+"""
+Hierarchical aggregation on loopback: one root and several relays
+(serve.py with FL_UPSTREAM_URL set), each in its own scratch directory.
+
+    python -m benchmarks.relay_test --relays 2 --clients 3 --size-mb 4
+
+Clients upload to their regional relay, every relay forwards one partial
+weighted sum to the root, the root aggregates the round and the result is
+compared against fed_avg over all client updates. Prints a JSON report.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+import requests
+import torch
+
+from benchmarks.load_test import REPO_DIR, Blob, start_server
+
+
+def start_relay(workdir, port, upstream, relay_id):
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, FL_UPSTREAM_URL=upstream, FL_RELAY_ID=relay_id)
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, "serve.py"), "--port", str(port), "--workers", "2"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        if proc.poll() is not None:
+            raise RuntimeError(f"relay exited with code {proc.returncode} (port {port} in use?)")
+        try:
+            requests.get(url + "/api/get-current-round", timeout=5)
+            return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("relay did not start")
+
+
+def wait_valid(url, cur_round, client_id, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        r = requests.get(url + "/api/upload-status", params={"client_id": client_id, "cur_round": cur_round})
+        if r.ok and r.json()["status"] != "pending":
+            return r.json()["status"]
+        time.sleep(0.2)
+    raise TimeoutError(f"{client_id} still pending at {url}")
+
+
+def aggregate_root(workdir, numel, cur_round):
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        from server import FederatedServer
+        from utils.weight_format import load_weights
+        from utils.checkpoint_utils import global_round_path
+
+        start = time.perf_counter()
+        FederatedServer(lambda device: Blob(numel), cur_round, None, device="cpu").aggregate()
+        elapsed = time.perf_counter() - start
+        return load_weights(global_round_path("global_models", cur_round, ".pth")), elapsed
+    finally:
+        os.chdir(cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8770)
+    parser.add_argument("--relays", type=int, default=2)
+    parser.add_argument("--clients", type=int, default=3, help="clients per relay")
+    parser.add_argument("--size-mb", type=float, default=4)
+    args = parser.parse_args()
+
+    cur_round = 1
+    numel = int(args.size_mb * 1024 * 1024 / 4)
+    procs = []
+    root_dir = tempfile.mkdtemp(prefix="fl_root_")
+    try:
+        root, root_url = start_server(root_dir, args.port, 2, 16, args.size_mb)
+        procs.append(root)
+        relays = []
+        for i in range(args.relays):
+            proc, url = start_relay(tempfile.mkdtemp(prefix=f"fl_relay{i}_"), args.port + 1 + i,
+                                    root_url, f"relay{i}")
+            procs.append(proc)
+            relays.append(url)
+
+        # clients upload to their own region only
+        updates, sizes = [], []
+        start = time.perf_counter()
+        for r, url in enumerate(relays):
+            for c in range(args.clients):
+                client_id = f"r{r}c{c}"
+                state = {"weight": torch.randn(numel)}
+                size = 10 + 7 * len(sizes)
+                buf = io.BytesIO()
+                torch.save(state, buf)
+                resp = requests.post(
+                    url + "/api/upload-client-weights",
+                    files={"file": ("weights.pth", buf.getvalue())},
+                    data={"client_id": client_id, "dataset_size": str(size), "cur_round": str(cur_round)},
+                    timeout=900,
+                )
+                resp.raise_for_status()
+                updates.append(state)
+                sizes.append(size)
+        for r, url in enumerate(relays):
+            for c in range(args.clients):
+                if wait_valid(url, cur_round, f"r{r}c{c}") != "valid":
+                    raise RuntimeError(f"r{r}c{c} was rejected by its relay")
+        upload_sec = time.perf_counter() - start
+
+        # one partial sum per relay goes upstream
+        start = time.perf_counter()
+        for i, url in enumerate(relays):
+            resp = requests.post(url + "/api/relay/forward", data={"cur_round": cur_round}, timeout=900)
+            resp.raise_for_status()
+            if wait_valid(root_url, cur_round, f"relay{i}") != "valid":
+                raise RuntimeError(f"relay{i} partial was rejected by the root")
+        forward_sec = time.perf_counter() - start
+
+        merged, aggregate_sec = aggregate_root(root_dir, numel, cur_round)
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+    from utils.fed_utils import fed_avg
+    expected = fed_avg(updates, sizes)
+    max_diff = (merged["weight"] - expected["weight"]).abs().max().item()
+
+    print(json.dumps({
+        "relays": args.relays,
+        "clients": len(updates),
+        "payload_mb": args.size_mb,
+        "upload_sec": round(upload_sec, 3),
+        "forward_sec": round(forward_sec, 3),
+        "root_aggregate_sec": round(aggregate_sec, 3),
+        "root_uploads": args.relays,
+        "max_abs_diff_vs_fed_avg": max_diff,
+        "match": max_diff < 1e-5,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
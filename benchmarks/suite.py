@@ -0,0 +1,383 @@
+"""
+End-to-end performance suite: uploads / downloads through the Flask app,
+aggregation latency and memory, checkpoint I/O and inference, all on
+synthetic UNETR-sized weights. Offline and CPU-only.
+
+    python -m benchmarks.suite --out results/main.json
+    python -m benchmarks.suite --quick --sections aggregation checkpoint
+    python -m benchmarks.suite --compare results/v1.json results/v2.json
+
+Results are a JSON file: an "environment" block (commit, versions, CPU)
+and a flat list of records {"name", "value", "unit", "better"}, so two
+runs can be compared name by name (--compare prints the ratios).
+
+Every aggregation / checkpoint / predict measurement runs in a fresh
+spawned process, so its peak RSS (VmHWM) belongs to that measurement
+alone; "baseline_rss_mb" is the same process right after its imports.
+Transfers go through serve.py (gunicorn) on loopback like load_test.
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import torch
+
+from benchmarks.load_test import REPO_DIR, launch_server, run_transfers
+
+SECTIONS = ("transfer", "aggregation", "checkpoint", "predict")
+ROI_SIZE = (128, 160, 160)
+
+
+# --- Synthetic weights ---
+def synthetic_state(seed=0):
+    """Random tensors with the exact keys, shapes and dtypes of the UNETR state dict."""
+    from models.unetr_model import get_unetr
+
+    template = get_unetr("cpu").state_dict()
+    g = torch.Generator().manual_seed(seed)
+    return {
+        k: torch.randn(v.shape, generator=g, dtype=v.dtype) if v.is_floating_point() else v.clone()
+        for k, v in template.items()
+    }
+
+
+def state_mb(state_dict):
+    return sum(t.numel() * t.element_size() for t in state_dict.values()) / 2**20
+
+
+def init_workdir(workdir, state_dict):
+    """Publish `state_dict` as round 0 of a fresh server directory."""
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        from server import FederatedServer
+        FederatedServer(model_fn=None, cur_round=None, test_loader=None).publish_global_model(0, state_dict)
+    finally:
+        os.chdir(cwd)
+
+
+# --- Isolated measurements ---
+def _peak_rss_mb():
+    # VmHWM starts over at exec; ru_maxrss would carry the parent's peak
+    # into the spawned child
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+def _run_measured(fn, args):
+    baseline = _peak_rss_mb()
+    result = fn(*args)
+    result["peak_rss_mb"] = round(_peak_rss_mb(), 1)
+    result["baseline_rss_mb"] = round(baseline, 1)
+    return result
+
+
+def isolated(fn, *args):
+    """Run fn(*args) in a new spawned process; its result dict gets peak / baseline RSS."""
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(_run_measured, (fn, args))
+
+
+def _fed_avg_job(workdir, cur_round, num_clients):
+    from utils.fed_utils import client_weights_path, fed_avg
+    from utils.weight_format import load_weights
+
+    os.chdir(workdir)
+    start = time.perf_counter()
+    state_dicts = [load_weights(client_weights_path("uploaded_client_weights", f"bench{i}", cur_round))
+                   for i in range(num_clients)]
+    fed_avg(state_dicts, [100 + 7 * i for i in range(num_clients)])
+    return {"sec": time.perf_counter() - start}
+
+
+def _aggregate_job(workdir, cur_round):
+    from server import FederatedServer
+
+    os.chdir(workdir)
+    start = time.perf_counter()
+    if not FederatedServer(model_fn=None, cur_round=cur_round, test_loader=None).aggregate():
+        raise RuntimeError(f"aggregation of round {cur_round} failed")
+    return {"sec": time.perf_counter() - start}
+
+
+def _checkpoint_job(workdir):
+    from server import FederatedServer
+    from utils.weight_format import FLAT_EXT, load_weights, save_weights
+
+    os.chdir(workdir)
+    state_dict = {k: v.clone() for k, v in load_weights("global_models/global_round_0.pth").items()}
+    result = {}
+
+    for label, ext in (("pth", ".pth"), ("flat", FLAT_EXT)):
+        path = os.path.join(workdir, "checkpoint_bench" + ext)
+        start = time.perf_counter()
+        save_weights(state_dict, path)
+        result[f"save_{label}_sec"] = time.perf_counter() - start
+
+        os.sync()
+        start = time.perf_counter()
+        loaded = load_weights(path)
+        result[f"open_{label}_sec"] = time.perf_counter() - start
+        # mmap'd loads are lazy, reading every tensor is the fair comparison
+        sum(float(t.float().sum()) for t in loaded.values())
+        result[f"load_{label}_sec"] = time.perf_counter() - start
+        del loaded
+        os.remove(path)
+
+    # what the server does per round: store blobs, .pth + .flat, checksums, pointers
+    server = FederatedServer(model_fn=None, cur_round=None, test_loader=None)
+    start = time.perf_counter()
+    server.publish_global_model(1000, state_dict)
+    result["publish_sec"] = time.perf_counter() - start
+    return result
+
+
+def _predict_job(volumes, amp, sw_batch_size):
+    from models.unetr_model import get_unetr
+    from utils.predict_eval_utils import predict
+
+    torch.manual_seed(0)
+    model = get_unetr("cpu")
+    image = torch.randn(3, *ROI_SIZE)
+
+    predict(model, image, "cpu", roi_size=ROI_SIZE, sw_batch_size=sw_batch_size, amp=amp)  # warm-up
+    start = time.perf_counter()
+    for _ in range(volumes):
+        predict(model, image, "cpu", roi_size=ROI_SIZE, sw_batch_size=sw_batch_size, amp=amp)
+    return {"sec_per_volume": (time.perf_counter() - start) / volumes}
+
+
+# --- Sections ---
+def record(records, name, value, unit, better):
+    records.append({"name": name, "value": round(value, 4), "unit": unit, "better": better})
+    print(f"  {name:<44} {value:12.3f} {unit}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def bench_transfer(records, state_dict, args):
+    workdir = tempfile.mkdtemp(prefix="fl_suite_transfer_")
+    init_workdir(workdir, state_dict)
+    buf = io.BytesIO()
+    torch.save(state_dict, buf)
+    payload = buf.getvalue()
+
+    proc, url = launch_server(workdir, free_port(), args.server_workers, args.server_threads)
+    try:
+        for level in args.concurrency:
+            up = run_transfers(url, payload, level, 0, cur_round=level, client_prefix=f"c{level}_")["upload"]
+            down = run_transfers(url, payload, 0, level)["download"]
+            for kind, r in (("upload", up), ("download", down)):
+                if r["ok"] != r["count"]:
+                    raise RuntimeError(f"{r['count'] - r['ok']} of {r['count']} {kind}s failed")
+                record(records, f"transfer.{kind}.c{level}.mb_per_sec", r["mb_per_sec"], "MB/s", "higher")
+                record(records, f"transfer.{kind}.c{level}.p95_sec", r["p95_sec"], "s", "lower")
+            # keep the disk footprint to one level's uploads (the server keeps the directory)
+            upload_dir = os.path.join(workdir, "uploaded_client_weights")
+            for name in os.listdir(upload_dir):
+                if name.startswith(f"c{level}_"):
+                    os.remove(os.path.join(upload_dir, name))
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_aggregation(records, state_dict, args):
+    from utils.fed_utils import client_weights_path
+    from utils.round_ledger import STATUS_VALID, get_ledger
+    from utils.weight_format import save_weights
+
+    workdir = tempfile.mkdtemp(prefix="fl_suite_agg_")
+    init_workdir(workdir, state_dict)
+    # two distinct client updates, written as often as needed
+    variant = {k: v + 0.01 if v.is_floating_point() else v for k, v in state_dict.items()}
+
+    cwd = os.getcwd()
+    try:
+        for num_clients in args.clients:
+            os.chdir(workdir)
+            os.makedirs("uploaded_client_weights", exist_ok=True)
+            ledger = get_ledger()
+            for i in range(num_clients):
+                path = client_weights_path("uploaded_client_weights", f"bench{i}", num_clients, ".pth")
+                save_weights(state_dict if i % 2 == 0 else variant, path)
+                ledger.record_upload(num_clients, f"bench{i}", 100 + 7 * i, status=STATUS_VALID)
+            os.chdir(cwd)
+
+            for label, fn, job_args in (
+                ("fed_avg", _fed_avg_job, (workdir, num_clients, num_clients)),
+                ("aggregate", _aggregate_job, (workdir, num_clients)),
+            ):
+                best = None
+                for _ in range(args.repeats):
+                    result = isolated(fn, *job_args)
+                    if best is None or result["sec"] < best["sec"]:
+                        best = result
+                record(records, f"aggregation.{label}.k{num_clients}.sec", best["sec"], "s", "lower")
+                record(records, f"aggregation.{label}.k{num_clients}.peak_rss_mb", best["peak_rss_mb"], "MB", "lower")
+                record(records, f"aggregation.{label}.k{num_clients}.baseline_rss_mb",
+                       best["baseline_rss_mb"], "MB", "lower")
+
+            shutil.rmtree(os.path.join(workdir, "uploaded_client_weights"), ignore_errors=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_checkpoint(records, state_dict, args):
+    workdir = tempfile.mkdtemp(prefix="fl_suite_ckpt_")
+    init_workdir(workdir, state_dict)
+    try:
+        runs = [isolated(_checkpoint_job, workdir) for _ in range(args.repeats)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for key in runs[0]:
+        if key.endswith("_sec"):
+            record(records, f"checkpoint.{key}", min(r[key] for r in runs), "s", "lower")
+    record(records, "checkpoint.peak_rss_mb", min(r["peak_rss_mb"] for r in runs), "MB", "lower")
+
+
+def bench_predict(records, args):
+    for amp in args.predict_amp:
+        result = isolated(_predict_job, args.predict_volumes, bool(amp), args.sw_batch_size)
+        label = "bf16" if amp else "fp32"
+        record(records, f"predict.{label}.volumes_per_sec", 1 / result["sec_per_volume"], "vol/s", "higher")
+        record(records, f"predict.{label}.peak_rss_mb", result["peak_rss_mb"], "MB", "lower")
+
+
+# --- Results ---
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                                text=True, timeout=30).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    try:
+        import monai
+        monai_version = monai.__version__
+    except ImportError:
+        monai_version = None
+
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "monai": monai_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def compare(old_path, new_path):
+    with open(old_path, "r") as f:
+        old = {r["name"]: r for r in json.load(f)["records"]}
+    with open(new_path, "r") as f:
+        new = json.load(f)["records"]
+
+    print(f"{'metric':<48} {'old':>12} {'new':>12} {'change':>9}")
+    for r in new:
+        before = old.get(r["name"])
+        if before is None or not before["value"]:
+            continue
+        ratio = r["value"] / before["value"]
+        # > 1 is an improvement whichever direction the metric goes
+        gain = ratio if r["better"] == "higher" else 1 / ratio if ratio else float("inf")
+        flag = "better" if gain > 1.05 else "worse" if gain < 0.95 else ""
+        print(f"{r['name']:<48} {before['value']:12.3f} {r['value']:12.3f} {gain:8.2f}x {flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end performance suite")
+    parser.add_argument("--out", default=None, help="write the results JSON here")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    parser.add_argument("--sections", nargs="+", choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument("--quick", action="store_true", help="small client counts and concurrency levels")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=None)
+    parser.add_argument("--clients", type=int, nargs="+", default=None)
+    parser.add_argument("--repeats", type=int, default=None)
+    parser.add_argument("--server-workers", type=int, default=2)
+    parser.add_argument("--server-threads", type=int, default=16)
+    parser.add_argument("--predict-volumes", type=int, default=None)
+    parser.add_argument("--predict-amp", type=int, nargs="+", choices=[0, 1], default=None,
+                        help="1 = bf16 autocast, 0 = fp32")
+    parser.add_argument("--sw-batch-size", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    defaults = {
+        "concurrency": [1, 2] if args.quick else [1, 4, 8],
+        "clients": [2, 4] if args.quick else [2, 4, 8, 16],
+        "repeats": 1 if args.quick else 3,
+        "predict_volumes": 1 if args.quick else 3,
+        "predict_amp": [0] if args.quick else [0, 1],
+    }
+    for key, value in defaults.items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+
+    sys.path.insert(0, REPO_DIR)
+    records = []
+    started = time.perf_counter()
+
+    state_dict = synthetic_state() if set(args.sections) - {"predict"} else None
+    if state_dict is not None:
+        print(f"Synthetic UNETR state dict: {len(state_dict)} tensors, {state_mb(state_dict):.1f} MB")
+
+    for section in args.sections:
+        print(f"[{section}]")
+        if section == "transfer":
+            bench_transfer(records, state_dict, args)
+        elif section == "aggregation":
+            bench_aggregation(records, state_dict, args)
+        elif section == "checkpoint":
+            bench_checkpoint(records, state_dict, args)
+        elif section == "predict":
+            bench_predict(records, args)
+
+    results = {
+        "suite": "fl-server-bench",
+        "version": 1,
+        "environment": environment(),
+        "config": vars(args),
+        "duration_sec": round(time.perf_counter() - started, 1),
+        "records": records,
+    }
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results → {args.out}")
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
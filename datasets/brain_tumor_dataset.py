@@ -1,22 +1,114 @@
 import os
+import argparse
 import numpy as np
 import torch
 from torch.utils.data import Dataset, DataLoader
 from monai.transforms import DivisiblePad
 from glob import glob
 from config import BASE_DIR
+from utils.locks import file_lock
+from utils.weight_format import is_flat_file, load_flat, read_metadata, save_flat_stream
+
+PAD_K = 16
+CACHE_VERSION = 1
+
+
+def _padded(size, k=PAD_K):
+    return (size + k - 1) // k * k
+
+
+def _source_stamp(paths):
+    return [[os.path.basename(p), os.path.getsize(p), int(os.path.getmtime(p))] for p in paths]
+
+
+# --- One-time preprocessing into a memory-mapped shard ---
+def build_shard_cache(img_files, mask_files, cache_path, dtype=torch.float32):
+    """
+    Writes every (image, mask) pair channel-first, padded and in `dtype`
+    into one flat file (see utils.weight_format) at `cache_path`. Volumes
+    are preprocessed one at a time, so the dataset never has to fit in RAM.
+    """
+    pad = DivisiblePad(k=PAD_K)
+    specs = []
+
+    for idx, (img_path, mask_path) in enumerate(zip(img_files, mask_files)):
+        # only the .npy headers are read here
+        h, w, d, c = np.load(img_path, mmap_mode="r").shape
+        spatial = (_padded(d), _padded(h), _padded(w))
+
+        def produce_img(img_path=img_path):
+            img = np.transpose(np.load(img_path), (3, 2, 0, 1))
+            return pad(torch.from_numpy(np.ascontiguousarray(img)).to(dtype)).as_tensor()
+
+        def produce_mask(mask_path=mask_path):
+            mask = np.expand_dims(np.transpose(np.load(mask_path), (2, 0, 1)), axis=0)
+            return pad(torch.from_numpy(np.ascontiguousarray(mask)).to(dtype)).as_tensor()
+
+        specs.append((f"img/{idx}", dtype, (c, *spatial), produce_img))
+        specs.append((f"mask/{idx}", dtype, (1, *spatial), produce_mask))
+
+    metadata = {
+        "version": CACHE_VERSION,
+        "count": len(img_files),
+        "pad_k": PAD_K,
+        "dtype": str(dtype).replace("torch.", ""),
+        "images": _source_stamp(img_files),
+        "masks": _source_stamp(mask_files),
+    }
+    save_flat_stream(specs, cache_path, metadata)
+    return cache_path
+
+
+def _cache_is_current(cache_path, img_files, mask_files, dtype):
+    if not is_flat_file(cache_path):
+        return False
+    meta = read_metadata(cache_path)
+    return (
+        meta.get("version") == CACHE_VERSION
+        and meta.get("pad_k") == PAD_K
+        and meta.get("dtype") == str(dtype).replace("torch.", "")
+        and meta.get("images") == _source_stamp(img_files)
+        and meta.get("masks") == _source_stamp(mask_files)
+    )
 
 
 class BrainTumor3DDataset(Dataset):
-    def __init__(self, img_dir, mask_dir):
+    """
+    With `cache_path`, volumes are preprocessed once into a shard file
+    (rebuilt when the source .npy files change) and __getitem__ returns
+    zero-copy views on its memory map. Without it, every access loads and
+    preprocesses the .npy files as before.
+    """
+
+    def __init__(self, img_dir, mask_dir, cache_path=None, cache_dtype=torch.float32):
         self.img_files = sorted(glob(os.path.join(img_dir, "*.npy")))
         self.mask_files = sorted(glob(os.path.join(mask_dir, "*.npy")))
-        self.pad = DivisiblePad(k=16)
+        self.pad = DivisiblePad(k=PAD_K)
+
+        self.cache_path = cache_path
+        self._cache = None
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            with file_lock(cache_path + ".lock"):
+                if not _cache_is_current(cache_path, self.img_files, self.mask_files, cache_dtype):
+                    print(f"[Dataset] Preprocessing {len(self.img_files)} volumes → {cache_path}")
+                    build_shard_cache(self.img_files, self.mask_files, cache_path, cache_dtype)
+
+    def __getstate__(self):
+        # DataLoader workers map the shard themselves instead of pickling views
+        state = self.__dict__.copy()
+        state["_cache"] = None
+        return state
 
     def __len__(self):
         return len(self.img_files)
 
     def __getitem__(self, idx):
+        if self.cache_path is not None:
+            if self._cache is None:
+                self._cache = load_flat(self.cache_path)
+            return self._cache[f"img/{idx}"], self._cache[f"mask/{idx}"]
+
         img = np.load(self.img_files[idx])
         mask = np.load(self.mask_files[idx])
 
@@ -34,7 +126,14 @@ class BrainTumor3DDataset(Dataset):
         return img, mask
 
 
-def get_client_data(batch_size=1):
+def get_client_data(batch_size=1, num_workers=0, pin_memory=None, persistent_workers=None,
+                    prefetch_factor=None, cache_dir=None, cache_dtype=torch.float32):
+    """
+    cache_dir enables the preprocessed shard cache (one file per split).
+    pin_memory defaults to True when CUDA is available, persistent_workers
+    to True whenever num_workers > 0; prefetch_factor only applies with
+    worker processes.
+    """
 
     data_path=os.path.join(BASE_DIR,"data")
 
@@ -47,12 +146,34 @@ def get_client_data(batch_size=1):
     test_img = os.path.join(data_path,"Testing","images")
     test_mask = os.path.join(data_path,"Testing","masks")
 
-    train_ds = BrainTumor3DDataset(train_img, train_mask)
-    val_ds = BrainTumor3DDataset(val_img, val_mask)
-    test_ds = BrainTumor3DDataset(test_img, test_mask)
+    def cache(split):
+        return os.path.join(cache_dir, f"{split}.shard") if cache_dir else None
 
-    train_loader = DataLoader(train_ds, batch_size=batch_size, shuffle=True)
-    val_loader = DataLoader(val_ds, batch_size=1, shuffle=False)
-    test_loader = DataLoader(test_ds, batch_size=1, shuffle=False)
+    train_ds = BrainTumor3DDataset(train_img, train_mask, cache("train"), cache_dtype)
+    val_ds = BrainTumor3DDataset(val_img, val_mask, cache("val"), cache_dtype)
+    test_ds = BrainTumor3DDataset(test_img, test_mask, cache("test"), cache_dtype)
+
+    loader_args = {
+        "num_workers": num_workers,
+        "pin_memory": torch.cuda.is_available() if pin_memory is None else pin_memory,
+    }
+    if num_workers > 0:
+        loader_args["persistent_workers"] = True if persistent_workers is None else persistent_workers
+        if prefetch_factor is not None:
+            loader_args["prefetch_factor"] = prefetch_factor
+
+    train_loader = DataLoader(train_ds, batch_size=batch_size, shuffle=True, **loader_args)
+    val_loader = DataLoader(val_ds, batch_size=1, shuffle=False, **loader_args)
+    test_loader = DataLoader(test_ds, batch_size=1, shuffle=False, **loader_args)
 
     return train_loader, val_loader, test_loader
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess the dataset into memory-mapped shards")
+    parser.add_argument("--cache-dir", default=os.path.join(BASE_DIR, "cache"))
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    args = parser.parse_args()
+
+    get_client_data(cache_dir=args.cache_dir, cache_dtype=getattr(torch, args.dtype))
+    print(f"Shards ready in {args.cache_dir}")
@@ -1,11 +1,17 @@
+import time
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk, messagebox
-import json
-import os
 from server import FederatedServer
 from models.unetr_model import get_unetr
+from utils.round_ledger import get_ledger
+from utils.round_events import file_signature, round_files
+from aggregation_daemon import (
+    published_round, read_daemon_status, request_aggregation, round_counts, run_aggregation
+)
 
-CLIENT_STATS_FILE = "client_stats.json"
+REFRESH_MS = 1000  # daemon status / round file check interval
 
 
 class ServerDashboard:
@@ -23,6 +29,14 @@ class ServerDashboard:
         self.num_clients = tk.IntVar(value=0)
         self.expected_clients = tk.IntVar(value=3)  # Set your expected number
 
+        # Long jobs run on a worker thread; results come back through this queue
+        self.results = queue.Queue()
+        self.busy = False
+        self.server = None  # kept warm between manual aggregations
+        # the ledger is only re-read after one of these files changed
+        self.round_files = round_files("global_models", get_ledger().db_path)
+        self.round_signature = None
+
         # -------------------------
         #   UI LAYOUT
         # -------------------------
@@ -107,6 +121,23 @@ class ServerDashboard:
         )
         self.expected_entry.grid(row=2, column=1, sticky="w")
 
+        # Aggregation daemon
+        tk.Label(
+            info_grid,
+            text="Aggregation Daemon:",
+            font=("Arial", 12, "bold"),
+            bg="#ffffff"
+        ).grid(row=3, column=0, sticky="w", padx=5, pady=5)
+
+        self.daemon_label = tk.Label(
+            info_grid,
+            text="not running",
+            font=("Arial", 12),
+            bg="#ffffff",
+            fg="#7f8c8d"
+        )
+        self.daemon_label.grid(row=3, column=1, sticky="w")
+
         # Buttons Frame
         btn_frame = tk.Frame(content_frame, bg="#f0f0f0")
         btn_frame.pack(fill=tk.X, pady=(0, 20))
@@ -168,25 +199,21 @@ class ServerDashboard:
 
         self.log("Dashboard started.")
         self.refresh_status()
+        self.root.after(REFRESH_MS, self.auto_refresh)
+        self.root.after(100, self.poll_results)
 
     # ----------------------------------------------------
-    #   Get current round from client_stats.json
+    #   Get current round from the round ledger
     # ----------------------------------------------------
     def get_current_round(self):
-        """Read current round from client_stats.json"""
-        if not os.path.exists(CLIENT_STATS_FILE):
-            return 1
-        
+        """Round after the latest published global model (the one to aggregate)"""
         try:
-            with open(CLIENT_STATS_FILE, "r") as f:
-                data = json.load(f)
-            
-            if not data:
-                return 1
-            
-            # Get max round + 1 (next round to aggregate)
-            rounds = [int(r) for r in data.keys()]
-            return max(rounds) if rounds else 1
+            published = published_round()
+            if published is not None:
+                return published + 1
+
+            max_round = get_ledger().max_round()
+            return max_round if max_round is not None else 1
             
         except Exception as e:
             self.log(f"Error reading current round: {e}")
@@ -209,23 +236,19 @@ class ServerDashboard:
     # ----------------------------------------------------
     #   Refresh number of client updates this round
     # ----------------------------------------------------
-    def refresh_status(self):
-        round_num = str(self.current_round.get())
+    def refresh_status(self, quiet=False):
+        if not self.busy:
+            self.round_signature = file_signature(self.round_files)
+            self.current_round.set(self.get_current_round())
+        round_num = self.current_round.get()
+        counts = round_counts(get_ledger().round_entries(round_num))
+        count = counts["valid"] + counts["pending"]
+        self.refresh_daemon_status()
 
-        if not os.path.exists(CLIENT_STATS_FILE):
-            self.num_clients.set(0)
-            self.client_label.config(
-                text=f"0 / {self.expected_clients.get()}",
-                fg="#e74c3c"
-            )
-            self.log("No client_stats.json found.")
+        if self.busy:
             return
 
-        with open(CLIENT_STATS_FILE, "r") as f:
-            stats = json.load(f)
-
-        if round_num in stats:
-            count = len(stats[round_num])
+        if count:
             self.num_clients.set(count)
             expected = self.expected_clients.get()
             
@@ -234,7 +257,9 @@ class ServerDashboard:
                 text=f"{count} / {expected}",
                 fg=color
             )
-            self.log(f"Round {round_num}: {count} client updates found.")
+            if not quiet:
+                self.log(f"Round {round_num}: {count} client updates found "
+                         f"({counts['pending']} pending validation, {counts['invalid']} rejected).")
             
             if count >= expected:
                 self.update_status("Ready to aggregate", "#27ae60")
@@ -246,13 +271,69 @@ class ServerDashboard:
                 text=f"0 / {self.expected_clients.get()}",
                 fg="#e74c3c"
             )
-            self.log(f"Round {round_num}: No updates found.")
+            if not quiet:
+                self.log(f"Round {round_num}: No updates found.")
             self.update_status("No client updates", "#e74c3c")
 
+    def refresh_daemon_status(self):
+        status = read_daemon_status()
+        if status is None:
+            self.daemon_label.config(text="not running (manual aggregation)", fg="#7f8c8d")
+            return
+
+        if status.get("mode") == "async":
+            text = (f"{status['state']} (async) - version {status['round']}, "
+                    f"{status['counts']['valid']}/{status['quorum']} buffered")
+        else:
+            text = f"{status['state']} - round {status['round']}, quorum {status['quorum']}"
+        if status.get("deadline_at"):
+            remaining = int(status["deadline_at"] - time.time())
+            text += f", deadline in {remaining}s" if remaining > 0 else ", deadline passed"
+        self.daemon_label.config(text=text, fg="#2980b9")
+
+    def auto_refresh(self):
+        try:
+            if self.busy or file_signature(self.round_files) != self.round_signature:
+                self.refresh_status(quiet=True)
+            else:
+                self.refresh_daemon_status()
+        except Exception as e:
+            self.log(f"Error refreshing status: {e}")
+        self.root.after(REFRESH_MS, self.auto_refresh)
+
+    # ----------------------------------------------------
+    #   Background jobs (never block the Tk main loop)
+    # ----------------------------------------------------
+    def run_in_background(self, job, on_done):
+        """Run `job()` on a worker thread; `on_done(result, error)` runs on the Tk thread."""
+        self.busy = True
+
+        def worker():
+            try:
+                self.results.put((on_done, job(), None))
+            except Exception as e:
+                self.results.put((on_done, None, e))
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def poll_results(self):
+        while True:
+            try:
+                on_done, result, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.busy = False
+            on_done(result, error)
+        self.root.after(100, self.poll_results)
+
     # ----------------------------------------------------
     #   Initialize new training from Round 0
     # ----------------------------------------------------
     def initialize_new_training(self):
+        if self.busy:
+            messagebox.showinfo("Busy", "Another job is still running.")
+            return
+
         result = messagebox.askyesno(
             "Initialize New Training",
             "This will create a fresh UNETR model and reset to Round 0.\n"
@@ -266,41 +347,50 @@ class ServerDashboard:
         self.log("=" * 50)
         self.log("Initializing new FL training session...")
         self.update_status("Initializing...", "#f39c12")
-        
-        try:
+
+        def job():
             # Create server with round 0 (will initialize fresh model)
-            server = FederatedServer(
+            return FederatedServer(
                 model_fn=get_unetr,
                 cur_round=0,
                 test_loader=None
             )
-            
-            self.current_round.set(1)  # Clients will start from round 1
-            self.num_clients.set(0)
-            
-            self.log("✓ Fresh UNETR model created and saved")
-            self.log("✓ Server ready for Round 1")
-            self.log("=" * 50)
-            
-            self.update_status("Initialized - Ready for Round 1", "#27ae60")
-            messagebox.showinfo(
-                "Success",
-                "New training session initialized!\n"
-                "Fresh UNETR model created.\n"
-                "Clients can now connect for Round 1."
-            )
-            
-            self.refresh_status()
-            
-        except Exception as e:
-            self.log(f"✗ Error: {str(e)}")
+
+        self.run_in_background(job, self.on_initialized)
+
+    def on_initialized(self, server, error):
+        if error is not None:
+            self.log(f"✗ Error: {str(error)}")
             self.update_status("Initialization failed", "#e74c3c")
-            messagebox.showerror("Error", str(e))
+            messagebox.showerror("Error", str(error))
+            return
+
+        self.server = server
+        self.current_round.set(1)  # Clients will start from round 1
+        self.num_clients.set(0)
+
+        self.log("✓ Fresh UNETR model created and saved")
+        self.log("✓ Server ready for Round 1")
+        self.log("=" * 50)
+
+        self.update_status("Initialized - Ready for Round 1", "#27ae60")
+        messagebox.showinfo(
+            "Success",
+            "New training session initialized!\n"
+            "Fresh UNETR model created.\n"
+            "Clients can now connect for Round 1."
+        )
+
+        self.refresh_status()
 
     # ----------------------------------------------------
     #   Run Aggregation
     # ----------------------------------------------------
     def aggregate_round(self):
+        if self.busy:
+            messagebox.showinfo("Busy", "Another job is still running.")
+            return
+
         round_num = self.current_round.get()
         
         # Check if we have enough clients
@@ -313,37 +403,48 @@ class ServerDashboard:
             if not result:
                 return
 
+        # A running daemon owns aggregation; just ask it to close the round
+        if read_daemon_status() is not None:
+            request_aggregation(round_num)
+            self.log(f"Asked the aggregation daemon to close Round {round_num}.")
+            self.update_status("Aggregation requested", "#2980b9")
+            return
+
         self.log(f"Starting aggregation for Round {round_num}...")
         self.update_status("Aggregating...", "#f39c12")
 
-        try:
-            server = FederatedServer(
-                model_fn=get_unetr,
-                cur_round=round_num,
-                test_loader=None,
-            )
+        def job():
+            if self.server is None:
+                self.server = FederatedServer(
+                    model_fn=get_unetr,
+                    cur_round=round_num,
+                    test_loader=None,
+                )
+            return run_aggregation(self.server, round_num)
 
-            success = server.aggregate()
-            
-            if not success:
-                self.log("✗ Aggregation failed - no valid client updates")
-                self.update_status("Aggregation failed", "#e74c3c")
-                messagebox.showerror("Error", "No valid client updates found for this round")
-                return
+        self.run_in_background(job, lambda success, error: self.on_aggregated(round_num, success, error))
 
-            self.log("✓ Aggregation completed successfully!")
-            self.update_status("Aggregation complete", "#27ae60")
-            messagebox.showinfo("Success", f"Round {round_num} aggregation complete!")
+    def on_aggregated(self, round_num, success, error):
+        if error is not None:
+            self.log(f"✗ Error: {str(error)}")
+            self.update_status("Error during aggregation", "#e74c3c")
+            messagebox.showerror("Error", str(error))
+            return
 
-            # Move to next round
-            self.current_round.set(round_num + 1)
-            self.num_clients.set(0)
-            self.refresh_status()
+        if not success:
+            self.log("✗ Aggregation failed - no valid client updates")
+            self.update_status("Aggregation failed", "#e74c3c")
+            messagebox.showerror("Error", "No valid client updates found for this round")
+            return
 
-        except Exception as e:
-            self.log(f"✗ Error: {str(e)}")
-            self.update_status("Error during aggregation", "#e74c3c")
-            messagebox.showerror("Error", str(e))
+        self.log("✓ Aggregation completed successfully!")
+        self.update_status("Aggregation complete", "#27ae60")
+        messagebox.showinfo("Success", f"Round {round_num} aggregation complete!")
+
+        # Move to next round
+        self.current_round.set(round_num + 1)
+        self.num_clients.set(0)
+        self.refresh_status()
 
 
 # ---------------------------------------------------------
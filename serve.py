@@ -0,0 +1,92 @@
+"""
+Production entry point for server_backend.
+
+    python serve.py --workers 4 --threads 16 --port 8000
+
+Runs the Flask app under gunicorn with pre-forked workers, each with a pool
+of threads, so a slow hospital upload only ties up one thread instead of
+the whole server. Model downloads go through sendfile(2). Shared state is
+already process-safe: the round ledger is SQLite, chunked upload sessions
+and the running FedAvg sum live on disk behind file locks.
+
+Clients waiting for the next round (/api/wait-for-round, /api/round-events)
+each park a thread, so every worker gets --round-waiters threads on top of
+--threads for them; further waiters are asked to retry later.
+
+Admission control is off unless --max-uploads / --max-downloads are
+given. Then concurrent transfers are capped across all workers and the
+rest queue in arrival order for a few seconds, answered with 503 +
+Retry-After beyond that, so a burst of finished sites is written at the
+disk's sequential speed instead of thrashing it. Only enable it when the
+clients retry 503s; stock clients give up. Clients that send their
+client_id get one transfer at a time, their others wait behind it.
+Queued requests hold a thread too, keep --threads above the caps.
+"""
+import os
+import argparse
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+
+
+class FLServerApplication(BaseApplication):
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from server_backend import app
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the FL server backend with gunicorn")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=min(4, multiprocessing.cpu_count()))
+    parser.add_argument("--threads", type=int, default=16,
+                        help="concurrent transfers per worker")
+    parser.add_argument("--max-uploads", type=int, default=None,
+                        help="concurrent uploads over all workers, 0 = no cap (default)")
+    parser.add_argument("--max-downloads", type=int, default=None,
+                        help="concurrent model downloads over all workers, 0 = no cap (default)")
+    parser.add_argument("--round-quota-mb", type=float, default=None,
+                        help="disk quota for one round's uploads, 0 = unlimited")
+    parser.add_argument("--round-waiters", type=int, default=64,
+                        help="long-poll / SSE clients parked per worker (idle threads, no CPU)")
+    parser.add_argument("--metrics-dir", default=os.environ.get("FL_METRICS_DIR", "metrics"),
+                        help="per-worker metrics snapshots merged by /metrics")
+    parser.add_argument("--timeout", type=int, default=900,
+                        help="seconds before a silent worker is restarted (large uploads)")
+    args = parser.parse_args()
+
+    options = {
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "threads": args.threads + args.round_waiters,
+        "worker_class": "gthread",
+        "timeout": args.timeout,
+        "keepalive": 30,
+        # unbounded request lines/headers are not needed, bodies are streamed
+        "limit_request_line": 8190,
+        "worker_tmp_dir": "/dev/shm" if os.path.isdir("/dev/shm") else None,
+    }
+    # read by server_backend in every worker
+    os.environ["FL_MAX_ROUND_WAITERS"] = str(args.round_waiters)
+    os.environ["FL_METRICS_DIR"] = os.path.abspath(args.metrics_dir)
+    for env, value in (("FL_MAX_UPLOADS", args.max_uploads), ("FL_MAX_DOWNLOADS", args.max_downloads),
+                       ("FL_ROUND_QUOTA_MB", args.round_quota_mb)):
+        if value is not None:
+            os.environ[env] = str(value)
+    print(f"[SERVER] Starting {args.workers} workers x {args.threads} threads "
+          f"(+{args.round_waiters} for round waiters) on {options['bind']}")
+    FLServerApplication(options).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,119 +1,407 @@
 import torch
 import os
-import json
-from utils.fed_utils import fed_avg
+import time
+import shutil
+import threading
+from utils.fed_utils import (
+    FedAvgAggregator, KrumAggregator, StreamingFedAvg, client_weights_path, get_aggregator, running_sum_path
+)
+from utils.parallel_agg import parallel_fed_avg
+from utils.weight_format import FLAT_EXT, save_weights
+from utils.round_ledger import CLIENT_STATS_DB, CLIENT_STATS_FILE, STATUS_PENDING, STATUS_VALID, get_ledger
+from utils.locks import tmp_path_for
+from utils.flat_utils import get_layout
+from utils.checkpoint_store import CheckpointStore
+from utils.transport import precompress
+from utils.async_fl import buffered_entries, fedbuff_update
+from utils import telemetry
+from utils.evaluation import append_global_metrics, evaluate_global_model
+from utils.checkpoint_utils import (
+    global_round_path, read_manifest, write_checksum, write_latest_pointer, write_manifest
+)
+
+PRECOMPRESS_LOCK = threading.Lock()
 
 class FederatedServer:
 
-    def __init__(self, model_fn, cur_round, test_loader, device=None):
+    def __init__(self, model_fn, cur_round, test_loader, device=None, store=None,
+                 eval_workers=1, sw_batch_size=4, amp=True):
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
-        self.model = model_fn(self.device)
+        # built on first use only; aggregation works on tensor files
+        self.model_fn = model_fn
+        self._model = None
 
         self.cur_round = cur_round
         self.test_loader = test_loader
 
+        # post-aggregation evaluation on test_loader
+        self.eval_workers = eval_workers
+        self.sw_batch_size = sw_batch_size
+        self.amp = amp
+        self.logs_dir = "logs"
+
         self.global_model_dir = "global_models"
         self.client_weights_dir = "uploaded_client_weights"
-        self.client_stats_file = "client_stats.json"
+        self.client_stats_file = CLIENT_STATS_FILE  # legacy, imported into the ledger
+        self.ledger = get_ledger(CLIENT_STATS_DB, self.client_stats_file)
 
         os.makedirs(self.client_weights_dir, exist_ok=True)
         os.makedirs(self.global_model_dir, exist_ok=True)
+
+        # content-addressed history of published rounds + retention policy
+        self.store = store or CheckpointStore(self.global_model_dir)
         
         # Initialize global model if starting from round 0
         if cur_round == 0:
             self.initialize_global_model()
 
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self.model_fn(self.device)
+        return self._model
+
     def initialize_global_model(self):
         print("[Server] Initializing fresh global model for Round 0...")
         
         # Model is already initialized in __init__, just save it
-        latest_path = os.path.join(self.global_model_dir, "global_latest.pth")
-        round_path = os.path.join(self.global_model_dir, "global_round_0.pth")
-        
-        torch.save(self.model.state_dict(), latest_path)
-        torch.save(self.model.state_dict(), round_path)
+        latest_path = self.publish_global_model(0)
         
         print(f"[Server] Fresh model saved → {latest_path}")
         
-        # Initialize client_stats.json if it doesn't exist
-        if not os.path.exists(self.client_stats_file):
-            with open(self.client_stats_file, "w") as f:
-                json.dump({}, f, indent=4)
-            print(f"[Server] Created {self.client_stats_file}")
+        # The round ledger (client_stats.db) is created on first use
+        print(f"[Server] Round ledger → {self.ledger.db_path}")
+
+    def publish_global_model(self, round_num, state_dict=None):
+        """
+        Store the model (or `state_dict`) as round `round_num`: tensor blobs
+        into the checkpoint store, then one full file per format (.pth for
+        clients, .flat for zero-copy server-side reads). global_latest.* and
+        latest.json only move once every file is in place, then the
+        retention policy prunes old rounds.
+        """
+        if state_dict is None:
+            state_dict = self.model.state_dict()
+
+        new_bytes, total_bytes = self.store.commit_round(round_num, state_dict)
+        print(f"[Server] Checkpoint store: {new_bytes / 2**20:.1f} MB new of "
+              f"{total_bytes / 2**20:.1f} MB (unchanged tensors shared)")
+
+        checksums = {}
+        for ext in (".pth", FLAT_EXT):
+            path = global_round_path(self.global_model_dir, round_num, ext)
+            save_weights(state_dict, path)
+            checksums[ext] = write_checksum(path)  # strong ETag for downloads
+
+            # hard link instead of a second write; rename keeps it atomic
+            latest = os.path.join(self.global_model_dir, f"global_latest{ext}")
+            tmp_latest = tmp_path_for(latest)
+            try:
+                os.link(path, tmp_latest)
+            except OSError:
+                shutil.copyfile(path, tmp_latest)
+            os.replace(tmp_latest, latest)
 
-    def save_global_model(self, round_num):
-        # save round-specific
-        path = os.path.join(self.global_model_dir, f"global_round_{round_num}.pth")
-        torch.save(self.model.state_dict(), path)
+        # key/shape/dtype layout that uploads are validated against
+        if round_num == 0 or read_manifest(self.global_model_dir) is None:
+            write_manifest(self.global_model_dir, get_layout(state_dict))
 
-        # save latest
-        latest = os.path.join(self.global_model_dir, "global_latest.pth")
-        torch.save(self.model.state_dict(), latest)
+        write_latest_pointer(self.global_model_dir, round_num, checksums)
+
+        # compressed copies for ?compressed=1 downloads, off the publish path;
+        # until they exist downloads are served plain. Not a daemon thread,
+        # so a one-off aggregation still finishes them before exiting.
+        threading.Thread(target=self.precompress_round, args=(round_num,), name="precompress").start()
+
+        summary = self.store.gc(protected={round_num})
+        if summary["dropped_rounds"] or summary["freed_bytes"]:
+            print(f"[Server] Retention: dropped rounds {summary['dropped_rounds']}, "
+                  f"freed {summary['freed_bytes'] / 2**20:.1f} MB")
+        return os.path.join(self.global_model_dir, "global_latest.pth")
+
+    def precompress_round(self, round_num):
+        with PRECOMPRESS_LOCK, telemetry.span("precompress", round=round_num):  # one round at a time
+            for ext in (".pth", FLAT_EXT):
+                path = global_round_path(self.global_model_dir, round_num, ext)
+                try:
+                    sizes = precompress(path)
+                except FileNotFoundError:
+                    return  # already pruned by retention
+                if sizes:
+                    original = os.path.getsize(path)
+                    print(f"[Server] Precompressed {os.path.basename(path)}: " + ", ".join(
+                        f"{enc} {size / original:.0%}" for enc, size in sizes.items()))
+
+    def save_global_model(self, round_num, state_dict=None):
+        self.publish_global_model(round_num, state_dict)
 
         print(f"[Server] Saved global model (Round {round_num})")
 
     def read_client_stats(self):
-        if not os.path.exists(self.client_stats_file):
-            return []
-            
-        with open(self.client_stats_file, "r") as f:
-            data = json.load(f)
-        return data.get(str(self.cur_round), [])
+        return self.ledger.round_entries(self.cur_round)
     
     @staticmethod
     def get_current_round_from_stats():
-        client_stats_file = "client_stats.json"
-        
-        if not os.path.exists(client_stats_file):
-            return 0
-        
         try:
-            with open(client_stats_file, "r") as f:
-                data = json.load(f)
-            
-            if not data:
-                return 0
-            
-            # Get the maximum round number
-            rounds = [int(r) for r in data.keys()]
-            return max(rounds) if rounds else 0
+            max_round = get_ledger().max_round()
+            return max_round if max_round is not None else 0
             
         except Exception as e:
             print(f"[Server] Error reading current round: {e}")
             return 0
 
-    def aggregate(self):
-        client_data = self.read_client_stats()
-        
-        if not client_data:
-            print(f"[Server] No client updates found for Round {self.cur_round}")
-            return False
+    def conform_to_manifest(self, state_dict):
+        """
+        Check an aggregated state dict against the manifest captured at
+        initialize_global_model and return it in the model's key order and
+        dtypes, so it can be published without building the model.
+        """
+        layout = read_manifest(self.global_model_dir)
+        if layout is None:
+            return state_dict
+
+        if not layout.matches(state_dict):
+            raise ValueError("Aggregated weights do not match the global model manifest")
 
-        state_dicts = []
-        dataset_sizes = []
+        return {
+            key: state_dict[key] if state_dict[key].dtype == dtype else state_dict[key].to(dtype)
+            for key, dtype in zip(layout.keys, layout.dtypes)
+        }
 
+    def validated_entries(self, client_data):
+        """Entries the upload validator accepted (legacy rows were never checked)."""
+        accepted = []
+        for entry in client_data:
+            status = entry.get("status")
+            if status in (None, STATUS_VALID):
+                accepted.append(entry)
+            elif status == STATUS_PENDING:
+                print(f"[Server] Skipping {entry['client_id']}: validation still pending")
+            else:
+                print(f"[Server] Skipping {entry['client_id']}: {entry.get('reason')}")
+        return accepted
+
+    def load_running_sum(self, client_data):
+        """Return the backend's running sum if it covers exactly these clients."""
+        path = running_sum_path(self.client_weights_dir, self.cur_round)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            acc = StreamingFedAvg.load(path)
+        except Exception as e:
+            print(f"[Server] Could not read running sum ({e}), re-reading client files")
+            return None
+
+        expected = {e["client_id"]: int(e["dataset_size"]) for e in client_data}
+        if acc.clients != expected:
+            print("[Server] Running sum is out of date, re-reading client files")
+            return None
+
+        return acc
+
+    def client_weight_files(self, client_data):
+        files = []
         for entry in client_data:
             client_id = entry["client_id"]
-            dataset_sizes.append(int(entry["dataset_size"]))
 
-            weights_path = os.path.join(
-                self.client_weights_dir, 
-                f"{client_id}_round{self.cur_round}.pth"
+            weights_path = client_weights_path(
+                self.client_weights_dir, client_id, self.cur_round
             )
             
-            if not os.path.exists(weights_path):
+            if weights_path is None:
                 print(f"[Server] Warning: Missing weights for {client_id}")
                 continue
 
-            state_dicts.append(torch.load(weights_path, map_location=self.device))
+            files.append((client_id, int(entry["dataset_size"]), weights_path))
+        return files
 
-        if not state_dicts:
-            print(f"[Server] No valid client weights found for Round {self.cur_round}")
+    def stream_files(self, files):
+        """Fold client files one at a time into a single buffer."""
+        acc = StreamingFedAvg(self.cur_round)
+        for client_id, size, path in files:
+            acc.add_file(path, size, client_id, global_model_dir=self.global_model_dir)
+        return acc
+
+    def partial_sum(self):
+        """
+        Weighted sum of this round's validated uploads, without dividing:
+        what a relay forwards upstream. None if there is nothing to send.
+        """
+        client_data = self.validated_entries(self.read_client_stats())
+        if not client_data:
+            return None
+
+        acc = self.load_running_sum(client_data)
+        if acc is None:
+            files = self.client_weight_files(client_data)
+            if not files:
+                return None
+            acc = self.stream_files(files)
+        return acc
+
+    def aggregate(self, num_workers=1, aggregator=None):
+        """
+        num_workers > 1 shards parameter keys across that many processes
+        (used when the backend's running sum can't be reused).
+        aggregator picks the strategy for this round: a name from
+        fed_utils.AGGREGATORS or an Aggregator instance (default FedAvg).
+        """
+        if isinstance(aggregator, str):
+            aggregator = get_aggregator(aggregator)
+        robust = aggregator is not None and not isinstance(aggregator, FedAvgAggregator)
+
+        client_data = self.read_client_stats()
+        
+        if not client_data:
+            print(f"[Server] No client updates found for Round {self.cur_round}")
+            return False
+
+        client_data = self.validated_entries(client_data)
+
+        if not client_data:
+            print(f"[Server] No validated client updates for Round {self.cur_round}")
+            return False
+
+        # Fast path: uploads were already folded in by the backend
+        start = time.perf_counter()
+        acc = None if robust else self.load_running_sum(client_data)
+        load_sec = time.perf_counter() - start
+
+        if acc is not None:
+            new_state = acc.result()
+        else:
+            files = self.client_weight_files(client_data)
+
+            if not files:
+                print(f"[Server] No valid client weights found for Round {self.cur_round}")
+                return False
+
+            # robust and parallel aggregation read uploads inside the
+            # average, only the streaming path reports its load time apart
+            if robust:
+                print(f"[Server] Aggregating {len(files)} clients with {aggregator.name}")
+                new_state = aggregator.aggregate(
+                    [path for _, _, path in files],
+                    [size for _, size, _ in files],
+                    global_model_dir=self.global_model_dir,
+                )
+                if isinstance(aggregator, KrumAggregator):
+                    print(f"[Server] Krum kept: {', '.join(files[i][0] for i in aggregator.selected)}")
+            elif num_workers > 1:
+                print(f"[Server] Aggregating {len(files)} clients with {num_workers} workers")
+                new_state = parallel_fed_avg(
+                    [path for _, _, path in files],
+                    [size for _, size, _ in files],
+                    num_workers=num_workers,
+                    global_model_dir=self.global_model_dir,
+                )
+            else:
+                acc = self.stream_files(files)
+                load_sec += acc.load_sec
+                new_state = acc.result()
+        average_sec = time.perf_counter() - start - load_sec
+
+        new_state = self.conform_to_manifest(new_state)
+
+        # keep an already-built model (e.g. for evaluation) in sync
+        if self._model is not None:
+            self._model.load_state_dict(new_state)
+
+        self.publish_and_evaluate(new_state, len(client_data), load=load_sec, average=average_sec)
+        return True
+
+    def publish_and_evaluate(self, new_state, num_clients, after_save=None, **phases):
+        """
+        Save round cur_round, run `after_save`, score the new model and
+        record the phase timings (seconds) in the metrics.
+        """
+        start = time.perf_counter()
+        self.save_global_model(self.cur_round, new_state)
+        phases["save"] = time.perf_counter() - start
+        if after_save is not None:
+            after_save()
+
+        start = time.perf_counter()
+        if self.evaluate_round(self.cur_round, new_state) is not None:
+            phases["evaluate"] = time.perf_counter() - start
+
+        for phase, seconds in phases.items():
+            telemetry.observe("fl_aggregation_phase_seconds", seconds, phase=phase)
+        telemetry.set_gauge("fl_aggregation_clients", num_clients)
+
+    def aggregate_async(self, config):
+        """
+        Asynchronous mode (see utils.async_fl): publish version cur_round
+        from the buffered uploads of the last max_staleness versions, each
+        applied as a staleness-weighted delta against its own base.
+        """
+        version = self.cur_round - 1
+        entries = buffered_entries(self.ledger, version, config["max_staleness"])
+        start = time.perf_counter()
+
+        if not entries:
+            print(f"[Server] No buffered client updates for version {self.cur_round}")
+            return False
+
+        new_state, acc = fedbuff_update(
+            entries[:config["buffer_size"]] if config.get("buffer_size") else entries,
+            version,
+            lambda e: client_weights_path(self.client_weights_dir, e["client_id"], e["round"]),
+            self.global_model_dir,
+            config,
+        )
+        if new_state is None:
+            print(f"[Server] No usable client updates for version {self.cur_round}")
             return False
+        average_sec = time.perf_counter() - start
 
-        # run FedAvg
-        new_state = fed_avg(state_dicts, dataset_sizes)
-        self.model.load_state_dict(new_state)
+        staleness = [s for s, _ in acc.uploads.values()]
+        print(f"[Server] Applying {len(staleness)} buffered updates to version {version} "
+              f"(staleness {min(staleness)}-{max(staleness)})")
+
+        new_state = self.conform_to_manifest(new_state)
+        if self._model is not None:
+            self._model.load_state_dict(new_state)
+
+        # uploads are read against their bases inside the average
+        self.publish_and_evaluate(
+            new_state, len(acc.uploads),
+            after_save=lambda: self.ledger.mark_applied(list(acc.uploads), self.cur_round),
+            average=average_sec,
+        )
+        return True
+
+    def evaluate_round(self, round_num, state_dict):
+        """Score the new global model on test_loader and log it to global_metrics.csv."""
+        if self.test_loader is None:
+            return None
+
+        print(f"[Server] Evaluating Round {round_num} global model...")
+        try:
+            if self.eval_workers > 1:
+                model = None  # each worker loads the published .flat itself
+            else:
+                model = self.model
+                model.load_state_dict(state_dict)
+
+            metrics = evaluate_global_model(
+                self.model_fn,
+                global_round_path(self.global_model_dir, round_num, FLAT_EXT),
+                self.test_loader,
+                num_workers=self.eval_workers,
+                sw_batch_size=self.sw_batch_size,
+                amp=self.amp,
+                device=self.device,
+                model=model,
+            )
+        except Exception as e:
+            # the round is already published, a failed evaluation must not undo that
+            print(f"[Server] Evaluation of Round {round_num} failed: {e}")
+            return None
 
-        self.save_global_model(self.cur_round)
-        return True
\ No newline at end of file
+        append_global_metrics(self.logs_dir, round_num, metrics)
+        print(f"[Server] Round {round_num}: Dice {metrics['dice']:.4f}, "
+              f"pixel acc {metrics['pixel_acc']:.4f} "
+              f"({metrics['num_volumes']} volumes, {metrics['eval_sec']}s)")
+        return metrics
@@ -1,17 +1,354 @@
-from flask import Flask, request, jsonify, Response
-from flask import send_file
+from flask import Flask, Request, request, jsonify, Response
+from flask import send_file, g
+from werkzeug.utils import cached_property
+from werkzeug.sansio.multipart import Data, Field, File, MultipartDecoder, NeedData
 import os
-import time
 import json
-from datetime import datetime
+import time
+import tempfile
+import threading
+import requests
+from utils.fed_utils import StreamingFedAvg, running_sum_path, client_weights_path
+from utils.weight_format import MAGIC, FLAT_EXT, load_weights
+from utils.delta_codec import DIFF_TYPES, base_model_path, read_encoding, save_xor_diff
+from utils.chunked_upload import ChunkedUploadStore, ChunkError, HashingFile
+from utils.round_ledger import (
+    CLIENT_STATS_DB, CLIENT_STATS_FILE, STATUS_INVALID, STATUS_PENDING, STATUS_VALID, get_ledger,
+)
+from utils.upload_validation import UploadValidator
+from utils.locks import file_lock, tmp_path_for
+from utils.checkpoint_utils import file_sha256, global_round_path, read_checksum, read_latest_pointer
+from utils.checkpoint_store import materialize_round
+from utils.async_fl import buffered_entries, read_async_config, upload_staleness
+from utils.round_events import RoundState, round_files
+from utils.admission import Saturated, TransferGate
+from utils.transport import (
+    ENCODINGS, DecodedTooLarge, DecodingStream, EncodingError, available_encodings, encoded_path, precompress,
+)
+from utils import telemetry
+from server import FederatedServer
+
+FORM_PEEK_BYTES = 64 * 1024  # multipart head searched for client_id before admission
+
+class PrefixedStream:
+    """`head` (already read off `stream`) followed by the rest of `stream`."""
+
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.head = self.head + self.stream.read(), b""
+        else:
+            data, self.head = self.head[:size], self.head[size:]
+        return data
+
+class UploadRequest(Request):
+    """Spools multipart file parts straight into UPLOAD_DIR, so saving an
+    upload is a rename instead of a second full copy. Bodies sent with a
+    Content-Encoding are decoded on the way (utils/transport.py)."""
+
+    @cached_property
+    def stream(self):
+        stream = Request.stream.fget(self)
+        content_encoding = (self.content_encoding or "identity").lower()
+        if content_encoding != "identity":
+            return DecodingStream(stream, content_encoding)
+        return stream
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # hashed while it streams in, for the validation verdict
+        spool = HashingFile(tempfile.NamedTemporaryFile("wb+", dir=UPLOAD_DIR, prefix=".spool-", delete=False))
+        self.__dict__.setdefault("spool_files", []).append(spool)
+        return spool
+
+    @cached_property
+    def head_fields(self):
+        """
+        Multipart fields sent before the first file part (requests puts
+        data= ahead of files=), read from the first FORM_PEEK_BYTES of the
+        body without consuming it.
+        """
+        boundary = self.mimetype_params.get("boundary")
+        if self.mimetype != "multipart/form-data" or not boundary:
+            return {}
+
+        head = b""
+        while len(head) < FORM_PEEK_BYTES:
+            block = self.stream.read(FORM_PEEK_BYTES - len(head))
+            if not block:
+                break
+            head += block
+        self.stream = PrefixedStream(head, self.stream)
+
+        decoder = MultipartDecoder(boundary.encode())
+        decoder.receive_data(head)
+        fields, name, value = {}, None, []
+        try:
+            event = decoder.next_event()
+            while not isinstance(event, (File, NeedData)):
+                if isinstance(event, Field):
+                    name, value = event.name, []
+                elif isinstance(event, Data) and name is not None:
+                    value.append(event.data)
+                    if not event.more_data:
+                        fields[name] = b"".join(value).decode("utf-8", "replace")
+                event = decoder.next_event()
+        except ValueError:  # malformed, the form parser will say so
+            pass
+        return fields
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+# Behind nginx/apache, let the proxy send model files (X-Sendfile)
+app.config["USE_X_SENDFILE"] = os.environ.get("FL_USE_X_SENDFILE") == "1"
 
-CLIENT_STATS_FILE = "client_stats.json"
 UPLOAD_DIR = "uploaded_client_weights"
-GLOBAL_MODEL_PATH = "global_models/global_latest.pth"
+GLOBAL_MODEL_DIR = "global_models"
+GLOBAL_MODEL_PATH = os.path.join(GLOBAL_MODEL_DIR, "global_latest.pth")
+GLOBAL_FLAT_MODEL_PATH = os.path.join(GLOBAL_MODEL_DIR, "global_latest" + FLAT_EXT)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs("global_models", exist_ok=True)
+os.makedirs(GLOBAL_MODEL_DIR, exist_ok=True)
+
+DIFF_CACHE_DIR = os.path.join(GLOBAL_MODEL_DIR, "diffs")
+os.makedirs(DIFF_CACHE_DIR, exist_ok=True)
+
+# Per-round upload records (imports a legacy client_stats.json once)
+ledger = get_ledger(CLIENT_STATS_DB, CLIENT_STATS_FILE)
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # suggested chunk size for /api/uploads
+upload_store = ChunkedUploadStore(UPLOAD_DIR)
+
+# Running FedAvg buffer for the round currently receiving uploads
+running_sum = None
+running_sum_lock = threading.Lock()
+
+VALIDATION_WORKERS = 2
+
+# Relay mode: this node collects one region's uploads and forwards a single
+# partial weighted sum to FL_UPSTREAM_URL (the root or another relay)
+UPSTREAM_URL = os.environ.get("FL_UPSTREAM_URL", "").rstrip("/") or None
+RELAY_ID = os.environ.get("FL_RELAY_ID", "relay")
+RELAY_QUORUM = int(os.environ.get("FL_RELAY_QUORUM", "0"))  # auto-forward after N valid uploads, 0 = on request
+UPSTREAM_SYNC_INTERVAL = 5  # seconds between checks for a new upstream global model / round
+UPSTREAM_ROUND_TIMEOUT = 10
+RELAY_VALIDATION_WAIT = 120  # seconds a forward waits for the round's pending uploads
+UPSTREAM_STATE = os.path.join(GLOBAL_MODEL_DIR, "upstream.json")
+last_upstream_sync = 0.0
+last_upstream_round_check = 0.0
+upstream_round = None  # upstream's get-current-round answer, refreshed on the round watcher thread
+
+# Long-poll / SSE round notifications. Every waiting client parks one
+# thread; past FL_MAX_ROUND_WAITERS per worker they are told to come back
+# later so transfers never run out of threads (serve.py --round-waiters).
+MAX_ROUND_WAITERS = int(os.environ.get("FL_MAX_ROUND_WAITERS", "64"))
+LONG_POLL_TIMEOUT = 30  # default seconds a wait-for-round request is held
+LONG_POLL_MAX = 300
+WAITERS_RETRY_AFTER = 5  # seconds, when all waiter slots are taken
+SSE_KEEPALIVE = 15  # seconds between comment lines on an idle event stream
+round_waiters = threading.BoundedSemaphore(MAX_ROUND_WAITERS)
+
+# Admission control (utils/admission.py), opt-in: with FL_MAX_UPLOADS /
+# FL_MAX_DOWNLOADS set, concurrent transfers are capped across all workers
+# and queued, identified clients get FL_PER_CLIENT_TRANSFERS at a time.
+# Queued requests past the wait get a 503 that stock clients do not retry.
+# A round's stored uploads may not exceed FL_ROUND_QUOTA_MB.
+MAX_UPLOADS = int(os.environ.get("FL_MAX_UPLOADS", "0"))  # 0 = no cap
+MAX_DOWNLOADS = int(os.environ.get("FL_MAX_DOWNLOADS", "0"))
+PER_CLIENT_TRANSFERS = int(os.environ.get("FL_PER_CLIENT_TRANSFERS", "1"))
+ADMISSION_QUEUE = int(os.environ.get("FL_ADMISSION_QUEUE", "32"))  # waiting requests per kind
+ADMISSION_WAIT = float(os.environ.get("FL_ADMISSION_WAIT", "15"))  # seconds queued before a 503
+ROUND_QUOTA_BYTES = int(float(os.environ.get("FL_ROUND_QUOTA_MB", "0")) * 1024 * 1024)  # 0 = unlimited
+ADMISSION_DIR = os.path.join(UPLOAD_DIR, ".admission")
+gates = {
+    kind: TransferGate(ADMISSION_DIR, kind, limit, PER_CLIENT_TRANSFERS,
+                       queue_limit=ADMISSION_QUEUE, max_wait=ADMISSION_WAIT)
+    for kind, limit in (("upload", MAX_UPLOADS), ("download", MAX_DOWNLOADS))
+}
+
+# ----------------------------------------------------
+#   Metrics (Prometheus text format, see utils.telemetry)
+#   GET /metrics
+# ----------------------------------------------------
+UPLOAD_ENDPOINTS = {"upload_client_weights", "upload_chunk"}
+DOWNLOAD_ENDPOINTS = {"get_global_model", "get_global_model_diff"}
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.transfer = ("upload" if request.endpoint in UPLOAD_ENDPOINTS
+                  else "download" if request.endpoint in DOWNLOAD_ENDPOINTS else None)
+    if g.transfer:
+        telemetry.inc("fl_transfers_in_flight", direction=g.transfer)
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get("request_start")
+    if start is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    method = request.method
+    transfer = g.get("transfer")
+    ticket = g.get("admission_ticket")
+    if transfer == "upload" and request.content_length and ticket is not None:  # body was admitted
+        telemetry.inc("fl_upload_bytes_total", request.content_length, route=route)
+
+    # streamed bodies (send_file) are only done once the response is closed
+    def finished():
+        if ticket is not None:
+            ticket.release()
+        telemetry.observe("fl_http_request_duration_seconds", time.perf_counter() - start,
+                          route=route, method=method)
+        telemetry.inc("fl_http_requests_total", route=route, method=method, status=response.status_code)
+        if transfer:
+            telemetry.inc("fl_transfers_in_flight", -1, direction=transfer)
+        if transfer == "download" and response.status_code in (200, 206) and response.content_length:
+            telemetry.inc("fl_download_bytes_total", response.content_length, route=route)
+
+    on_response_closed(response, finished)
+    return response
+
+# ----------------------------------------------------
+#   Admission control, decided before the body is read
+# ----------------------------------------------------
+def transfer_client_key():
+    """
+    The body is not parsed yet, so clients are identified by ?client_id=,
+    X-Client-ID or a client_id form field ahead of the file (chunks by
+    their session). None for anonymous requests: many sites can share one
+    address behind NAT or a proxy, so those only count toward the global cap.
+    """
+    if request.endpoint == "upload_chunk":
+        session = upload_store.get(request.view_args["upload_id"])
+        if session is not None:
+            return session["client_id"]
+    client_id = request.args.get("client_id") or request.headers.get("X-Client-ID")
+    if not client_id and request.endpoint == "upload_client_weights":
+        client_id = request.head_fields.get("client_id")
+    return client_id or None
+
+def busy_response(message, retry_after, reason):
+    telemetry.inc("fl_admission_rejected_total", direction=g.transfer, reason=reason)
+    response = jsonify({"success": False, "error": message, "retry_after": retry_after})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+@app.before_request
+def check_content_encoding():
+    content_encoding = (request.content_encoding or "identity").lower()
+    if content_encoding == "identity":
+        return None
+    # chunk offsets and lengths count decoded bytes, compress the whole file instead
+    if content_encoding in ENCODINGS and request.endpoint != "upload_chunk":
+        return None
+
+    response = jsonify({"success": False, "error": f"Unsupported Content-Encoding {content_encoding!r} here",
+                        "encodings": ENCODINGS})
+    response.status_code = 415
+    response.headers["Accept-Encoding"] = ", ".join(ENCODINGS)
+    return response
+
+@app.before_request
+def admit_transfer():
+    transfer = g.get("transfer")
+    if transfer is None:
+        return None
+
+    client_key = transfer_client_key()
+    if request.endpoint == "upload_client_weights":
+        cur_round = request.args.get("cur_round") or request.head_fields.get("cur_round", "")
+        if cur_round.isdigit():
+            # refuse over-quota uploads before a byte is written
+            error = round_quota_error(cur_round, client_key, request.content_length or 0)
+            if error is not None:
+                return error
+
+    try:
+        ticket = gates[transfer].admit(client_key)
+    except Saturated as e:
+        return busy_response(str(e), e.retry_after, "busy")
+    if ticket.waited:
+        telemetry.observe("fl_admission_wait_seconds", ticket.waited, direction=transfer)
+    g.admission_ticket = ticket
+
+def round_quota_error(cur_round, client_id, incoming_bytes):
+    """507 response if `incoming_bytes` more would overflow the round's quota, else None."""
+    if not ROUND_QUOTA_BYTES:
+        return None
+    # a client's re-upload replaces its previous file
+    used = ledger.round_bytes(cur_round, exclude_client=client_id) + \
+        upload_store.reserved_bytes(cur_round, exclude_client=client_id)
+    if used + incoming_bytes <= ROUND_QUOTA_BYTES:
+        return None
+
+    telemetry.inc("fl_admission_rejected_total", direction="upload", reason="quota")
+    return jsonify({
+        "success": False,
+        "error": f"Round {cur_round} upload quota exceeded "
+                 f"({used + incoming_bytes} of {ROUND_QUOTA_BYTES} bytes)",
+    }), 507
+
+@app.after_request
+def advertise_encodings(response):
+    # encodings accepted for uploads and offered to ?compressed=1 downloads, plain stays the default
+    if request.endpoint in UPLOAD_ENDPOINTS | DOWNLOAD_ENDPOINTS | {"get_current_round", "initiate_upload"}:
+        response.headers.setdefault("Accept-Encoding", ", ".join(ENCODINGS))
+    return response
+
+def negotiated_file(path):
+    """
+    (file to send, Content-Encoding or None). Compressed copies are opt-in
+    with ?compressed=1: requests and most HTTP libraries send Accept-Encoding
+    on their own, and clients that save r.raw must keep getting plain bytes.
+    """
+    if request.args.get("compressed") != "1" or "Range" in request.headers:
+        return path, None  # Range: byte ranges of the plain file, so resumed downloads keep working
+    content_encoding = request.accept_encodings.best_match(available_encodings(path))
+    if content_encoding is None:
+        return path, None
+    return encoded_path(path, content_encoding), content_encoding
+
+def on_response_closed(response, callback):
+    """
+    Run `callback` once the body has been sent. send_file responses hand
+    their file wrapper straight to the server (sendfile), bypassing
+    call_on_close, so hook the wrapper's close() instead.
+    """
+    body = response.response
+    if response.direct_passthrough and hasattr(body, "close"):
+        close = body.close
+
+        def close_and_notify():
+            try:
+                close()
+            finally:
+                callback()
+        body.close = close_and_notify
+    else:
+        response.call_on_close(callback)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    latest = read_latest_pointer(GLOBAL_MODEL_DIR)
+    version = latest["round"] if latest else None
+    gauges = [("fl_global_round", {}, version if version is not None else -1)]
+
+    async_config = read_async_config(GLOBAL_MODEL_DIR)
+    if async_config is not None:
+        entries = buffered_entries(ledger, version, async_config["max_staleness"], valid_only=False)
+    else:
+        entries = ledger.round_entries((version or 0) + 1)
+    counts = {STATUS_VALID: 0, STATUS_PENDING: 0, STATUS_INVALID: 0}
+    for entry in entries:
+        status = entry.get("status") or STATUS_VALID  # legacy rows were never checked
+        counts[status] = counts.get(status, 0) + 1
+    gauges += [("fl_round_clients", {"status": status}, count) for status, count in counts.items()]
+
+    return Response(telemetry.render(gauges), mimetype="text/plain; version=0.0.4; charset=utf-8")
 
 @app.route('/api/upload-client-weights', methods=['POST'])
 def upload_client_weights():
@@ -32,54 +369,256 @@ def upload_client_weights():
     if not cur_round:
         return jsonify({"success": False, "error": "cur_round not provided"}), 400
 
+    if not cur_round.isdigit():
+        return jsonify({"success": False, "error": "cur_round must be an integer"}), 400
+
     dataset_size = int(dataset_size) if dataset_size else 0
 
+    part_path = os.path.join(UPLOAD_DIR, f"{client_id}_round{cur_round}.upload")
+    spool_path = getattr(file.stream, "name", None)
+    sha256 = None
+    if isinstance(spool_path, str) and os.path.exists(spool_path):
+        file.stream.close()
+        os.replace(spool_path, part_path)
+        sha256 = file.stream.hexdigest()
+    else:
+        file.save(part_path)
+
+    return finalize_client_upload(part_path, client_id, cur_round, dataset_size, sha256)
+
+@app.teardown_request
+def remove_spooled_files(exc=None):
+    # uploads rejected before they were moved into place, or cut short
+    # by a corrupt encoded body
+    for spool in request.__dict__.get("spool_files", ()):
+        if os.path.exists(spool.name):
+            spool.close()
+            os.remove(spool.name)
+
+@app.errorhandler(EncodingError)
+def encoding_error(e):
+    status = 413 if isinstance(e, DecodedTooLarge) else 400
+    return jsonify({"success": False, "error": str(e)}), status
+
+def finalize_client_upload(part_path, client_id, cur_round, dataset_size, sha256=None):
+    """Move a fully received upload into place, record it and queue validation."""
+    # Uploads may be .pth or flat weight files, keep the matching extension
+    with open(part_path, "rb") as f:
+        head = f.read(len(MAGIC))
+    ext = FLAT_EXT if head == MAGIC else ".pth"
+
+    # Async mode takes updates from any recent version, but not from too far back
+    async_config = read_async_config(GLOBAL_MODEL_DIR)
+    if async_config is not None:
+        latest = read_latest_pointer(GLOBAL_MODEL_DIR)
+        version = latest["round"] if latest else 0
+        staleness = upload_staleness(cur_round, version)
+        if not 0 <= staleness <= async_config["max_staleness"]:
+            os.remove(part_path)
+            return jsonify({
+                "success": False,
+                "error": f"Update for round {cur_round} is outside the accepted window "
+                         f"(latest version {version}, max staleness {async_config['max_staleness']})",
+                "version": version,
+            }), 409
+
+    error = round_quota_error(cur_round, client_id, os.path.getsize(part_path))
+    if error is not None:
+        os.remove(part_path)
+        return error
+
+    # Delta uploads must reference a global model we still have
+    encoding = read_encoding(part_path) if ext == FLAT_EXT else None
+    if encoding and encoding.get("type") in DIFF_TYPES:
+        if base_model_path(GLOBAL_MODEL_DIR, encoding.get("base_round")) is None:
+            os.remove(part_path)
+            return jsonify({
+                "success": False,
+                "error": f"Unknown base round {encoding.get('base_round')} for delta upload"
+            }), 400
+
     # Save weights with round info
-    save_path = os.path.join(UPLOAD_DIR, f"{client_id}_round{cur_round}.pth")
-    file.save(save_path)
+    save_path = client_weights_path(UPLOAD_DIR, client_id, cur_round, ext)
+    upload_bytes = os.path.getsize(part_path)
+    os.replace(part_path, save_path)
+
+    # Drop a previous upload in the other format
+    stale_path = client_weights_path(UPLOAD_DIR, client_id, cur_round, ".pth" if ext == FLAT_EXT else FLAT_EXT)
+    if os.path.exists(stale_path):
+        os.remove(stale_path)
+
+    if sha256 is None:
+        sha256 = file_sha256(save_path)
 
     # Store metadata safely
-    store_client_stats(cur_round, client_id, dataset_size)
+    store_client_stats(cur_round, client_id, dataset_size, encoding, upload_bytes, sha256)
+    round_state.touch()
+
+    # Schema / NaN checks run in the background, valid uploads get folded
+    # into this round's running sum from there
+    validator.submit(cur_round, client_id, dataset_size, save_path, sha256)
 
     print(f"[SERVER] Saved client {client_id} R{cur_round} weights → {save_path}")
 
     return jsonify({
         "success": True,
         "message": "File uploaded successfully",
-        "save_path": save_path
+        "save_path": save_path,
+        "encoding": encoding or "full",
+        "sha256": sha256,
+        "validation": STATUS_PENDING
+    }), 200
+
+# ----------------------------------------------------
+#   Chunked, resumable uploads
+#   POST /api/uploads                   initiate (JSON body)
+#   PUT  /api/uploads/<id>?offset=N     raw chunk, optional X-Chunk-SHA256
+#   GET  /api/uploads/<id>              received / missing byte ranges
+#   POST /api/uploads/<id>/commit       verify, then same path as a normal upload
+# ----------------------------------------------------
+@app.route("/api/uploads", methods=["POST"])
+def initiate_upload():
+    data = request.get_json(silent=True) or {}
+
+    client_id = data.get("client_id")
+    cur_round = data.get("cur_round")
+    total_size = data.get("total_size")
+
+    if not client_id:
+        return jsonify({"success": False, "error": "client_id not provided"}), 400
+
+    if not cur_round:
+        return jsonify({"success": False, "error": "cur_round not provided"}), 400
+
+    try:
+        cur_round = int(cur_round)
+        total_size = int(total_size)
+        dataset_size = int(data.get("dataset_size") or 0)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "cur_round, total_size and dataset_size must be integers"}), 400
+
+    if total_size <= 0:
+        return jsonify({"success": False, "error": "total_size must be positive"}), 400
+
+    # the session preallocates total_size, so the quota is reserved here
+    error = round_quota_error(cur_round, client_id, total_size)
+    if error is not None:
+        return error
+
+    session = upload_store.create(client_id, str(cur_round), dataset_size, total_size, data.get("sha256"))
+    print(f"[SERVER] Started chunked upload {session['upload_id']} for {client_id} R{cur_round} ({total_size} bytes)")
+
+    return jsonify({
+        "success": True,
+        "upload_id": session["upload_id"],
+        "chunk_size": UPLOAD_CHUNK_SIZE
     }), 200
 
+@app.route("/api/uploads/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+    offset = request.args.get("offset", type=int)
+    length = request.content_length
+
+    if offset is None or length is None:
+        return jsonify({"success": False, "error": "offset and Content-Length are required"}), 400
+
+    try:
+        session = upload_store.write_chunk(
+            upload_id, offset, request.stream, length,
+            sha256=request.headers.get("X-Chunk-SHA256")
+        )
+    except KeyError:
+        return jsonify({"success": False, "error": "Unknown upload_id"}), 404
+    except ChunkError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    return jsonify({"success": True, **upload_store.status(session)}), 200
+
+@app.route("/api/uploads/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    session = upload_store.get(upload_id)
+    if session is None:
+        return jsonify({"success": False, "error": "Unknown upload_id"}), 404
+
+    return jsonify({"success": True, **upload_store.status(session)}), 200
+
+@app.route("/api/uploads/<upload_id>/commit", methods=["POST"])
+def commit_upload(upload_id):
+    session = upload_store.get(upload_id)
+    if session is None:
+        return jsonify({"success": False, "error": "Unknown upload_id"}), 404
+
+    try:
+        upload_store.verify(session)
+    except ChunkError as e:
+        return jsonify({"success": False, "error": str(e), **upload_store.status(session)}), 409
+
+    response = finalize_client_upload(
+        upload_store.data_path(upload_id),
+        session["client_id"],
+        session["cur_round"],
+        session["dataset_size"],
+        session.get("sha256"),  # verified above when the client sent one
+    )
+    upload_store.discard(upload_id)
+    return response
+
+def compute_round_state():
+    """Payload of /api/get-current-round, recomputed only when rounds change."""
+    if UPSTREAM_URL and upstream_round is not None:
+        # rounds are decided at the root, relays pass on its last answer
+        return upstream_round
+
+    latest = read_latest_pointer(GLOBAL_MODEL_DIR)
+    version = latest["round"] if latest else None
+
+    async_config = read_async_config(GLOBAL_MODEL_DIR)
+    if async_config is not None:
+        # no barrier: train on the latest version and tag the upload version + 1
+        return {
+            "current_round": (version or 0) + 1,
+            "version": version,
+            "mode": "async",
+            "status": "active",
+            "buffer_size": async_config["buffer_size"],
+            "max_staleness": async_config["max_staleness"],
+            "buffered": len(buffered_entries(ledger, version, async_config["max_staleness"])),
+        }
+
+    rounds = ledger.rounds()
+
+    if not rounds:
+        # No uploads yet means we're at round 0 or 1
+        return {
+            "current_round": 1,
+            "version": version,
+            "mode": "sync",
+            "status": "initialized"
+        }
+
+    # Get the maximum round number and add 1 for the next round
+    return {
+        "current_round": rounds[-1] + 1,
+        "version": version,
+        "mode": "sync",
+        "status": "active",
+        "completed_rounds": rounds
+    }
+
+def state_version(state):
+    return state["version"] if state["version"] is not None else -1
+
 @app.route("/api/get-current-round", methods=["GET"])
 def get_current_round():
-    """Get the current round from client_stats.json"""
+    """
+    Get the current round (cached in memory, see utils/round_events.py).
+    A relay answers with the upstream's round as last fetched in the
+    background, or locally until it reached the upstream once.
+    """
     try:
-        if not os.path.exists(CLIENT_STATS_FILE):
-            # No stats file means we're at round 0 or 1
-            return jsonify({
-                "current_round": 1,
-                "status": "initialized"
-            }), 200
-        
-        with open(CLIENT_STATS_FILE, "r") as f:
-            data = json.load(f)
-        
-        if not data:
-            # Empty stats file
-            return jsonify({
-                "current_round": 1,
-                "status": "initialized"
-            }), 200
-        
-        # Get the maximum round number and add 1 for the next round
-        rounds = [int(r) for r in data.keys()]
-        current_round = max(rounds) + 1 if rounds else 1
-        
-        return jsonify({
-            "current_round": current_round,
-            "status": "active",
-            "completed_rounds": rounds
-        }), 200
-        
+        _, state = round_state.current()
+        return jsonify(state), 200
+
     except Exception as e:
         print(f"[ERROR] Failed to get current round: {str(e)}")
         return jsonify({
@@ -87,68 +626,496 @@ def get_current_round():
             "current_round": 1
         }), 500
 
+# ----------------------------------------------------
+#   Round notifications
+#   GET /api/wait-for-round?after=N&timeout=S   long-poll
+#   GET /api/round-events                       server-sent events
+# ----------------------------------------------------
+@app.route("/api/wait-for-round", methods=["GET"])
+def wait_for_round():
+    """
+    Answers with the get-current-round payload once a global model newer
+    than version `after` is published (right away if there already is
+    one), or with 204 after `timeout` seconds (default 30) so the client
+    asks again. Without `after` it waits for the next version.
+    """
+    timeout = min(max(request.args.get("timeout", LONG_POLL_TIMEOUT, type=float), 0), LONG_POLL_MAX)
+    try:
+        _, state = round_state.current()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    after = request.args.get("after", type=int)
+    if after is None:
+        after = state_version(state)
+    if state_version(state) > after:
+        return jsonify(state), 200
+
+    if not round_waiters.acquire(blocking=False):
+        return Response(status=204, headers={"Retry-After": str(WAITERS_RETRY_AFTER)})
+
+    telemetry.inc("fl_round_waiters", kind="long_poll")
+    try:
+        update = round_state.wait_for(lambda seq, state: state_version(state) > after, timeout)
+    finally:
+        telemetry.inc("fl_round_waiters", -1, kind="long_poll")
+        round_waiters.release()
+
+    if update is None:
+        return Response(status=204)
+    return jsonify(update[1]), 200
+
+@app.route("/api/round-events", methods=["GET"])
+def round_events():
+    """
+    text/event-stream with one "round" event (the get-current-round
+    payload) on connect and after every change: new versions, uploads
+    and validation verdicts.
+    """
+    if not round_waiters.acquire(blocking=False):
+        return jsonify({"error": "Too many listeners, use /api/wait-for-round"}), 503, {
+            "Retry-After": str(WAITERS_RETRY_AFTER)}
+    telemetry.inc("fl_round_waiters", kind="sse")
+
+    def events():
+        seq, state = round_state.current()
+        yield f"retry: {WAITERS_RETRY_AFTER * 1000}\n\n"
+        while True:
+            yield f"event: round\ndata: {json.dumps(state)}\n\n"
+            update = None
+            while update is None:
+                update = round_state.wait_for(lambda new_seq, _: new_seq > seq, SSE_KEEPALIVE)
+                if update is None:
+                    yield ": keepalive\n\n"  # also how a gone client is noticed
+            seq, state = update
+
+    def disconnected():
+        telemetry.inc("fl_round_waiters", -1, kind="sse")
+        round_waiters.release()
+
+    response = Response(events(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # nginx: do not buffer the stream
+    # runs when the server closes the iterator, also if the client left early
+    response.call_on_close(disconnected)
+    return response
+
 @app.route("/api/get-global-model", methods=["GET"])
 def get_global_model():
+    """
+    ?round=N serves a historical checkpoint, otherwise the latest one.
+    ?format=flat serves the memory-mappable copy, default stays .pth.
+    Responses carry a strong ETag (sha256 of the bytes sent) and
+    X-Model-Round / X-Model-Version (the same number: in async mode,
+    clients tag their upload with version + 1), answer If-None-Match with
+    304 and support Range requests. With ?compressed=1 clients get the
+    precompressed copy (zstd or gzip) their Accept-Encoding allows, when
+    the model compressed well enough to keep one.
+    """
     client_ip = request.remote_addr
     print(f"[REQUEST] {client_ip} is requesting the global model...")
 
-    if not os.path.exists(GLOBAL_MODEL_PATH):
+    ext = FLAT_EXT if request.args.get("format") == "flat" else ".pth"
+    round_num = request.args.get("round", type=int)
+    pinned = round_num is not None
+
+    if round_num is None:
+        latest = read_latest_pointer(GLOBAL_MODEL_DIR)
+        round_num = latest["round"] if latest else None
+
+    if round_num is not None:
+        # older retained rounds are rebuilt from the checkpoint store on demand
+        model_path = (materialize_round(GLOBAL_MODEL_DIR, round_num, ext)
+                      or global_round_path(GLOBAL_MODEL_DIR, round_num, ext))
+    else:
+        # checkpoints published before the latest pointer existed
+        model_path = GLOBAL_FLAT_MODEL_PATH if ext == FLAT_EXT else GLOBAL_MODEL_PATH
+
+    if not os.path.exists(model_path):
         print("[ERROR] Global model file not found!")
+        if pinned:
+            return jsonify({"error": f"No global model stored for round {round_num}."}), 404
         return jsonify({"error": "No global model found on server. Please initialize the server first."}), 404
 
+    send_path, content_encoding = negotiated_file(model_path)
+
     # Print stats
-    size_mb = round(os.path.getsize(GLOBAL_MODEL_PATH) / (1024 * 1024), 2)
-    print(f"Sending model ({size_mb} MB) to {client_ip}")
+    size_mb = round(os.path.getsize(send_path) / (1024 * 1024), 2)
+    print(f"Sending model ({size_mb} MB, {content_encoding or 'identity'}) to {client_ip}")
 
     # Start time
     start = time.time()
 
-    # send_file auto-streams the file efficiently
-    def generate():
-        with open(GLOBAL_MODEL_PATH, "rb") as f:
-            while True:
-                chunk = f.read(1024 * 1024)  # 1 MB chunks
-                if not chunk:
-                    break
-                yield chunk
-
     # When response completes (client finished download)
     def log_after(response):
         end = time.time()
-        print(f"[COMPLETE] Finished sending model to {client_ip} in {end - start:.2f} sec")
+        print(f"[COMPLETE] Finished sending model to {client_ip} in {end - start:.2f} sec "
+              f"({response.status_code})")
         return response
 
-    response = Response(generate(), mimetype="application/octet-stream")
-    response.direct_passthrough = True
-    response.call_on_close(lambda: log_after(response))
+    # send_file hands the open file to wsgi.file_wrapper (sendfile(2) under
+    # gunicorn) or to the front proxy when USE_X_SENDFILE is set
+    response = send_file(
+        os.path.abspath(send_path),  # relative paths would resolve against the app root
+        mimetype="application/octet-stream",
+        as_attachment=True,
+        download_name=os.path.basename(model_path),
+        conditional=True,
+        etag=read_checksum(send_path),
+        # a round's checkpoint never changes once published, latest must revalidate
+        max_age=31536000 if pinned else None,
+    )
+    if pinned:
+        response.cache_control.immutable = True
+    if content_encoding:
+        response.headers["Content-Encoding"] = content_encoding
+    response.vary.add("Accept-Encoding")
+
+    if round_num is not None:
+        response.headers["X-Model-Round"] = str(round_num)
+        response.headers["X-Model-Version"] = str(round_num)
+    on_response_closed(response, lambda: log_after(response))
     return response
 
-def store_client_stats(cur_round, client_id, dataset_size):
-    if os.path.exists(CLIENT_STATS_FILE):
-        with open(CLIENT_STATS_FILE, "r") as f:
-            stats = json.load(f)
-    else:
-        stats = {}
+@app.route("/api/get-global-model-diff", methods=["GET"])
+def get_global_model_diff():
+    """
+    Lossless diff that turns global round `from` into round `to` (default:
+    latest). Decode with delta_codec.load_update against the client's copy
+    of round `from`. Each (from, to) pair is computed once and cached.
+    ?compressed=1 works as for get-global-model.
+    """
+    from_round = request.args.get("from", type=int)
+    to_round = request.args.get("to", type=int)
+
+    if from_round is None:
+        return jsonify({"error": "from round not provided"}), 400
+
+    if to_round is None:
+        latest = read_latest_pointer(GLOBAL_MODEL_DIR)
+        if latest is None:
+            return jsonify({"error": "No global model found on server. Please initialize the server first."}), 404
+        to_round = latest["round"]
+
+    from_path = base_model_path(GLOBAL_MODEL_DIR, from_round)
+    to_path = base_model_path(GLOBAL_MODEL_DIR, to_round)
+
+    if to_path is None:
+        return jsonify({"error": f"No global model stored for round {to_round}."}), 404
+
+    if from_path is None:
+        # client has to fall back to the full model
+        return jsonify({
+            "error": f"No global model stored for round {from_round}, download the full model instead.",
+            "fallback": f"/api/get-global-model?round={to_round}"
+        }), 404
+
+    diff_path = os.path.join(DIFF_CACHE_DIR, f"diff_{from_round}_to_{to_round}{FLAT_EXT}")
+
+    # one lock per (from, to) pair, across workers, so a diff is built once
+    with file_lock(diff_path + ".lock"):
+        if not os.path.exists(diff_path):
+            start = time.time()
+            save_xor_diff(load_weights(to_path), load_weights(from_path), from_round, diff_path)
+            # unchanged high bits make XOR diffs compress well; written in the background
+            threading.Thread(target=precompress, args=(diff_path,), daemon=True).start()
+            print(f"[SERVER] Built diff R{from_round} → R{to_round} "
+                  f"({os.path.getsize(diff_path) / (1024 * 1024):.2f} MB) in {time.time() - start:.2f} sec")
+
+    send_path, content_encoding = negotiated_file(diff_path)
+    response = send_file(
+        os.path.abspath(send_path),
+        mimetype="application/octet-stream",
+        as_attachment=True,
+        download_name=os.path.basename(diff_path),
+        conditional=True,
+        etag=read_checksum(send_path),
+        max_age=31536000,
+    )
+    response.cache_control.immutable = True
+    if content_encoding:
+        response.headers["Content-Encoding"] = content_encoding
+    response.vary.add("Accept-Encoding")
+    response.headers["X-Model-Round"] = str(to_round)
+    response.headers["X-Model-Version"] = str(to_round)
+    response.headers["X-Base-Round"] = str(from_round)
+    return response
 
-    cur_round = str(cur_round)
+@app.route("/api/upload-status", methods=["GET"])
+def get_upload_status():
+    """Validation verdict for a client's upload: pending, valid or invalid."""
+    client_id = request.args.get("client_id")
+    cur_round = request.args.get("cur_round", type=int)
 
-    if cur_round not in stats:
-        stats[cur_round] = []
+    if not client_id or cur_round is None:
+        return jsonify({"error": "client_id and cur_round are required"}), 400
+
+    entry = ledger.get_entry(cur_round, client_id)
+    if entry is None:
+        return jsonify({"error": f"No upload from {client_id} for round {cur_round}"}), 404
+
+    return jsonify({
+        "client_id": client_id,
+        "cur_round": cur_round,
+        "sha256": entry["sha256"],
+        "status": entry["status"],
+        "reason": entry["reason"]
+    }), 200
+
+def fold_client_update(cur_round, client_id, dataset_size, state_dict):
+    global running_sum
+
+    cur_round = int(cur_round)
+    path = running_sum_path(UPLOAD_DIR, cur_round)
+
+    # the file lock serializes folds across worker processes as well
+    with running_sum_lock, file_lock(path + ".lock"):
+        # another worker may have folded uploads since our last fold
+        on_disk = StreamingFedAvg.saved_clients(path)
+        if running_sum is None or running_sum.cur_round != cur_round or running_sum.clients != on_disk:
+            running_sum = None  # release the stale buffer first
+            if on_disk:
+                running_sum = StreamingFedAvg.load(path)
+            else:
+                running_sum = StreamingFedAvg(cur_round)
+
+        if client_id in running_sum.clients:
+            # Re-upload: the old contribution is gone, aggregate will re-read files
+            print(f"[WARNING] Dropping running sum for round {cur_round} after re-upload")
+            running_sum = None
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        try:
+            running_sum.add(state_dict, dataset_size, client_id)
+        except Exception:
+            # A half-applied update would poison the buffer, so discard it
+            running_sum = None
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        running_sum.save(path)
+
+# ----------------------------------------------------
+#   Relay (sub-aggregator) role
+#   POST /api/relay/forward   send this region's partial sum upstream
+# ----------------------------------------------------
+def sync_from_upstream(force=False):
+    """
+    Mirror the upstream's latest global model (at most every few seconds).
+    Runs on the round watcher thread only, never inside a client request.
+    """
+    global last_upstream_sync
+
+    if not force and time.time() - last_upstream_sync < UPSTREAM_SYNC_INTERVAL:
+        return
+    last_upstream_sync = time.time()
+
+    with file_lock(UPSTREAM_STATE + ".lock"):
+        try:
+            with open(UPSTREAM_STATE, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+
+        headers = {"If-None-Match": state["etag"]} if state.get("etag") else {}
+        tmp_path = tmp_path_for(os.path.join(GLOBAL_MODEL_DIR, "upstream" + FLAT_EXT))
+        try:
+            with requests.get(UPSTREAM_URL + "/api/get-global-model", params={"format": "flat", "client_id": RELAY_ID},
+                              headers=headers, stream=True, timeout=900) as r:
+                if r.status_code != 200:
+                    return
+                with open(tmp_path, "wb") as f:
+                    for block in r.iter_content(UPLOAD_CHUNK_SIZE):
+                        f.write(block)
+                round_num = int(r.headers["X-Model-Round"])
+                etag = r.headers.get("ETag")
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"[RELAY] Could not sync the global model from upstream: {e}")
+            return
+
+        try:
+            # same publish path as the root: round files, checksums, manifest, latest pointer
+            FederatedServer(model_fn=None, cur_round=None, test_loader=None).publish_global_model(
+                round_num, load_weights(tmp_path)
+            )
+        finally:
+            os.remove(tmp_path)
+
+        tmp_state = tmp_path_for(UPSTREAM_STATE)
+        with open(tmp_state, "w") as f:
+            json.dump({"round": round_num, "etag": etag}, f)
+        os.replace(tmp_state, UPSTREAM_STATE)
+        print(f"[RELAY] Synced global model round {round_num} from {UPSTREAM_URL}")
+    round_state.touch()
+
+def refresh_upstream_round():
+    """Fetch the upstream's current round (at most every few seconds)."""
+    global last_upstream_round_check, upstream_round
+
+    if time.time() - last_upstream_round_check < UPSTREAM_SYNC_INTERVAL:
+        return
+    last_upstream_round_check = time.time()
+
+    try:
+        response = requests.get(UPSTREAM_URL + "/api/get-current-round", timeout=UPSTREAM_ROUND_TIMEOUT)
+        response.raise_for_status()
+        state = response.json()
+    except (requests.RequestException, ValueError) as e:
+        print(f"[RELAY] Upstream round lookup failed ({e}), keeping the last answer")
+        return
+
+    if state != upstream_round:
+        upstream_round = state
+        round_state.touch()
+
+def poll_upstream():
+    """Round watcher tick of a relay: new global models and rounds from upstream."""
+    sync_from_upstream()
+    refresh_upstream_round()
+    # catches a quorum reached by uploads validated at the same time
+    rounds = ledger.rounds() if RELAY_QUORUM else []
+    if rounds:
+        check_relay_quorum(rounds[-1])
+
+def forwarded_marker(cur_round):
+    # on disk, so every worker (and a restarted one) sees it
+    return os.path.join(UPLOAD_DIR, f"round{cur_round}_partial.forwarded")
+
+def claim_auto_forward(cur_round):
+    """True for exactly one worker per round (exclusive create of the marker)."""
+    try:
+        os.close(os.open(forwarded_marker(cur_round), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+    except FileExistsError:
+        return False
+    return True
+
+def check_relay_quorum(cur_round, also_valid=None):
+    """Forward `cur_round` upstream (from one worker, once) after RELAY_QUORUM valid uploads."""
+    if not RELAY_QUORUM or os.path.exists(forwarded_marker(cur_round)):
+        return
+    entries = ledger.round_entries(cur_round)
+    valid = sum(e["status"] == STATUS_VALID or e["client_id"] == also_valid for e in entries)
+    if valid >= RELAY_QUORUM and claim_auto_forward(cur_round):
+        threading.Thread(target=auto_forward, args=(cur_round,), daemon=True).start()
+
+def wait_round_validated(cur_round, timeout=RELAY_VALIDATION_WAIT):
+    """
+    True once no upload of `cur_round` is pending. Checks the shared ledger,
+    so uploads other workers are still validating count too.
+    """
+    deadline = time.time() + timeout
+    while any(e["status"] == STATUS_PENDING for e in ledger.round_entries(cur_round)):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.2)
+    return True
+
+def auto_forward(cur_round):
+    # the upload that reached the quorum is only marked valid after on_valid
+    if not wait_round_validated(cur_round):
+        print(f"[RELAY] R{cur_round} uploads still pending, auto-forward postponed")
+        os.remove(forwarded_marker(cur_round))  # the next check tries again
+        return
+    try:
+        response = forward_partial(cur_round)
+    except requests.RequestException as e:
+        print(f"[RELAY] Auto-forward of R{cur_round} failed: {e}")
+        response = None
+    if response is None or not response.ok:
+        os.remove(forwarded_marker(cur_round))  # the next valid upload tries again
+
+def forward_partial(cur_round):
+    """Upload this region's weighted sum for `cur_round` as one update."""
+    acc = FederatedServer(model_fn=None, cur_round=cur_round, test_loader=None).partial_sum()
+    if acc is None:
+        return None
+
+    path = os.path.join(UPLOAD_DIR, f"round{cur_round}_partial{FLAT_EXT}")
+    with file_lock(path + ".lock"):
+        acc.save(path)
+        with open(path, "rb") as f:
+            response = requests.post(
+                UPSTREAM_URL + "/api/upload-client-weights",
+                params={"client_id": RELAY_ID, "cur_round": str(cur_round)},  # for the upstream's admission
+                files={"file": (os.path.basename(path), f)},
+                data={"client_id": RELAY_ID, "dataset_size": str(acc.total_size), "cur_round": str(cur_round)},
+                timeout=900,
+            )
+
+    if response.ok:  # a refused forward must not stop later retries
+        open(forwarded_marker(cur_round), "a").close()
+    print(f"[RELAY] Forwarded R{cur_round} partial sum of {len(acc.clients)} clients "
+          f"(dataset_size {acc.total_size}) → {UPSTREAM_URL} ({response.status_code})")
+    return response
+
+@app.route("/api/relay/forward", methods=["POST"])
+def relay_forward():
+    if not UPSTREAM_URL:
+        return jsonify({"success": False, "error": "Not a relay (FL_UPSTREAM_URL is not set)"}), 400
+
+    cur_round = request.values.get("cur_round", type=int)
+    if cur_round is None:
+        return jsonify({"success": False, "error": "cur_round not provided"}), 400
+
+    # include uploads that are still being checked, in any worker
+    if not wait_round_validated(cur_round):
+        return jsonify({"success": False, "error": f"Uploads for round {cur_round} are still being validated"}), 503, {
+            "Retry-After": str(WAITERS_RETRY_AFTER)}
+    try:
+        response = forward_partial(cur_round)
+    except requests.RequestException as e:
+        return jsonify({"success": False, "error": f"Upstream unreachable: {e}"}), 502
+
+    if response is None:
+        return jsonify({"success": False, "error": f"No validated uploads for round {cur_round}"}), 404
+
+    try:
+        upstream = response.json()
+    except ValueError:
+        upstream = {"status_code": response.status_code}
+    return jsonify({"success": response.ok, "relay_id": RELAY_ID, "upstream": upstream}), response.status_code
+
+def on_valid_upload(cur_round, client_id, dataset_size, state_dict):
+    # async versions apply each update against its own base, no running sum
+    if read_async_config(GLOBAL_MODEL_DIR) is None:
+        fold_client_update(cur_round, client_id, dataset_size, state_dict)
+    round_state.touch()
+
+    if UPSTREAM_URL:
+        # the verdict is stored after this callback, count this upload as valid already
+        check_relay_quorum(int(cur_round), also_valid=client_id)
+
+def store_client_stats(cur_round, client_id, dataset_size, encoding=None, upload_bytes=None, sha256=None):
+    replaced = ledger.record_upload(
+        cur_round, client_id, dataset_size, encoding, upload_bytes,
+        sha256=sha256, status=STATUS_PENDING
+    )
 
     # Check if this client already uploaded for this round
-    existing = [c for c in stats[cur_round] if c["client_id"] == client_id]
-    if existing:
+    if replaced:
         print(f"[WARNING] Client {client_id} already uploaded for round {cur_round}. Updating...")
-        stats[cur_round] = [c for c in stats[cur_round] if c["client_id"] != client_id]
 
-    stats[cur_round].append({
-        "client_id": client_id,
-        "dataset_size": dataset_size,
-        "timestamp": str(datetime.now())
-    })
+# Round state pushed to long-poll / SSE clients. A relay also checks the
+# upstream for new global models and rounds while its clients wait.
+round_state = RoundState(
+    compute_round_state,
+    round_files(GLOBAL_MODEL_DIR, ledger.db_path),
+    on_tick=poll_upstream if UPSTREAM_URL else None,
+)
+if UPSTREAM_URL:
+    # start the watcher now: it alone mirrors the upstream model, requests
+    # only read what is on disk and never wait for an upstream download
+    round_state.current()
 
-    with open(CLIENT_STATS_FILE, "w") as f:
-        json.dump(stats, f, indent=4)
+# Background checks for finished uploads (see utils/upload_validation.py)
+validator = UploadValidator(ledger, GLOBAL_MODEL_DIR, on_valid=on_valid_upload, workers=VALIDATION_WORKERS)
+# uploads acknowledged before a worker died are still pending, check them again
+resumed = validator.resume_pending(UPLOAD_DIR)
+if resumed:
+    print(f"[VALIDATION] Re-queued {resumed} pending upload(s)")
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0',port=8000)
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""
+Admission control for uploads and downloads, shared by all server workers.
+
+A transfer runs while it holds an flock(2) on one of `limit` slot files,
+so the cap covers every gunicorn worker and the kernel frees the slots of
+a crashed one.
+
+Identified clients also hold one of `per_client` client slots. Their
+further requests wait for that slot before joining the queue, so a site
+firing many transfers at once takes one place in line, not all of them.
+Anonymous requests (client_key None: no client id, shared NAT or proxy
+addresses) only count toward the global cap.
+
+When every slot is busy, requests wait in a FIFO queue (one ticket file
+per waiting request). The whole wait is bounded by `max_wait` seconds;
+past `queue_limit` waiters, or once the wait runs out, requests are
+turned away with a Retry-After hint that grows with the queue.
+"""
+import os
+import time
+import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process slots, admission is disabled
+    fcntl = None
+
+QUEUE_POLL = 0.05  # seconds between queue checks of a waiting request
+
+
+class Saturated(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _try_flock(path):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Ticket:
+    """Slots held by one admitted transfer; `release` is idempotent."""
+
+    def __init__(self, fds=(), waited=0.0):
+        self.fds = list(fds)
+        self.waited = waited
+        self.lock = threading.Lock()
+
+    def release(self):
+        with self.lock:
+            fds, self.fds = self.fds, []
+        for fd in fds:
+            os.close(fd)  # drops the flock
+
+
+class TransferGate:
+    """Admission for one kind of transfer ("upload" or "download"). limit=0 admits everything."""
+
+    def __init__(self, state_dir, kind, limit, per_client=1, queue_limit=32, max_wait=15.0, retry_after=2):
+        self.state_dir = state_dir
+        self.kind = kind
+        self.limit = int(limit)
+        self.per_client = max(1, int(per_client))
+        self.queue_limit = int(queue_limit)
+        self.max_wait = float(max_wait)
+        self.retry_after = int(retry_after)
+        self.queue_dir = os.path.join(state_dir, f"{kind}.queue")
+        os.makedirs(self.queue_dir, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.limit > 0 and fcntl is not None
+
+    def admit(self, client_key):
+        """Ticket for a transfer of `client_key` (None: anonymous), or raises Saturated."""
+        if not self.enabled:
+            return Ticket()
+
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        client = "anonymous"
+        fds = []
+        if client_key is not None:
+            client = hashlib.sha1(client_key.encode()).hexdigest()[:16]
+            fds.append(self._client_slot(client_key, client, deadline))
+        try:
+            fds.insert(0, self._queued(client, deadline))
+        except BaseException:
+            for fd in fds:
+                os.close(fd)
+            raise
+        return Ticket(fds, waited=time.monotonic() - start)
+
+    def retry_hint(self, waiting):
+        return self.retry_after * (1 + waiting // self.limit)
+
+    def _slot(self, prefix, count):
+        for i in range(count):
+            fd = _try_flock(os.path.join(self.state_dir, f"{prefix}.{i}.slot"))
+            if fd is not None:
+                return fd
+        return None
+
+    def _client_slot(self, client_key, client, deadline):
+        while True:
+            fd = self._slot(f"{self.kind}-client-{client}", self.per_client)
+            if fd is not None:
+                return fd
+            if time.monotonic() >= deadline:
+                raise Saturated(f"{client_key} already has {self.per_client} {self.kind}(s) in progress",
+                                self.retry_after)
+            time.sleep(QUEUE_POLL)
+
+    def _waiting(self):
+        """Queue tickets, oldest first; tickets of dead processes are dropped."""
+        waiting = []
+        for name in sorted(os.listdir(self.queue_dir)):
+            pid = int(name.split("-")[1])
+            if pid != os.getpid() and not _pid_alive(pid):
+                try:
+                    os.remove(os.path.join(self.queue_dir, name))
+                except FileNotFoundError:
+                    pass
+                continue
+            waiting.append(name)
+        return waiting
+
+    def _queued(self, client, deadline):
+        waiting = self._waiting()
+        if not waiting:
+            # nobody is queued, so taking a free slot skips no one
+            fd = self._slot(self.kind, self.limit)
+            if fd is not None:
+                return fd
+        if len(waiting) >= self.queue_limit:
+            raise Saturated(f"All {self.limit} {self.kind} slots are busy and the queue is full",
+                            self.retry_hint(len(waiting)))
+
+        name = f"{time.time_ns():020d}-{os.getpid()}-{threading.get_ident()}-{client}"
+        ticket = os.path.join(self.queue_dir, name)
+        open(ticket, "w").close()
+        try:
+            while True:
+                waiting = self._waiting()
+                if waiting and waiting[0] == name:
+                    fd = self._slot(self.kind, self.limit)
+                    if fd is not None:
+                        return fd
+                if time.monotonic() >= deadline:
+                    raise Saturated(f"All {self.limit} {self.kind} slots are busy",
+                                    self.retry_hint(len(waiting)))
+                time.sleep(QUEUE_POLL)
+        finally:
+            os.remove(ticket)
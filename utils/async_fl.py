@@ -0,0 +1,164 @@
+"""
+Asynchronous buffered FL (FedBuff-style).
+
+Clients keep training on whatever global version they downloaded last and
+tag their upload with that version + 1, the same cur_round they send in
+synchronous mode. Instead of waiting for one round's clients, the server
+buffers valid uploads trained on any of the last `max_staleness` versions
+and publishes version v + 1 as soon as `buffer_size` of them are in:
+
+    x[v+1] = x[v] + server_lr * sum_i w_i * (x_i - x[b_i]) / sum_i w_i
+    w_i    = dataset_size_i * (1 + v - b_i) ** -staleness_exponent
+
+b_i is the version client i started from, so an update is applied as the
+change it made to that version and stale updates count for less. Every
+upload is applied once (applied_version in the round ledger).
+
+The aggregation daemon owns the mode: it writes global_models/async.json
+while it runs asynchronously, and the backend reads it to accept stale
+uploads and report versions.
+"""
+import os
+import json
+import time
+
+from utils.flat_utils import get_layout
+from utils.locks import tmp_path_for
+from utils.weight_format import load_weights
+from utils.delta_codec import base_model_path, load_update
+from utils.round_ledger import STATUS_VALID
+
+ASYNC_CONFIG = "async.json"
+BUFFER_SIZE = 10          # updates per published version
+MAX_STALENESS = 10        # oldest base version still accepted, relative to the latest
+STALENESS_EXPONENT = 0.5  # w = (1 + staleness) ** -exponent
+
+
+# --- Mode file shared by the daemon and the backend ---
+def write_async_config(global_model_dir, buffer_size=BUFFER_SIZE, max_staleness=MAX_STALENESS,
+                       server_lr=1.0, staleness_exponent=STALENESS_EXPONENT):
+    config = {
+        "buffer_size": int(buffer_size),
+        "max_staleness": int(max_staleness),
+        "server_lr": float(server_lr),
+        "staleness_exponent": float(staleness_exponent),
+        "since": time.time(),
+    }
+    path = os.path.join(global_model_dir, ASYNC_CONFIG)
+    tmp_path = tmp_path_for(path)
+    with open(tmp_path, "w") as f:
+        json.dump(config, f)
+    os.replace(tmp_path, path)
+    return config
+
+
+def read_async_config(global_model_dir):
+    """The running async configuration, or None in synchronous mode."""
+    try:
+        with open(os.path.join(global_model_dir, ASYNC_CONFIG), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def clear_async_config(global_model_dir):
+    try:
+        os.remove(os.path.join(global_model_dir, ASYNC_CONFIG))
+    except FileNotFoundError:
+        pass
+
+
+# --- Staleness ---
+def upload_staleness(cur_round, version):
+    """Versions published since the upload's base (cur_round - 1) was."""
+    return (version or 0) - (int(cur_round) - 1)
+
+
+def staleness_weight(staleness, exponent=STALENESS_EXPONENT):
+    return (1 + staleness) ** -exponent
+
+
+def buffered_entries(ledger, version, max_staleness, valid_only=True):
+    """Not yet applied uploads trained on one of the accepted versions, oldest first."""
+    version = version or 0
+    entries = ledger.unapplied_entries(version + 1 - max_staleness, version + 1)
+    if valid_only:
+        entries = [e for e in entries if e.get("status") in (None, STATUS_VALID)]
+    return entries
+
+
+# --- Staleness-weighted delta buffer ---
+class StalenessWeightedDelta:
+    """
+    sum_i w_i * (x_i - x[b_i]) in one float32 buffer, updates folded in one
+    at a time like StreamingFedAvg. `apply` adds the weighted mean delta
+    to the current global model.
+    """
+
+    def __init__(self, version=None):
+        self.version = version
+        self.layout = None
+        self.flat_sum = None
+        self.total_weight = 0.0
+        self.uploads = {}  # (round, client_id) -> (staleness, weight)
+
+    def add(self, update, base, weight, upload=None, staleness=None):
+        if self.layout is None:
+            self.layout = get_layout(base)
+            self.flat_sum = self.layout.new_buffer()
+        if not self.layout.matches(update) or not self.layout.matches(base):
+            raise ValueError("Update does not match the global model layout")
+
+        self.layout.add_(self.flat_sum, update, alpha=weight)
+        self.layout.add_(self.flat_sum, base, alpha=-weight)
+
+        self.total_weight += weight
+        if upload is not None:
+            self.uploads[upload] = (staleness, weight)
+
+    def apply(self, current, server_lr=1.0):
+        if self.flat_sum is None:
+            raise ValueError("No client updates have been added")
+        if self.total_weight <= 0:
+            raise ValueError("Total update weight is zero, cannot average")
+
+        flat = self.layout.flatten(current)
+        flat.add_(self.flat_sum, alpha=server_lr / self.total_weight)
+        return self.layout.unflatten(flat)
+
+
+def fedbuff_update(entries, version, upload_path, global_model_dir, config):
+    """
+    New global state for version + 1 from buffered ledger `entries`
+    (each with its "round"). `upload_path(entry)` gives the upload's file. Returns (state_dict, StalenessWeightedDelta) for reporting.
+    """
+    exponent = config.get("staleness_exponent", STALENESS_EXPONENT)
+    acc = StalenessWeightedDelta(version + 1)
+    bases = {}
+
+    for entry in entries:
+        path = upload_path(entry)
+        if path is None:
+            print(f"[Async] Skipping {entry['client_id']}: upload file is gone")
+            continue
+
+        base_round = entry["round"] - 1
+        if base_round not in bases:
+            base_path = base_model_path(global_model_dir, base_round)
+            if base_path is None:
+                print(f"[Async] Skipping {entry['client_id']}: base version {base_round} was pruned")
+                continue
+            bases[base_round] = load_weights(base_path)
+
+        staleness = upload_staleness(entry["round"], version)
+        weight = int(entry["dataset_size"]) * staleness_weight(staleness, exponent)
+        acc.add(load_update(path, global_model_dir), bases[base_round], weight,
+                upload=(entry["round"], entry["client_id"]), staleness=staleness)
+
+    if not acc.uploads:
+        return None, acc
+
+    current = bases.get(version)
+    if current is None:
+        current = load_weights(base_model_path(global_model_dir, version))
+    return acc.apply(current, config.get("server_lr", 1.0)), acc
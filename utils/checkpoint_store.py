@@ -0,0 +1,306 @@
+"""
+Content-addressed store for global model checkpoints.
+
+    global_models/store/blobs/ab/abcdef...   raw tensor bytes, named by sha256
+    global_models/store/rounds/round_N.json  key -> blob / dtype / shape
+    global_models/store/rounds/index.json    sorted list of stored rounds
+
+A tensor that did not change between rounds (frozen layers, buffers) is
+written once and shared by every round manifest that references it.
+Blobs and manifests are written to a temp name and renamed, and a round
+only becomes visible once its manifest exists, so readers never see a
+partial checkpoint.
+
+Full .pth / .flat files are kept for the newest rounds only; older rounds
+that are still retained are rebuilt from their blobs on demand
+(`materialize_round`). `gc` applies the retention policy and deletes blobs
+no remaining round refers to.
+
+The policy lives in global_models/retention.json, written by the
+aggregation daemon's --keep-* flags and read at every gc, so the daemon,
+the backend and the dashboard all prune the same way. Without the file
+every round is kept in full.
+"""
+import os
+import json
+import mmap
+import hashlib
+from datetime import datetime
+
+import torch
+
+from utils.locks import file_lock, tmp_path_for
+from utils.weight_format import _DTYPES, FLAT_EXT, _dtype_name, save_weights
+from utils.checkpoint_utils import global_round_path, write_checksum
+from utils.transport import remove_sidecars
+
+STORE_DIR = "store"
+RETENTION_CONFIG = "retention.json"
+# keep_last: newest rounds always retained (0 = all)
+# keep_every: plus every Nth round as a milestone (0 = none)
+# keep_materialized: newest rounds that keep full .pth / .flat files (0 = all)
+KEEP_ALL = {"keep_last": 0, "keep_every": 0, "keep_materialized": 0}
+
+
+# --- Policy file shared by every process ---
+def write_retention(global_model_dir, keep_last=0, keep_every=0, keep_materialized=0):
+    policy = {"keep_last": int(keep_last), "keep_every": int(keep_every),
+              "keep_materialized": int(keep_materialized)}
+    path = os.path.join(global_model_dir, RETENTION_CONFIG)
+    tmp_path = tmp_path_for(path)
+    with open(tmp_path, "w") as f:
+        json.dump(policy, f)
+    os.replace(tmp_path, path)
+    return policy
+
+
+def read_retention(global_model_dir):
+    """The configured retention policy, KEEP_ALL if there is none."""
+    try:
+        with open(os.path.join(global_model_dir, RETENTION_CONFIG), "r") as f:
+            return dict(KEEP_ALL, **json.load(f))
+    except (OSError, ValueError):
+        return dict(KEEP_ALL)
+
+
+class CheckpointStore:
+
+    def __init__(self, global_model_dir, keep_last=None, keep_every=None, keep_materialized=None):
+        # None: take the value from retention.json at gc time
+        self.global_model_dir = global_model_dir
+        self.root = os.path.join(global_model_dir, STORE_DIR)
+        self.blob_dir = os.path.join(self.root, "blobs")
+        self.round_dir = os.path.join(self.root, "rounds")
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.keep_materialized = keep_materialized
+
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.round_dir, exist_ok=True)
+
+    # --- paths ---
+    def _lock_path(self):
+        return os.path.join(self.root, "store.lock")
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def manifest_path(self, round_num):
+        return os.path.join(self.round_dir, f"round_{round_num}.json")
+
+    def _index_path(self):
+        return os.path.join(self.round_dir, "index.json")
+
+    # --- round index (numeric, sorted) ---
+    def rounds(self):
+        try:
+            with open(self._index_path(), "r") as f:
+                return json.load(f)["rounds"]
+        except (OSError, ValueError, KeyError):
+            return self._scan_rounds()
+
+    def _scan_rounds(self):
+        rounds = []
+        for name in os.listdir(self.round_dir):
+            if name.startswith("round_") and name.endswith(".json"):
+                number = name[len("round_"):-len(".json")]
+                if number.isdigit():
+                    rounds.append(int(number))
+        return sorted(rounds)
+
+    def _write_index(self, rounds):
+        _write_json(self._index_path(), {"rounds": sorted(set(rounds))})
+
+    def latest_round(self):
+        rounds = self.rounds()
+        return rounds[-1] if rounds else None
+
+    def has_round(self, round_num):
+        return os.path.exists(self.manifest_path(round_num))
+
+    # --- writing ---
+    def _put_tensor(self, tensor):
+        data = tensor.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8).numpy()
+        digest = hashlib.sha256(memoryview(data)).hexdigest()
+        path = self.blob_path(digest)
+
+        if os.path.exists(path):
+            return digest, 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = tmp_path_for(path)
+        with open(tmp_path, "wb") as f:
+            f.write(memoryview(data))
+        os.replace(tmp_path, path)
+        return digest, data.nbytes
+
+    def commit_round(self, round_num, state_dict):
+        """Store `state_dict` as round `round_num`. Returns (bytes written, total bytes)."""
+        with file_lock(self._lock_path()):
+            entries = []
+            new_bytes = total_bytes = 0
+            for key, tensor in state_dict.items():
+                digest, written = self._put_tensor(tensor)
+                entries.append({
+                    "key": key,
+                    "dtype": _dtype_name(tensor.dtype),
+                    "shape": list(tensor.shape),
+                    "blob": digest,
+                })
+                new_bytes += written
+                total_bytes += tensor.numel() * tensor.element_size()
+
+            _write_json(self.manifest_path(round_num), {
+                "round": round_num,
+                "created": str(datetime.now()),
+                "tensors": entries,
+            })
+            self._write_index(self.rounds() + [round_num])
+        return new_bytes, total_bytes
+
+    # --- reading ---
+    def read_round(self, round_num):
+        try:
+            with open(self.manifest_path(round_num), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load_round(self, round_num, keys=None):
+        """{key: tensor} for a stored round, each a view on a private mmap of its blob."""
+        manifest = self.read_round(round_num)
+        if manifest is None:
+            raise KeyError(f"Round {round_num} is not in the checkpoint store")
+
+        wanted = set(keys) if keys is not None else None
+        state_dict = {}
+        for entry in manifest["tensors"]:
+            if wanted is not None and entry["key"] not in wanted:
+                continue
+            dtype = _DTYPES[entry["dtype"]]
+            shape = entry["shape"]
+            path = self.blob_path(entry["blob"])
+
+            if os.path.getsize(path) == 0:
+                state_dict[entry["key"]] = torch.empty(shape, dtype=dtype)
+                continue
+            with open(path, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            state_dict[entry["key"]] = torch.frombuffer(buf, dtype=dtype).view(shape)
+        return state_dict
+
+    # --- retention ---
+    def policy(self):
+        """Constructor values where given, else the shared retention.json."""
+        shared = read_retention(self.global_model_dir)
+        return {k: shared[k] if getattr(self, k) is None else getattr(self, k) for k in KEEP_ALL}
+
+    def retained_rounds(self, rounds, protected=(), policy=None):
+        if not rounds:
+            return set()
+        policy = policy or self.policy()
+        keep_last, keep_every = policy["keep_last"], policy["keep_every"]
+        keep = set(rounds[-keep_last:]) if keep_last else set(rounds)
+        if keep_every:
+            keep.update(r for r in rounds if r % keep_every == 0)
+        keep.update(r for r in protected if r in rounds)
+        keep.add(rounds[-1])
+        return keep
+
+    def gc(self, protected=()):
+        """
+        Drop rounds outside the retention policy (and their full files),
+        strip full files from retained rounds past `keep_materialized`, then
+        delete unreferenced blobs. Returns a summary dict.
+        """
+        policy = self.policy()
+        with file_lock(self._lock_path()):
+            rounds = self.rounds()
+            keep = self.retained_rounds(rounds, protected, policy)
+            dropped = [r for r in rounds if r not in keep]
+
+            for round_num in dropped:
+                _remove(self.manifest_path(round_num))
+            if dropped:
+                self._write_index(sorted(keep))
+
+            keep_materialized = policy["keep_materialized"]
+            materialized = set(sorted(keep)[-keep_materialized:]) if keep_materialized else set(keep)
+            materialized.update(r for r in protected if r in keep)
+            for round_num in rounds:
+                if round_num not in materialized:
+                    for ext in (".pth", FLAT_EXT):
+                        path = global_round_path(self.global_model_dir, round_num, ext)
+                        _remove(path)
+                        _remove(path + ".sha256")
+                        _remove(path + ".lock")
+                        remove_sidecars(path)
+
+            self._prune_diffs(keep)
+
+            referenced = set()
+            for round_num in keep:
+                manifest = self.read_round(round_num)
+                if manifest is not None:
+                    referenced.update(e["blob"] for e in manifest["tensors"])
+
+            freed = 0
+            for sub in os.listdir(self.blob_dir):
+                sub_dir = os.path.join(self.blob_dir, sub)
+                if not os.path.isdir(sub_dir):
+                    continue
+                for name in os.listdir(sub_dir):
+                    # temp files of an interrupted write are not referenced either
+                    if name not in referenced:
+                        path = os.path.join(sub_dir, name)
+                        freed += os.path.getsize(path)
+                        _remove(path)
+
+        return {"dropped_rounds": dropped, "kept_rounds": sorted(keep), "freed_bytes": freed}
+
+
+    def _prune_diffs(self, keep):
+        """Cached diffs (diff_A_to_B.flat) are useless once either round is gone."""
+        diff_dir = os.path.join(self.global_model_dir, "diffs")
+        if not os.path.isdir(diff_dir):
+            return
+        for name in os.listdir(diff_dir):
+            parts = name.split(".")[0].split("_")
+            if len(parts) == 4 and parts[0] == "diff" and parts[1].isdigit() and parts[3].isdigit():
+                if int(parts[1]) not in keep or int(parts[3]) not in keep:
+                    _remove(os.path.join(diff_dir, name))
+
+
+def _write_json(path, data):
+    tmp_path = tmp_path_for(path)
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# --- On-demand full files for older rounds ---
+def materialize_round(global_model_dir, round_num, ext=".pth"):
+    """
+    Path of global_round_N{ext}, rebuilt from the store if only the blobs
+    are left. None if the round is not stored at all.
+    """
+    path = global_round_path(global_model_dir, round_num, ext)
+    if os.path.exists(path):
+        return path
+
+    if not os.path.exists(os.path.join(global_model_dir, STORE_DIR, "rounds", f"round_{round_num}.json")):
+        return None
+    store = CheckpointStore(global_model_dir)
+
+    with file_lock(path + ".lock"):
+        if not os.path.exists(path):
+            save_weights(store.load_round(round_num), path)
+            write_checksum(path)
+    return path
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import threading
+
+from utils.flat_utils import FlatLayout
+from utils.locks import tmp_path_for
+
+LATEST_POINTER = "latest.json"
+READ_SIZE = 1024 * 1024  # 1 MB
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def global_round_path(global_model_dir, round_num, ext=".pth"):
+    return os.path.join(global_model_dir, f"global_round_{round_num}{ext}")
+
+
+# --- Content hashes (strong ETags) ---
+def write_checksum(path):
+    """Hash a published checkpoint once and keep it next to the file."""
+    sha = file_sha256(path)
+    with open(path + ".sha256", "w") as f:
+        f.write(sha)
+    return sha
+
+
+_checksum_cache = {}
+_checksum_lock = threading.Lock()
+
+
+def read_checksum(path):
+    """sha256 of `path`, from its sidecar or hashed once and cached by (mtime, size)."""
+    st = os.stat(path)
+    cache_key = (path, st.st_mtime_ns, st.st_size)
+
+    with _checksum_lock:
+        if cache_key in _checksum_cache:
+            return _checksum_cache[cache_key]
+
+    sidecar = path + ".sha256"
+    if os.path.exists(sidecar) and os.stat(sidecar).st_mtime_ns >= st.st_mtime_ns:
+        with open(sidecar, "r") as f:
+            sha = f.read().strip()
+    else:
+        sha = file_sha256(path)
+
+    with _checksum_lock:
+        _checksum_cache[cache_key] = sha
+    return sha
+
+
+# --- Latest-round pointer ---
+def write_latest_pointer(global_model_dir, round_num, checksums):
+    path = os.path.join(global_model_dir, LATEST_POINTER)
+    tmp_path = tmp_path_for(path)
+    with open(tmp_path, "w") as f:
+        json.dump({"round": round_num, "sha256": checksums}, f)
+    os.replace(tmp_path, path)
+
+
+def read_latest_pointer(global_model_dir):
+    path = os.path.join(global_model_dir, LATEST_POINTER)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# --- Model manifest (key / shape / dtype layout of the global model) ---
+MANIFEST = "manifest.json"
+
+
+def write_manifest(global_model_dir, layout):
+    path = os.path.join(global_model_dir, MANIFEST)
+    tmp_path = tmp_path_for(path)
+    with open(tmp_path, "w") as f:
+        json.dump(layout.to_dict(), f)
+    os.replace(tmp_path, path)
+
+
+def read_manifest(global_model_dir):
+    """FlatLayout captured when the global model was initialized, or None."""
+    path = os.path.join(global_model_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return FlatLayout.from_dict(json.load(f))
@@ -0,0 +1,195 @@
+import os
+import json
+import uuid
+import hashlib
+from datetime import datetime
+
+from utils.locks import file_lock, tmp_path_for
+
+READ_SIZE = 1024 * 1024  # 1 MB
+
+
+class ChunkError(Exception):
+    pass
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def missing_ranges(received, total_size):
+    missing = []
+    pos = 0
+    for start, end in received:
+        if start > pos:
+            missing.append([pos, start])
+        pos = max(pos, end)
+    if pos < total_size:
+        missing.append([pos, total_size])
+    return missing
+
+
+# --- Resumable upload sessions ---
+class ChunkedUploadStore:
+    """
+    Upload sessions for large weight files. Each session owns a target file
+    preallocated to its final size; chunks are written in place at their
+    offset, so an interrupted transfer only resends the missing ranges.
+    Session state lives next to the data file and survives restarts.
+    """
+
+    def __init__(self, upload_dir):
+        self.session_dir = os.path.join(upload_dir, ".sessions")
+        os.makedirs(self.session_dir, exist_ok=True)
+
+    def _state_path(self, upload_id):
+        return os.path.join(self.session_dir, f"{upload_id}.json")
+
+    def data_path(self, upload_id):
+        return os.path.join(self.session_dir, f"{upload_id}.part")
+
+    def _save(self, session):
+        path = self._state_path(session["upload_id"])
+        tmp_path = tmp_path_for(path)
+        with open(tmp_path, "w") as f:
+            json.dump(session, f)
+        os.replace(tmp_path, path)
+
+    def get(self, upload_id):
+        # ids are uuid4 hex, anything else never touches the filesystem
+        if len(upload_id) != 32 or not all(c in "0123456789abcdef" for c in upload_id):
+            return None
+        path = self._state_path(upload_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def create(self, client_id, cur_round, dataset_size, total_size, sha256=None):
+        upload_id = uuid.uuid4().hex
+        session = {
+            "upload_id": upload_id,
+            "client_id": client_id,
+            "cur_round": cur_round,
+            "dataset_size": dataset_size,
+            "total_size": total_size,
+            "sha256": sha256,
+            "received": [],
+            "created": str(datetime.now()),
+        }
+
+        with open(self.data_path(upload_id), "wb") as f:
+            if total_size:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, total_size)
+                except (AttributeError, OSError):
+                    f.truncate(total_size)
+
+        self._save(session)
+        return session
+
+    def write_chunk(self, upload_id, offset, stream, length, sha256=None):
+        """Copy `length` bytes from `stream` to `offset`, verifying `sha256`."""
+        session = self.get(upload_id)
+        if session is None:
+            raise KeyError(upload_id)
+        if offset < 0 or length < 0 or offset + length > session["total_size"]:
+            raise ChunkError("Chunk lies outside the declared file size")
+
+        digest = hashlib.sha256()
+        written = 0
+        fd = os.open(self.data_path(upload_id), os.O_WRONLY)
+        try:
+            while written < length:
+                data = stream.read(min(READ_SIZE, length - written))
+                if not data:
+                    break
+                digest.update(data)
+                os.pwrite(fd, data, offset + written)
+                written += len(data)
+        finally:
+            os.close(fd)
+
+        if written != length:
+            raise ChunkError(f"Expected {length} bytes, received {written}")
+        if sha256 and digest.hexdigest() != sha256.lower():
+            raise ChunkError("Chunk checksum mismatch")
+
+        # chunks of one upload may land on different worker processes
+        with file_lock(self._state_path(upload_id) + ".lock"):
+            session = self.get(upload_id)
+            session["received"] = merge_ranges(session["received"] + [[offset, offset + length]])
+            self._save(session)
+        return session
+
+    def status(self, session):
+        return {
+            "upload_id": session["upload_id"],
+            "client_id": session["client_id"],
+            "cur_round": session["cur_round"],
+            "total_size": session["total_size"],
+            "received": session["received"],
+            "missing": missing_ranges(session["received"], session["total_size"]),
+        }
+
+    def verify(self, session):
+        """Raises ChunkError unless every byte arrived and the file hash matches."""
+        if missing_ranges(session["received"], session["total_size"]):
+            raise ChunkError("Upload is incomplete")
+
+        if session.get("sha256"):
+            digest = hashlib.sha256()
+            with open(self.data_path(session["upload_id"]), "rb") as f:
+                for block in iter(lambda: f.read(READ_SIZE), b""):
+                    digest.update(block)
+            if digest.hexdigest() != session["sha256"].lower():
+                raise ChunkError("File checksum mismatch")
+
+    def reserved_bytes(self, cur_round, exclude_client=None):
+        """Declared size of the open sessions for `cur_round` (preallocated on disk)."""
+        total = 0
+        for name in os.listdir(self.session_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.session_dir, name), "r") as f:
+                    session = json.load(f)
+            except (OSError, ValueError):
+                continue  # discarded meanwhile
+            if int(session["cur_round"]) == int(cur_round) and session["client_id"] != exclude_client:
+                total += session["total_size"]
+        return total
+
+    def discard(self, upload_id):
+        state_path = self._state_path(upload_id)
+        for path in (state_path, self.data_path(upload_id), state_path + ".lock"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# --- Hash-while-spooling file for multipart uploads ---
+class HashingFile:
+    """File wrapper that feeds every written byte into a sha256."""
+
+    def __init__(self, f):
+        self._f = f
+        self._digest = hashlib.sha256()
+
+    def write(self, data):
+        self._digest.update(data)
+        return self._f.write(data)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __iter__(self):
+        return iter(self._f)
@@ -0,0 +1,280 @@
+"""
+Delta-compressed client updates.
+
+A client sends `weights - global_round_N` instead of full weights, as a
+flat weight file (see weight_format.py) whose header carries the encoding:
+
+    {"encoding": {"type": "delta", "base_round": N, "quant": "int8",
+                  "topk": 0.05, "block": 4096}, "keys": [...]}
+
+quant  "none" (float32), "fp16", or "int8" (symmetric, one scale per block)
+topk   optional fraction of entries kept per tensor (largest |delta|)
+
+Encode on the client:
+
+    python -m utils.delta_codec weights.pth global_round_3.pth upd.flat --base-round 3 --quant int8 --topk 0.05
+
+Global model diffs served to returning clients use the lossless "xor"
+type instead: raw bytes XOR the base round, byte-plane shuffled and
+zlib-compressed, with unchanged tensors left out entirely.
+
+Relays forward their region's FedAvg running sum as a "partial" upload
+(flat_sum plus total_size); load_update returns its average.
+"""
+import os
+import zlib
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from utils.flat_utils import get_layout, get_layout_from_parts
+from utils.weight_format import FLAT_EXT, is_flat_file, load_flat, load_weights, read_metadata, save_flat
+from utils.checkpoint_store import materialize_round
+
+QUANT_MODES = ("none", "fp16", "int8")
+DIFF_TYPES = ("delta", "xor")
+PARTIAL_TYPE = "partial"  # a relay's running weighted sum, see fed_utils.StreamingFedAvg
+BLOCK = 4096
+
+
+# --- int8 block quantization ---
+def _quantize_int8(x, block=BLOCK):
+    n = x.numel()
+    xb = F.pad(x, (0, (-n) % block)).view(-1, block)
+    scale = xb.abs().amax(dim=1) / 127.0
+    scale[scale == 0] = 1.0
+    q = torch.round(xb / scale[:, None]).clamp_(-127, 127).to(torch.int8)
+    return q.view(-1)[:n].clone(), scale
+
+
+def _dequantize_int8(q, scale, block=BLOCK):
+    n = q.numel()
+    qb = F.pad(q.float(), (0, (-n) % block)).view(-1, block)
+    return (qb * scale[:, None]).view(-1)[:n]
+
+
+def _encode_values(prefix, values, quant, block, out):
+    if quant == "int8":
+        out[prefix + "::q"], out[prefix + "::scale"] = _quantize_int8(values, block)
+    elif quant == "fp16":
+        out[prefix + "::fp16"] = values.half()
+    else:
+        out[prefix + "::f32"] = values.float()
+
+
+def _decode_values(prefix, tensors, block):
+    if prefix + "::q" in tensors:
+        return _dequantize_int8(tensors[prefix + "::q"], tensors[prefix + "::scale"], block)
+    if prefix + "::fp16" in tensors:
+        return tensors[prefix + "::fp16"].float()
+    return tensors[prefix + "::f32"].float()
+
+
+# --- Encoding ---
+def encode_delta(state_dict, base_state, base_round, quant="int8", topk=None, block=BLOCK):
+    """Returns (tensors, metadata) ready for save_flat()."""
+    if quant not in QUANT_MODES:
+        raise ValueError(f"quant must be one of {QUANT_MODES}")
+    if topk is not None and not 0 < topk <= 1:
+        raise ValueError("topk must be a fraction in (0, 1]")
+
+    tensors = {}
+    keys = []
+    for key, tensor in state_dict.items():
+        keys.append({"key": key, "shape": list(tensor.shape), "dtype": str(tensor.dtype).replace("torch.", "")})
+
+        if not tensor.is_floating_point():
+            # integer buffers (e.g. num_batches_tracked) are sent as-is
+            tensors[key + "::raw"] = tensor.detach().cpu()
+            continue
+
+        delta = (tensor.detach().cpu().float() - base_state[key].float()).reshape(-1)
+
+        if topk is not None and topk < 1 and delta.numel() > 1:
+            k = max(1, int(delta.numel() * topk))
+            idx = torch.topk(delta.abs(), k, sorted=False).indices
+            idx, _ = idx.sort()
+            idx_dtype = torch.int32 if delta.numel() < 2**31 else torch.int64
+            tensors[key + "::idx"] = idx.to(idx_dtype)
+            delta = delta[idx]
+
+        _encode_values(key, delta, quant, block, tensors)
+
+    metadata = {
+        "encoding": {"type": "delta", "base_round": int(base_round), "quant": quant,
+                     "topk": topk, "block": block},
+        "keys": keys,
+    }
+    return tensors, metadata
+
+
+def save_delta(state_dict, base_state, base_round, path, quant="int8", topk=None):
+    tensors, metadata = encode_delta(state_dict, base_state, base_round, quant, topk)
+    save_flat(tensors, path, metadata=metadata)
+    return metadata["encoding"]
+
+
+def _tensor_bytes(tensor):
+    return tensor.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8)
+
+
+def encode_xor_diff(state_dict, base_state, base_round, level=1):
+    """Lossless diff: returns (tensors, metadata) ready for save_flat()."""
+    tensors = {}
+    keys = []
+    for key, tensor in state_dict.items():
+        keys.append({"key": key, "shape": list(tensor.shape), "dtype": str(tensor.dtype).replace("torch.", "")})
+
+        base = base_state.get(key)
+        if base is None or base.shape != tensor.shape or base.dtype != tensor.dtype or tensor.numel() == 0:
+            tensors[key + "::raw"] = tensor.detach().cpu()
+            continue
+
+        new_bytes, base_bytes = _tensor_bytes(tensor), _tensor_bytes(base)
+        if torch.equal(new_bytes, base_bytes):
+            continue  # unchanged (e.g. frozen layers): nothing to send
+
+        # group byte 0 of every element, then byte 1, ... so the mostly-zero
+        # sign/exponent bytes of the XOR sit together and compress well
+        planes = torch.bitwise_xor(new_bytes, base_bytes).view(-1, tensor.element_size()).t().contiguous()
+        packed = zlib.compress(memoryview(planes.numpy()), level)
+        tensors[key + "::xorz"] = torch.frombuffer(bytearray(packed), dtype=torch.uint8)
+
+    metadata = {
+        "encoding": {"type": "xor", "base_round": int(base_round), "compression": "zlib"},
+        "keys": keys,
+    }
+    return tensors, metadata
+
+
+def save_xor_diff(state_dict, base_state, base_round, path):
+    tensors, metadata = encode_xor_diff(state_dict, base_state, base_round)
+    save_flat(tensors, path, metadata=metadata)
+    return metadata["encoding"]
+
+
+def _decode_xor(tensors, key, base):
+    planes = torch.frombuffer(bytearray(zlib.decompress(memoryview(tensors[key + "::xorz"].numpy()))),
+                              dtype=torch.uint8)
+    xor = planes.view(base.element_size(), -1).t().reshape(-1)
+    return torch.bitwise_xor(_tensor_bytes(base), xor).view(base.dtype).view(base.shape)
+
+
+# --- Decoding ---
+def read_encoding(path):
+    """Encoding header of an upload, or None for plain full weights."""
+    if not is_flat_file(path):
+        return None
+    return read_metadata(path).get("encoding")
+
+
+def base_model_path(global_model_dir, base_round):
+    for ext in (FLAT_EXT, ".pth"):
+        path = os.path.join(global_model_dir, f"global_round_{base_round}{ext}")
+        if os.path.exists(path):
+            return path
+    # full files of older rounds may have been pruned, the blobs are kept
+    return materialize_round(global_model_dir, base_round, FLAT_EXT)
+
+
+def decode_delta(path, base_state, keys=None):
+    meta = read_metadata(path)
+    enc = meta["encoding"]
+    block = enc.get("block", BLOCK)
+    tensors = load_flat(path)
+    keys = set(keys) if keys is not None else None
+
+    state_dict = {}
+    for entry in meta["keys"]:
+        key = entry["key"]
+        if keys is not None and key not in keys:
+            continue
+
+        if key + "::raw" in tensors:
+            state_dict[key] = tensors[key + "::raw"]
+            continue
+
+        base = base_state[key]
+        if list(base.shape) != entry["shape"]:
+            raise ValueError(f"{path}: shape of {key} does not match base round {enc['base_round']}")
+
+        if enc["type"] == "xor":
+            if key + "::xorz" in tensors:
+                state_dict[key] = _decode_xor(tensors, key, base)
+            else:
+                state_dict[key] = base
+            continue
+
+        values = _decode_values(key, tensors, block)
+        full = base.float().reshape(-1).clone()
+        if key + "::idx" in tensors:
+            full.index_add_(0, tensors[key + "::idx"].long(), values)
+        else:
+            full.add_(values)
+        state_dict[key] = full.view(base.shape).to(base.dtype)
+
+    return state_dict
+
+
+def update_layout(path):
+    """FlatLayout of the full weights behind an upload, without decoding it."""
+    enc = read_encoding(path)
+    if enc is not None and enc.get("type") == PARTIAL_TYPE:
+        return _partial_layout(read_metadata(path))
+    if enc is None or enc.get("type") not in DIFF_TYPES:
+        return get_layout(load_weights(path))
+
+    keys = read_metadata(path)["keys"]
+    return get_layout_from_parts(
+        [k["key"] for k in keys],
+        [k["shape"] for k in keys],
+        [getattr(torch, k["dtype"]) for k in keys],
+    )
+
+
+def _partial_layout(meta):
+    layout = meta["layout"]
+    return get_layout_from_parts(
+        layout["keys"], layout["shapes"], [getattr(torch, d) for d in layout["dtypes"]]
+    )
+
+
+def decode_partial(path, keys=None):
+    """Average weights behind a relay's partial sum (flat_sum / total_size)."""
+    meta = read_metadata(path)
+    layout = _partial_layout(meta)
+    state = layout.unflatten(load_flat(path)["flat_sum"] / meta["total_size"])
+    if keys is not None:
+        state = {k: state[k] for k in keys}
+    return state
+
+
+def load_update(path, global_model_dir, keys=None):
+    """Full weights for `path`, decoding a delta/xor diff against its base round."""
+    enc = read_encoding(path)
+    if enc is not None and enc.get("type") == PARTIAL_TYPE:
+        return decode_partial(path, keys=keys)
+    if enc is None or enc.get("type") not in DIFF_TYPES:
+        return load_weights(path, keys=keys)
+
+    base_path = base_model_path(global_model_dir, enc["base_round"])
+    if base_path is None:
+        raise FileNotFoundError(f"Base model for round {enc['base_round']} not found")
+    return decode_delta(path, load_weights(base_path, keys=keys), keys=keys)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode client weights as a delta upload")
+    parser.add_argument("weights")
+    parser.add_argument("base")
+    parser.add_argument("out")
+    parser.add_argument("--base-round", type=int, required=True)
+    parser.add_argument("--quant", choices=QUANT_MODES, default="int8")
+    parser.add_argument("--topk", type=float, default=None)
+    args = parser.parse_args()
+
+    enc = save_delta(load_weights(args.weights), load_weights(args.base), args.base_round,
+                     args.out, quant=args.quant, topk=args.topk)
+    ratio = os.path.getsize(args.weights) / os.path.getsize(args.out)
+    print(f"Encoded {args.weights} → {args.out} ({enc['quant']}, topk={enc['topk']}, {ratio:.1f}x smaller)")
@@ -0,0 +1,104 @@
+import os
+import csv
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+from utils.locks import file_lock
+from utils.weight_format import load_weights
+from utils.metrics import MetricAccumulator, confusion_counts
+from utils.predict_eval_utils import predict
+
+GLOBAL_METRICS_FILE = "global_metrics.csv"
+METRIC_FIELDS = ["round", "dice", "pixel_acc", "num_volumes", "eval_sec", "timestamp",
+                 "global_dice", "slice_dice", "tp", "fp", "fn", "tn"]
+ROI_SIZE = (128, 160, 160)
+
+
+def evaluate_volume(model, image, mask, device, sw_batch_size=4, amp=True, roi_size=ROI_SIZE):
+    """Per-slice confusion counts [1, C, D, 4] for one volume."""
+    pred_mask = predict(model, image, device, roi_size=roi_size, sw_batch_size=sw_batch_size, amp=amp)
+    return confusion_counts(pred_mask[None], mask[None]).cpu()
+
+
+# --- Worker processes (one model each, volumes handed out by index) ---
+_worker = {}
+
+
+def _init_worker(model_fn, weights_path, dataset, threads, sw_batch_size, amp):
+    torch.set_num_threads(threads)
+    model = model_fn("cpu")
+    model.load_state_dict(load_weights(weights_path))
+    model.eval()
+    _worker.update(model=model, dataset=dataset, sw_batch_size=sw_batch_size, amp=amp)
+
+
+def _evaluate_index(idx):
+    image, mask = _worker["dataset"][idx]
+    return evaluate_volume(_worker["model"], image, mask, "cpu", _worker["sw_batch_size"], _worker["amp"])
+
+
+# --- Evaluation of a published global model ---
+def evaluate_global_model(model_fn, weights_path, test_loader, num_workers=1, sw_batch_size=4,
+                          amp=True, device="cpu", model=None):
+    """
+    Metrics (see MetricAccumulator) of the weights at `weights_path` over
+    `test_loader`; only per-slice counts are kept, never predictions.
+    With num_workers > 1 the volumes of test_loader.dataset are spread
+    over that many CPU processes, each holding one model and an equal
+    share of the cores. `model` (already loaded) skips the rebuild in the
+    single-process case.
+    """
+    start = time.time()
+    metrics = MetricAccumulator()
+
+    if num_workers > 1:
+        dataset = test_loader.dataset
+        threads = max(1, (os.cpu_count() or 1) // num_workers)
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(model_fn, weights_path, dataset, threads, sw_batch_size, amp),
+        ) as pool:
+            for counts in pool.map(_evaluate_index, range(len(dataset))):
+                metrics.update_counts(counts)
+    else:
+        if model is None:
+            model = model_fn(device)
+            model.load_state_dict(load_weights(weights_path))
+
+        # the loader streams volumes, only one is held at a time
+        for images, masks in test_loader:
+            for image, mask in zip(images, masks):
+                metrics.update_counts(evaluate_volume(model, image, mask, device, sw_batch_size, amp))
+
+    if not metrics.volumes:
+        raise ValueError("Test set is empty")
+
+    return {**metrics.compute(), "eval_sec": round(time.time() - start, 2)}
+
+
+def append_global_metrics(logs_dir, round_num, metrics):
+    """Append one row to logs_dir/global_metrics.csv (read by resume_global_state)."""
+    os.makedirs(logs_dir, exist_ok=True)
+    path = os.path.join(logs_dir, GLOBAL_METRICS_FILE)
+    row = {"round": round_num, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"), **metrics}
+
+    with file_lock(path + ".lock"):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        fieldnames = METRIC_FIELDS
+        if not new_file:
+            # keep the columns of an existing file so every row lines up
+            with open(path, "r", newline="") as f:
+                fieldnames = next(csv.reader(f))
+
+        with open(path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+            if new_file:
+                writer.writeheader()
+            writer.writerow(row)
+    return path
@@ -1,25 +1,338 @@
 import os
+import re
 import copy
+import time
+import bisect
 import torch
 import pandas as pd
 from glob import glob
+from utils.flat_utils import FlatLayout, get_layout
+from utils.weight_format import FLAT_EXT, load_flat, load_weights, read_metadata, save_flat
+from utils.delta_codec import PARTIAL_TYPE, base_model_path, load_update, read_encoding, update_layout
+from utils.checkpoint_utils import read_latest_pointer
+from utils.telemetry import span
 
 # --- FedAvg (weighted by dataset size) ---
 def fed_avg(state_dicts, data_sizes):
 
-    total_size = sum(data_sizes)
-    avg_state = copy.deepcopy(state_dicts[0])
+    with span("fed_avg", clients=len(state_dicts)):
+        total_size = sum(data_sizes)
+        avg_state = copy.deepcopy(state_dicts[0])
 
-    for key in avg_state.keys():
-        # Weighted sum
-        avg_state[key] = sum(
-            state_dicts[i][key] * (data_sizes[i] / total_size)
-            for i in range(len(state_dicts))
-        )
+        for key in avg_state.keys():
+            # Weighted sum
+            avg_state[key] = sum(
+                state_dicts[i][key] * (data_sizes[i] / total_size)
+                for i in range(len(state_dicts))
+            )
 
     return avg_state
 
 
+# --- Streaming FedAvg (one running weighted-sum buffer per round) ---
+class StreamingFedAvg:
+    """
+    Folds client state dicts in one at a time so peak memory stays at
+    roughly the running sum plus the update currently being added.
+    The result matches fed_avg() over the same clients.
+    """
+
+    def __init__(self, cur_round=None):
+        self.cur_round = cur_round
+        self.layout = None
+        self.flat_sum = None  # one contiguous float32 buffer, see flat_utils
+        self.total_size = 0
+        self.clients = {}  # client_id -> dataset_size
+        self.load_sec = 0.0  # time add_file spent reading uploads
+
+    def add(self, state_dict, data_size, client_id=None):
+        data_size = int(data_size)
+
+        if self.layout is None:
+            self.layout = get_layout(state_dict)
+            self.flat_sum = self.layout.new_buffer()
+        elif not self.layout.matches(state_dict):
+            raise ValueError("Client state_dict does not match the running sum layout")
+
+        self.layout.add_(self.flat_sum, state_dict, alpha=data_size)
+
+        self.total_size += data_size
+        if client_id is not None:
+            self.clients[client_id] = data_size
+
+    def add_file(self, path, data_size, client_id=None, global_model_dir="global_models"):
+        """Add an upload from disk; a relay's partial sum is merged exactly."""
+        start = time.perf_counter()
+        enc = read_encoding(path)
+        if enc is not None and enc.get("type") == PARTIAL_TYPE:
+            partial = StreamingFedAvg.load(path)
+            self.load_sec += time.perf_counter() - start
+            self.merge(partial, client_id)
+        else:
+            update = load_update(path, global_model_dir)
+            self.load_sec += time.perf_counter() - start
+            self.add(update, data_size, client_id)
+
+    def merge(self, other, client_id=None):
+        """Add another running sum (e.g. a relay's partial) as one contributor."""
+        if self.layout is None:
+            self.layout = other.layout
+            self.flat_sum = self.layout.new_buffer()
+        elif self.layout.signature != other.layout.signature:
+            raise ValueError("Partial sum does not match the running sum layout")
+
+        self.flat_sum.add_(other.flat_sum)
+        self.total_size += other.total_size
+        if client_id is not None:
+            self.clients[client_id] = other.total_size
+
+    def result(self):
+        if self.flat_sum is None:
+            raise ValueError("No client updates have been added")
+        if self.total_size <= 0:
+            raise ValueError("Total dataset size is zero, cannot average")
+
+        return self.layout.unflatten(self.flat_sum / self.total_size)
+
+    def save(self, path):
+        # flat weight file: raw buffer plus the bookkeeping in the header
+        # also a valid "partial" upload for a relay's upstream server
+        save_flat({"flat_sum": self.flat_sum}, path, metadata={
+            "encoding": {"type": PARTIAL_TYPE},
+            "cur_round": self.cur_round,
+            "layout": self.layout.to_dict(),
+            "total_size": self.total_size,
+            "clients": self.clients,
+        })
+
+    @staticmethod
+    def saved_clients(path):
+        """Clients folded into the buffer at `path` ({} if there is none)."""
+        if not os.path.exists(path):
+            return {}
+        return read_metadata(path).get("clients", {})
+
+    @classmethod
+    def load(cls, path):
+        meta = read_metadata(path)
+        acc = cls(meta["cur_round"])
+        acc.layout = FlatLayout.from_dict(meta["layout"])
+        acc.flat_sum = load_flat(path)["flat_sum"]
+        acc.total_size = meta["total_size"]
+        acc.clients = meta["clients"]
+        return acc
+
+
+def running_sum_path(client_weights_dir, cur_round):
+    return os.path.join(client_weights_dir, f"round{cur_round}_running_sum{FLAT_EXT}")
+
+
+def client_weights_path(client_weights_dir, client_id, cur_round, ext=None):
+    """
+    Path of a client's upload for a round. Without `ext`, returns whichever
+    of the .flat / .pth files exists (None if neither does).
+    """
+    base = os.path.join(client_weights_dir, f"{client_id}_round{cur_round}")
+    if ext is not None:
+        return base + ext
+
+    for ext in (FLAT_EXT, ".pth"):
+        if os.path.exists(base + ext):
+            return base + ext
+    return None
+
+
+# --- Pluggable aggregators ---
+CHUNK_BYTES = 256 * 1024 * 1024  # working memory for the robust aggregators
+
+
+class Aggregator:
+    """
+    Turns a round's client weight files into the new global state dict.
+    Files are read through delta_codec.load_update, so full, delta and xor
+    uploads are all accepted.
+    """
+
+    name = None
+
+    def aggregate(self, paths, data_sizes, global_model_dir="global_models"):
+        raise NotImplementedError
+
+
+class FedAvgAggregator(Aggregator):
+    """Weighted FedAvg, one client at a time (same result as fed_avg)."""
+
+    name = "fedavg"
+
+    def aggregate(self, paths, data_sizes, global_model_dir="global_models"):
+        acc = StreamingFedAvg()
+        for path, size in zip(paths, data_sizes):
+            acc.add_file(path, size, global_model_dir=global_model_dir)
+        return acc.result()
+
+
+def _chunk_spans(layout, lo, hi):
+    """(key, offset, numel) of every tensor overlapping flat elements [lo, hi)."""
+    first = bisect.bisect_right(layout.offsets, lo) - 1
+    spans = []
+    for i in range(max(first, 0), len(layout.keys)):
+        offset, numel = layout.offsets[i], layout.numels[i]
+        if offset >= hi:
+            break
+        if numel and offset + numel > lo:
+            spans.append((layout.keys[i], offset, numel))
+    return spans
+
+
+def _load_chunk(path, layout, lo, hi, out, global_model_dir):
+    """Copy flat elements [lo, hi) of one client's weights into `out`."""
+    spans = _chunk_spans(layout, lo, hi)
+    state_dict = load_update(path, global_model_dir, keys=[key for key, _, _ in spans])
+    for key, offset, numel in spans:
+        start, end = max(lo, offset), min(hi, offset + numel)
+        out[start - lo:end - lo].copy_(state_dict[key].reshape(-1)[start - offset:end - offset])
+
+
+class ChunkedAggregator(Aggregator):
+    """
+    Coordinate-wise aggregation over all K clients at once, done on slices
+    of the flattened model: each step loads elements [lo, hi) of every
+    client into a K x chunk buffer and reduces it. The chunk shrinks as K
+    grows so working memory stays near `chunk_bytes` plus one output model.
+    """
+
+    bytes_per_value = 4  # stacked float32 values; sort-based reducers need more
+
+    def __init__(self, chunk_bytes=CHUNK_BYTES):
+        self.chunk_bytes = chunk_bytes
+
+    def reduce(self, stacked, weights):
+        """stacked: [K, n] client values, weights: [K] dataset fractions → [n]."""
+        raise NotImplementedError
+
+    def aggregate(self, paths, data_sizes, global_model_dir="global_models"):
+        layout = update_layout(paths[0])
+        total_size = sum(data_sizes)
+        if total_size <= 0:
+            raise ValueError("Total dataset size is zero, cannot average")
+        weights = torch.tensor([size / total_size for size in data_sizes], dtype=torch.float32)
+
+        num_clients = len(paths)
+        chunk = max(1, self.chunk_bytes // (self.bytes_per_value * num_clients))
+        stacked = torch.empty(num_clients, min(chunk, layout.numel), dtype=torch.float32)
+        out = layout.new_buffer()
+
+        for lo in range(0, layout.numel, chunk):
+            hi = min(lo + chunk, layout.numel)
+            buf = stacked[:, :hi - lo]
+            for k, path in enumerate(paths):
+                _load_chunk(path, layout, lo, hi, buf[k], global_model_dir)
+            out[lo:hi] = self.reduce(buf, weights)
+
+        return layout.unflatten(out)
+
+
+class TrimmedMeanAggregator(ChunkedAggregator):
+    """
+    Per coordinate, drop the `trim` fraction of largest and smallest client
+    values and average the rest (unweighted).
+    """
+
+    name = "trimmed_mean"
+    bytes_per_value = 16  # values + sorted copy + int64 sort indices
+
+    def __init__(self, trim=0.1, chunk_bytes=CHUNK_BYTES):
+        super().__init__(chunk_bytes)
+        if not 0 <= trim < 0.5:
+            raise ValueError("trim must be in [0, 0.5)")
+        self.trim = trim
+
+    def reduce(self, stacked, weights):
+        num_clients = stacked.shape[0]
+        cut = int(self.trim * num_clients)
+        values = stacked.sort(dim=0).values
+        return values[cut:num_clients - cut].mean(dim=0)
+
+
+class MedianAggregator(ChunkedAggregator):
+    """Coordinate-wise median (mean of the two middle values for even K)."""
+
+    name = "median"
+    bytes_per_value = 16
+
+    def reduce(self, stacked, weights):
+        num_clients = stacked.shape[0]
+        values = stacked.sort(dim=0).values
+        mid = num_clients // 2
+        if num_clients % 2:
+            return values[mid].clone()
+        return (values[mid - 1] + values[mid]) / 2
+
+
+class KrumAggregator(Aggregator):
+    """
+    (Multi-)Krum: score each client by the summed squared distance to its
+    K - f - 2 nearest neighbours, keep the `m` lowest-scoring clients and
+    FedAvg them. Distances are accumulated chunk by chunk, so only a K x K
+    matrix is kept besides the chunk buffer. `f` (tolerated Byzantine
+    clients) defaults to the largest value Krum allows.
+    """
+
+    name = "krum"
+
+    def __init__(self, f=None, m=1, chunk_bytes=CHUNK_BYTES):
+        self.f = f
+        self.m = m
+        self.chunk_bytes = chunk_bytes
+        self.selected = []
+
+    def distances(self, paths, global_model_dir):
+        layout = update_layout(paths[0])
+        num_clients = len(paths)
+        chunk = max(1, self.chunk_bytes // (4 * num_clients))
+        stacked = torch.empty(num_clients, min(chunk, layout.numel), dtype=torch.float32)
+        dist = torch.zeros(num_clients, num_clients, dtype=torch.float64)
+
+        for lo in range(0, layout.numel, chunk):
+            hi = min(lo + chunk, layout.numel)
+            buf = stacked[:, :hi - lo]
+            for k, path in enumerate(paths):
+                _load_chunk(path, layout, lo, hi, buf[k], global_model_dir)
+            dist += torch.cdist(buf, buf, compute_mode="donot_use_mm_for_euclid_dist").double() ** 2
+        return dist
+
+    def aggregate(self, paths, data_sizes, global_model_dir="global_models"):
+        num_clients = len(paths)
+        f = self.f if self.f is not None else max(0, (num_clients - 3) // 2)
+        neighbours = num_clients - f - 2
+        if neighbours < 1:
+            raise ValueError(f"Krum needs more than 2f + 2 clients (K={num_clients}, f={f})")
+
+        dist = self.distances(paths, global_model_dir)
+        dist.fill_diagonal_(float("inf"))
+        scores = dist.sort(dim=1).values[:, :neighbours].sum(dim=1)
+
+        m = max(1, min(self.m, num_clients - f))
+        self.selected = scores.argsort()[:m].tolist()
+
+        acc = StreamingFedAvg()
+        for i in sorted(self.selected):
+            acc.add_file(paths[i], data_sizes[i], global_model_dir=global_model_dir)
+        return acc.result()
+
+
+AGGREGATORS = {
+    cls.name: cls
+    for cls in (FedAvgAggregator, TrimmedMeanAggregator, MedianAggregator, KrumAggregator)
+}
+
+
+def get_aggregator(name="fedavg", **kwargs):
+    if name not in AGGREGATORS:
+        raise ValueError(f"Unknown aggregator {name!r}, choose from {', '.join(AGGREGATORS)}")
+    return AGGREGATORS[name](**kwargs)
+
+
 # --- Resume Global State (checkpoint + logs) ---
 def resume_global_state(global_dir, logs_dir):
 
@@ -28,14 +341,25 @@ def resume_global_state(global_dir, logs_dir):
     global_weights = None
     global_metrics_list = []
 
-    # Find latest checkpoint
-    ckpts = glob(os.path.join(global_dir, "global_round_*.pth"))
-    ckpts.sort()
+    # Latest round from the pointer, else the highest-numbered checkpoint
+    latest = read_latest_pointer(global_dir)
+    if latest is not None:
+        latest_round = latest["round"]
+    else:
+        rounds = [
+            int(m.group(1))
+            for m in (re.search(r"global_round_(\d+)\.pth$", p)
+                      for p in glob(os.path.join(global_dir, "global_round_*.pth")))
+            if m
+        ]
+        latest_round = max(rounds) if rounds else None
 
-    if len(ckpts) > 0:
-        latest_ckpt = ckpts[-1]
-        start_round = int(latest_ckpt.split("_round_")[-1].split(".pth")[0]) + 1
-        global_weights = torch.load(latest_ckpt, map_location="cpu")
+    if latest_round is not None:
+        start_round = latest_round + 1
+        # flat files load as memory-mapped views, nothing is read up front
+        path = base_model_path(global_dir, latest_round)
+        if path is not None:
+            global_weights = load_weights(path)
 
     # Load existing metrics if CSV exists
     if os.path.exists(global_metrics_path):
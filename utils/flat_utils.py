@@ -0,0 +1,142 @@
+import torch
+
+
+# --- Flat layout (key / shape / dtype / offset of every tensor) ---
+class FlatLayout:
+    """
+    Describes how a state dict maps onto one contiguous float32 buffer.
+    Layouts are cached by signature, so every client of the same
+    architecture shares one instance.
+    """
+
+    def __init__(self, keys, shapes, dtypes):
+        self.keys = list(keys)
+        self.shapes = [tuple(s) for s in shapes]
+        self.dtypes = list(dtypes)
+
+        self.offsets = []
+        self.numels = []
+        offset = 0
+        for shape in self.shapes:
+            numel = 1
+            for dim in shape:
+                numel *= dim
+            self.offsets.append(offset)
+            self.numels.append(numel)
+            offset += numel
+        self.numel = offset
+
+    @property
+    def signature(self):
+        return tuple(zip(self.keys, self.shapes, (str(d) for d in self.dtypes)))
+
+    def matches(self, state_dict):
+        if len(state_dict) != len(self.keys):
+            return False
+        for key, shape in zip(self.keys, self.shapes):
+            tensor = state_dict.get(key)
+            if tensor is None or tuple(tensor.shape) != shape:
+                return False
+        return True
+
+    def new_buffer(self, device="cpu"):
+        return torch.zeros(self.numel, dtype=torch.float32, device=device)
+
+    def flatten(self, state_dict, out=None):
+        if out is None:
+            out = torch.empty(self.numel, dtype=torch.float32)
+        for key, offset, numel in zip(self.keys, self.offsets, self.numels):
+            out[offset:offset + numel].copy_(state_dict[key].reshape(-1))
+        return out
+
+    def add_(self, flat, state_dict, alpha=1.0):
+        # flat += alpha * state_dict, key by key, without packing the client
+        for key, offset, numel in zip(self.keys, self.offsets, self.numels):
+            tensor = state_dict[key].detach().reshape(-1)
+            if tensor.device != flat.device:
+                tensor = tensor.to(flat.device)
+            flat[offset:offset + numel].add_(tensor, alpha=alpha)
+        return flat
+
+    def views(self, flat):
+        """Float32 views into `flat`, no copies."""
+        return {
+            key: flat[offset:offset + numel].view(shape)
+            for key, shape, offset, numel
+            in zip(self.keys, self.shapes, self.offsets, self.numels)
+        }
+
+    def unflatten(self, flat):
+        """State dict of views; only non-float32 entries are copied."""
+        state = self.views(flat)
+        for key, dtype in zip(self.keys, self.dtypes):
+            if dtype != torch.float32:
+                tensor = state[key]
+                if not dtype.is_floating_point:
+                    tensor = tensor.round()
+                state[key] = tensor.to(dtype)
+        return state
+
+    def to_dict(self):
+        return {
+            "keys": self.keys,
+            "shapes": [list(s) for s in self.shapes],
+            "dtypes": [str(d).replace("torch.", "") for d in self.dtypes],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        dtypes = [getattr(torch, d) for d in data["dtypes"]]
+        return get_layout_from_parts(data["keys"], data["shapes"], dtypes)
+
+
+_layout_cache = {}
+
+
+def get_layout_from_parts(keys, shapes, dtypes):
+    layout = FlatLayout(keys, shapes, dtypes)
+    return _layout_cache.setdefault(layout.signature, layout)
+
+
+def get_layout(state_dict):
+    return get_layout_from_parts(
+        state_dict.keys(),
+        [t.shape for t in state_dict.values()],
+        [t.dtype for t in state_dict.values()],
+    )
+
+
+# --- FedAvg on flat buffers ---
+def flat_fed_avg(state_dicts, data_sizes, method="add"):
+    """
+    Same result as fed_avg() but accumulates into one contiguous buffer.
+
+    method="add"    chain of in-place add_(alpha=w) calls, no temporaries
+    method="matmul" pack every client and do one weights @ stacked matmul
+                    (faster for a handful of clients, K times the memory)
+    """
+    total_size = sum(data_sizes)
+    if total_size <= 0:
+        raise ValueError("Total dataset size is zero, cannot average")
+
+    layout = get_layout(state_dicts[0])
+    for sd in state_dicts[1:]:
+        if not layout.matches(sd):
+            raise ValueError("Client state_dict does not match the model layout")
+
+    weights = [size / total_size for size in data_sizes]
+
+    if method == "matmul":
+        stacked = torch.empty(len(state_dicts), layout.numel, dtype=torch.float32)
+        for i, sd in enumerate(state_dicts):
+            layout.flatten(sd, out=stacked[i])
+        flat = torch.tensor(weights, dtype=torch.float32) @ stacked
+        del stacked
+    elif method == "add":
+        flat = layout.new_buffer()
+        for sd, w in zip(state_dicts, weights):
+            layout.add_(flat, sd, alpha=w)
+    else:
+        raise ValueError(f"Unknown flat_fed_avg method: {method}")
+
+    return layout.unflatten(flat)
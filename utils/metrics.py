@@ -0,0 +1,128 @@
+"""
+Vectorized segmentation metrics.
+
+Everything is derived from per-slice confusion counts (tp, fp, fn, tn along
+the last spatial axis), computed for a whole batch in one pass without a
+Python loop or a host sync per slice. Counts are small and additive, so
+MetricAccumulator can stream a full test set (or merge results from
+worker processes) and still report exact set-level numbers.
+"""
+import math
+
+import torch
+
+TP, FP, FN, TN = range(4)
+
+
+def confusion_counts(pred, target):
+    """
+    pred / target: binary (0/1) masks [B, C, *spatial]. Returns int64
+    [B, C, D, 4] with (tp, fp, fn, tn) for each of the D slices along the
+    last axis.
+    """
+    if pred.shape != target.shape:
+        raise ValueError(f"Shape mismatch: pred {tuple(pred.shape)} vs target {tuple(target.shape)}")
+
+    slice_size = math.prod(pred.shape[2:-1])
+    # float sums vectorize far better than bool/int reductions and stay
+    # exact while a slice has fewer than 2**24 voxels
+    dtype = torch.float32 if slice_size < 2 ** 24 else torch.float64
+    p = pred.to(dtype).reshape(*pred.shape[:2], slice_size, pred.shape[-1])
+    t = target.to(device=pred.device, dtype=dtype).reshape(p.shape)
+
+    tp = (p * t).sum(dim=2)
+    pred_pos = p.sum(dim=2)
+    true_pos = t.sum(dim=2)
+
+    fp = pred_pos - tp
+    fn = true_pos - tp
+    tn = slice_size - tp - fp - fn
+    return torch.stack([tp, fp, fn, tn], dim=-1).round().to(torch.int64)
+
+
+def dice_from_counts(counts, empty=float("nan"), eps=0.0):
+    """2tp / (2tp + fp + fn) over the last axis of `counts`; `empty` where the target is empty."""
+    counts = counts.double()
+    tp, fp, fn = counts[..., TP], counts[..., FP], counts[..., FN]
+    dice = 2 * tp / (2 * tp + fp + fn + eps)
+    return torch.where(tp + fn > 0, dice, torch.full_like(dice, empty))
+
+
+def slice_dice(counts, eps=1e-8):
+    """Per-slice Dice [B, C, D]; slices where both masks are empty score 0."""
+    counts = counts.double()
+    tp, fp, fn = counts[..., TP], counts[..., FP], counts[..., FN]
+    return 2 * tp / (2 * tp + fp + fn + eps)
+
+
+def volume_metrics(counts):
+    """
+    Per-volume (Dice averaged over channels, pixel accuracy) from slice
+    counts [B, C, D, 4]. A volume with an empty target scores Dice 0, as
+    MONAI's DiceMetric reports it.
+    """
+    per_volume = counts.sum(dim=2)                                # [B, C, 4]
+    dice = dice_from_counts(per_volume, empty=0.0).mean(dim=1)    # [B]
+    totals = per_volume.sum(dim=1).double()              # [B, 4]
+    acc = (totals[:, TP] + totals[:, TN]) / totals.sum(dim=1)
+    return dice, acc
+
+
+# --- Streaming accumulator ---
+class MetricAccumulator:
+    """
+    Running sufficient statistics over a test set. `update` takes a batch
+    of binary masks (or precomputed `confusion_counts` via update_counts);
+    `compute` returns:
+
+        dice         mean per-volume Dice (see volume_metrics)
+        global_dice  Dice of the pooled confusion counts over the whole set
+        pixel_acc    exact (tp + tn) / voxels over the whole set
+        slice_dice   mean per-slice Dice
+        tp/fp/fn/tn  pooled confusion counts
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = torch.zeros(4, dtype=torch.int64)
+        self.dice_sum = 0.0
+        self.volumes = 0
+        self.slice_dice_sum = 0.0
+        self.slices = 0
+
+    def update(self, pred, target):
+        return self.update_counts(confusion_counts(pred, target))
+
+    def update_counts(self, counts):
+        counts = counts.cpu()
+        dice, acc = volume_metrics(counts)
+        per_slice = slice_dice(counts)
+
+        self.counts += counts.sum(dim=(0, 1, 2))
+        self.dice_sum += dice.sum().item()
+        self.volumes += counts.shape[0]
+        self.slice_dice_sum += per_slice.sum().item()
+        self.slices += per_slice.numel()
+        return dice, acc
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.dice_sum += other.dice_sum
+        self.volumes += other.volumes
+        self.slice_dice_sum += other.slice_dice_sum
+        self.slices += other.slices
+        return self
+
+    def compute(self):
+        tp, fp, fn, tn = (int(c) for c in self.counts)
+        voxels = tp + fp + fn + tn
+        return {
+            "dice": self.dice_sum / self.volumes if self.volumes else float("nan"),
+            "global_dice": 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else float("nan"),
+            "pixel_acc": (tp + tn) / voxels if voxels else float("nan"),
+            "slice_dice": self.slice_dice_sum / self.slices if self.slices else float("nan"),
+            "num_volumes": self.volumes,
+            "tp": tp, "fp": fp, "fn": fn, "tn": tn,
+        }
@@ -0,0 +1,73 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import torch.multiprocessing  # noqa: F401  registers shared-memory tensor pickling
+
+from utils.delta_codec import load_update, update_layout
+
+
+# --- Key sharding ---
+def shard_keys(layout, num_shards):
+    """Split keys into `num_shards` groups of roughly equal byte size."""
+    num_shards = max(1, min(num_shards, len(layout.keys)))
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+
+    # largest tensors first, each to the currently lightest shard
+    order = sorted(range(len(layout.keys)), key=lambda i: -layout.numels[i])
+    for i in order:
+        target = loads.index(min(loads))
+        shards[target].append(i)
+        loads[target] += layout.numels[i]
+
+    return [sorted(s) for s in shards if s]
+
+
+def _average_shard(paths, weights, layout, indices, out, global_model_dir):
+    torch.set_num_threads(1)
+
+    keys = [layout.keys[i] for i in indices]
+    for path, w in zip(paths, weights):
+        state_dict = load_update(path, global_model_dir, keys=keys)
+        for i in indices:
+            key, offset, numel = layout.keys[i], layout.offsets[i], layout.numels[i]
+            tensor = state_dict[key]
+            if tuple(tensor.shape) != layout.shapes[i]:
+                raise ValueError(f"{path}: shape mismatch for {key}")
+            out[offset:offset + numel].add_(tensor.reshape(-1), alpha=w)
+        del state_dict
+
+    return len(indices)
+
+
+# --- Parallel FedAvg over client files ---
+def parallel_fed_avg(paths, data_sizes, num_workers=None, mp_context="spawn", global_model_dir="global_models"):
+    """
+    FedAvg over checkpoint files with keys sharded across processes.
+    Each worker memory-maps every client file (.flat or .pth) but only
+    reads its own keys, and writes straight into a shared output buffer.
+    Delta uploads are decoded against their base round in global_model_dir.
+    """
+    total_size = sum(data_sizes)
+    if total_size <= 0:
+        raise ValueError("Total dataset size is zero, cannot average")
+
+    num_workers = num_workers or os.cpu_count() or 1
+    weights = [size / total_size for size in data_sizes]
+
+    layout = update_layout(paths[0])
+    out = layout.new_buffer().share_memory_()
+    shards = shard_keys(layout, num_workers)
+
+    ctx = multiprocessing.get_context(mp_context)
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=ctx) as pool:
+        futures = [
+            pool.submit(_average_shard, paths, weights, layout, indices, out, global_model_dir)
+            for indices in shards
+        ]
+        for f in futures:
+            f.result()
+
+    return layout.unflatten(out)
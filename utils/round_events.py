@@ -0,0 +1,119 @@
+"""
+In-memory round state for push notifications.
+
+Clients used to discover a new round by polling /api/get-current-round,
+and every poll re-read the round ledger. RoundState keeps that answer in
+memory instead: a watcher thread stats the files that change with a round
+(latest.json, async.json, the ledger and its WAL) every WATCH_INTERVAL and
+only recomputes the state when one of them moved. Changes made by this
+process (uploads, relay syncs) call `touch()` to publish right away.
+
+Long-poll and SSE requests block on a Condition, so an idle client costs
+one parked thread and no CPU until the state changes.
+"""
+import os
+import time
+import threading
+
+from utils.async_fl import ASYNC_CONFIG
+from utils.checkpoint_utils import LATEST_POINTER
+
+WATCH_INTERVAL = 0.5  # seconds between stats of the watched files
+
+
+def round_files(global_model_dir, ledger_db):
+    """Files whose change means the round state may have changed."""
+    return [
+        os.path.join(global_model_dir, LATEST_POINTER),
+        os.path.join(global_model_dir, ASYNC_CONFIG),
+        ledger_db,
+        ledger_db + "-wal",  # WAL mode: commits only touch this file
+    ]
+
+
+def file_signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            signature.append((st.st_ino, st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class RoundState:
+    """
+    Latest `compute()` result with a sequence number that increases every
+    time it changes. `on_tick` runs on the watcher thread before each check
+    (a relay uses it to mirror the upstream model).
+    """
+
+    def __init__(self, compute, watch_paths, interval=WATCH_INTERVAL, on_tick=None):
+        self.compute = compute
+        self.watch_paths = list(watch_paths)
+        self.interval = interval
+        self.on_tick = on_tick
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.state = None
+        self.signature = None
+        self._watcher_pid = None
+
+    def refresh(self, force=False):
+        """Recompute if a watched file changed; returns True if the state did."""
+        signature = file_signature(self.watch_paths)
+        if not force and self.state is not None and signature == self.signature:
+            return False
+
+        state = self.compute()
+        with self.cond:
+            self.signature = signature
+            if state == self.state:
+                return False
+            self.state = state
+            self.seq += 1
+            self.cond.notify_all()
+        return True
+
+    def touch(self):
+        self.refresh(force=True)
+
+    def current(self):
+        """(seq, state), computed on first use."""
+        self._ensure_watcher()
+        if self.state is None:
+            self.refresh(force=True)
+        with self.cond:
+            return self.seq, self.state
+
+    def wait_for(self, predicate, timeout):
+        """
+        Block until `predicate(seq, state)` holds; (seq, state) or None
+        after `timeout` seconds.
+        """
+        self.current()
+        with self.cond:
+            if self.cond.wait_for(lambda: predicate(self.seq, self.state), timeout):
+                return self.seq, self.state
+        return None
+
+    # --- watcher thread, one per process ---
+    def _ensure_watcher(self):
+        if self._watcher_pid == os.getpid():
+            return
+        with self.cond:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+        threading.Thread(target=self._watch, name="round-watcher", daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self.on_tick is not None:
+                    self.on_tick()
+                self.refresh()
+            except Exception as e:
+                print(f"[RoundState] Could not refresh round state: {e}")
@@ -0,0 +1,295 @@
+import os
+import json
+import sqlite3
+import threading
+import functools
+from datetime import datetime
+
+from utils import telemetry
+
+CLIENT_STATS_DB = "client_stats.db"
+CLIENT_STATS_FILE = "client_stats.json"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    seq          INTEGER PRIMARY KEY AUTOINCREMENT,
+    round        INTEGER NOT NULL,
+    client_id    TEXT NOT NULL,
+    dataset_size INTEGER NOT NULL,
+    timestamp    TEXT NOT NULL,
+    encoding     TEXT,
+    upload_bytes INTEGER,
+    sha256       TEXT,
+    status       TEXT,
+    reason       TEXT,
+    applied_version INTEGER,
+    UNIQUE (round, client_id)
+);
+CREATE INDEX IF NOT EXISTS uploads_client ON uploads (client_id, round);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# columns added after the first release, patched into older databases
+_ADDED_COLUMNS = {"sha256": "TEXT", "status": "TEXT", "reason": "TEXT", "applied_version": "INTEGER"}
+
+# upload verdicts written by the validation pipeline (None = legacy, unchecked)
+STATUS_PENDING = "pending"
+STATUS_VALID = "valid"
+STATUS_INVALID = "invalid"
+
+
+def _timed(method):
+    """Record the ledger call in fl_stats_io_seconds{op=<method name>}."""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with telemetry.timed("fl_stats_io_seconds", op=method.__name__):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+# --- Round ledger (replaces the client_stats.json read-modify-write) ---
+class RoundLedger:
+    """
+    Per-round client upload records in SQLite (WAL mode). Appends are a
+    single indexed INSERT, lookups by round or client use indexes, and
+    concurrent writers from several threads or processes are serialized
+    by SQLite instead of racing on a JSON file.
+
+    An existing client_stats.json is imported once on first open.
+    """
+
+    def __init__(self, db_path=CLIENT_STATS_DB, json_path=CLIENT_STATS_FILE):
+        # per-thread connections are opened lazily, so pin the path now
+        self.db_path = os.path.abspath(db_path)
+        self.json_path = json_path
+        self._local = threading.local()
+
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+            existing = {r["name"] for r in conn.execute("PRAGMA table_info(uploads)")}
+            for column, kind in _ADDED_COLUMNS.items():
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE uploads ADD COLUMN {column} {kind}")
+        self.migrate_from_json()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    # --- writes ---
+    @_timed
+    def record_upload(self, cur_round, client_id, dataset_size, encoding=None,
+                      upload_bytes=None, timestamp=None, sha256=None, status=None):
+        """Insert (or replace) a client's upload for a round. Returns True if replaced."""
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            replaced = conn.execute(
+                "SELECT 1 FROM uploads WHERE round = ? AND client_id = ?",
+                (int(cur_round), client_id),
+            ).fetchone() is not None
+
+            # REPLACE gets a new seq, so a re-upload moves to the end like before
+            conn.execute(
+                "INSERT OR REPLACE INTO uploads "
+                "(round, client_id, dataset_size, timestamp, encoding, upload_bytes, sha256, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (int(cur_round), client_id, int(dataset_size),
+                 timestamp or str(datetime.now()),
+                 json.dumps(encoding or "full"), upload_bytes, sha256, status),
+            )
+        return replaced
+
+    @_timed
+    def set_status(self, cur_round, client_id, status, reason=None, sha256=None):
+        """
+        Record a validation verdict. With `sha256`, only applies if the row
+        still describes that exact upload (not a newer re-upload).
+        """
+        query = "UPDATE uploads SET status = ?, reason = ? WHERE round = ? AND client_id = ?"
+        params = [status, reason, int(cur_round), client_id]
+        if sha256 is not None:
+            query += " AND sha256 = ?"
+            params.append(sha256)
+
+        with self._conn() as conn:
+            return conn.execute(query, params).rowcount > 0
+
+    @_timed
+    def mark_applied(self, uploads, version):
+        """Record that (round, client_id) uploads went into global `version` (async mode)."""
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "UPDATE uploads SET applied_version = ? WHERE round = ? AND client_id = ?",
+                [(int(version), int(r), c) for r, c in uploads],
+            )
+
+    @_timed
+    def get_entry(self, cur_round, client_id):
+        with self._conn() as conn:
+            row = conn.execute(
+                "SELECT * FROM uploads WHERE round = ? AND client_id = ?", (int(cur_round), client_id)
+            ).fetchone()
+        return self._entry(row) if row else None
+
+    # --- reads ---
+    @staticmethod
+    def _entry(row):
+        return {
+            "client_id": row["client_id"],
+            "dataset_size": row["dataset_size"],
+            "timestamp": row["timestamp"],
+            "encoding": json.loads(row["encoding"]) if row["encoding"] else "full",
+            "upload_bytes": row["upload_bytes"],
+            "sha256": row["sha256"],
+            "status": row["status"],
+            "reason": row["reason"],
+        }
+
+    @_timed
+    def round_entries(self, cur_round):
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT * FROM uploads WHERE round = ? ORDER BY seq", (int(cur_round),)
+            ).fetchall()
+        return [self._entry(r) for r in rows]
+
+    @_timed
+    def unapplied_entries(self, min_round, max_round):
+        """Uploads for rounds min_round..max_round not yet applied, oldest first, with their "round"."""
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT * FROM uploads WHERE round BETWEEN ? AND ? AND applied_version IS NULL ORDER BY seq",
+                (int(min_round), int(max_round)),
+            ).fetchall()
+        return [dict(self._entry(r), round=r["round"]) for r in rows]
+
+    @_timed
+    def pending_entries(self):
+        """Uploads still waiting for a validation verdict, oldest first, with their "round"."""
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT * FROM uploads WHERE status = ? ORDER BY seq", (STATUS_PENDING,)
+            ).fetchall()
+        return [dict(self._entry(r), round=r["round"]) for r in rows]
+
+    @_timed
+    def client_count(self, cur_round):
+        with self._conn() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM uploads WHERE round = ?", (int(cur_round),)
+            ).fetchone()[0]
+
+    @_timed
+    def round_bytes(self, cur_round, exclude_client=None):
+        """Stored upload bytes of a round, without `exclude_client`'s (about to be replaced)."""
+        with self._conn() as conn:
+            return conn.execute(
+                "SELECT COALESCE(SUM(upload_bytes), 0) FROM uploads WHERE round = ? AND client_id != ?",
+                (int(cur_round), exclude_client or ""),
+            ).fetchone()[0]
+
+    @_timed
+    def rounds(self):
+        with self._conn() as conn:
+            return [r[0] for r in conn.execute("SELECT DISTINCT round FROM uploads ORDER BY round")]
+
+    @_timed
+    def max_round(self):
+        """Highest round with any upload, or None."""
+        with self._conn() as conn:
+            return conn.execute("SELECT MAX(round) FROM uploads").fetchone()[0]
+
+    @_timed
+    def client_history(self, client_id):
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT * FROM uploads WHERE client_id = ? ORDER BY round", (client_id,)
+            ).fetchall()
+        return {r["round"]: self._entry(r) for r in rows}
+
+    @_timed
+    def as_dict(self):
+        """Same shape as the old client_stats.json."""
+        stats = {}
+        with self._conn() as conn:
+            for row in conn.execute("SELECT * FROM uploads ORDER BY round, seq"):
+                stats.setdefault(str(row["round"]), []).append(self._entry(row))
+        return stats
+
+    # --- one-time import of client_stats.json ---
+    def migrate_from_json(self):
+        if not self.json_path or not os.path.exists(self.json_path):
+            return 0
+
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_json'").fetchone():
+                conn.execute("COMMIT")
+                return 0
+
+            try:
+                with open(self.json_path, "r") as f:
+                    stats = json.load(f)
+            except ValueError:
+                stats = {}
+
+            count = 0
+            for cur_round, entries in stats.items():
+                for e in entries:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO uploads "
+                        "(round, client_id, dataset_size, timestamp, encoding, upload_bytes) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (int(cur_round), e["client_id"], int(e.get("dataset_size") or 0),
+                         e.get("timestamp") or "", json.dumps(e.get("encoding", "full")),
+                         e.get("upload_bytes")),
+                    )
+                    count += 1
+
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('migrated_json', ?)",
+                (str(datetime.now()),),
+            )
+            conn.execute("COMMIT")
+
+        if count:
+            print(f"[Ledger] Imported {count} entries from {self.json_path}")
+        return count
+
+
+class _Transaction:
+    """`with` wrapper that commits (or rolls back) any transaction the block opened."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_ledger(db_path=CLIENT_STATS_DB, json_path=CLIENT_STATS_FILE):
+    """One shared RoundLedger per database path in this process."""
+    key = os.path.abspath(db_path)
+    with _ledgers_lock:
+        if key not in _ledgers:
+            _ledgers[key] = RoundLedger(db_path, json_path)
+        return _ledgers[key]
@@ -0,0 +1,304 @@
+"""
+Prometheus-style metrics shared by every server process.
+
+Every process keeps its counters, gauges and histograms in memory. Server
+processes (serve.py sets FL_METRICS_DIR for its workers; set it for the
+aggregation daemon too) also snapshot them to $FL_METRICS_DIR/<pid>.json
+about once a second, and the /metrics endpoint merges all snapshots into
+the Prometheus text format: counters and histograms are summed across
+processes, gauges only over live ones. Snapshots of exited processes are
+folded into exited.json and removed, so counters never go backwards and
+the directory stays small. Without FL_METRICS_DIR (CLI tools, scripts)
+nothing is written and /metrics shows this process only.
+
+`span(name)` times a block into fl_span_seconds{span=name}. With
+FL_TRACE_SPANS=1 every span is also appended to spans.jsonl in
+FL_METRICS_DIR (default metrics/) as one JSON line (start, duration,
+pid, thread, labels) for offline analysis.
+"""
+import os
+import json
+import time
+import bisect
+import atexit
+import threading
+from contextlib import contextmanager
+
+from utils.locks import file_lock, tmp_path_for
+
+METRICS_DIR = os.environ.get("FL_METRICS_DIR") or None  # None: no snapshots
+TRACE_SPANS = os.environ.get("FL_TRACE_SPANS", "") not in ("", "0")
+SPANS_FILE = "spans.jsonl"
+EXITED_FILE = "exited.json"  # summed counters / histograms of processes that are gone
+FLUSH_INTERVAL = 1.0  # seconds between snapshots of a process's metrics
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+IO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "fl_http_request_duration_seconds": (
+        "histogram", "Request latency per route, until the response body is sent", LATENCY_BUCKETS),
+    "fl_http_requests_total": ("counter", "Requests per route, method and status", None),
+    "fl_upload_bytes_total": ("counter", "Bytes of client weights received", None),
+    "fl_download_bytes_total": ("counter", "Bytes of global models and diffs sent", None),
+    "fl_transfers_in_flight": ("gauge", "Uploads / downloads currently being transferred", None),
+    "fl_admission_wait_seconds": (
+        "histogram", "Time transfers queued for an admission slot", LATENCY_BUCKETS),
+    "fl_admission_rejected_total": ("counter", "Transfers turned away (busy, quota)", None),
+    "fl_round_waiters": ("gauge", "Clients parked on wait-for-round / round-events", None),
+    "fl_aggregation_phase_seconds": (
+        "histogram", "Aggregation time per phase (load, average, save, evaluate)", LATENCY_BUCKETS),
+    "fl_aggregation_clients": ("gauge", "Client updates in the last aggregation", None),
+    "fl_stats_io_seconds": ("histogram", "Round ledger (client_stats.db) operations", IO_BUCKETS),
+    "fl_span_seconds": ("histogram", "Timed spans (torch.load, torch.save, fed_avg, ...)", LATENCY_BUCKETS),
+    "fl_round_clients": ("gauge", "Uploads for the open round by validation status", None),
+    "fl_global_round": ("gauge", "Latest published global round / version", None),
+}
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry:
+    """In-memory metrics of this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}      # (name, labels) -> number (counters, gauges)
+        self.histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self.dirty = False
+        self._flusher = None
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            key = (name, _key(labels))
+            self.values[key] = self.values.get(key, 0) + value
+            self._touch()
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, _key(labels))] = value
+            self._touch()
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        with self.lock:
+            key = (name, _key(labels))
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            hist[bisect.bisect_left(buckets, value)] += 1
+            hist[-1] += value
+            self._touch()
+
+    def _touch(self):
+        self.dirty = True
+        if self._flusher is None and METRICS_DIR is not None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+            self._flusher.start()
+
+    # --- snapshots on disk ---
+    def snapshot(self):
+        with self.lock:
+            self.dirty = False
+            return {
+                "pid": os.getpid(),
+                "values": [[n, list(map(list, l)), v] for (n, l), v in self.values.items()],
+                "histograms": [[n, list(map(list, l)), list(h)] for (n, l), h in self.histograms.items()],
+            }
+
+    def flush(self):
+        if not self.dirty or METRICS_DIR is None:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        tmp_path = tmp_path_for(path)
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"[Metrics] Could not write snapshot: {e}")
+
+
+registry = Registry()
+atexit.register(lambda: registry.flush())
+
+inc = registry.inc
+set_gauge = registry.set
+observe = registry.observe
+
+
+# --- Spans ---
+@contextmanager
+def span(name, **labels):
+    start = time.time()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - t0
+        observe("fl_span_seconds", duration, span=name)
+        if TRACE_SPANS:
+            _write_span({"span": name, "start": start, "duration_sec": round(duration, 6),
+                         "pid": os.getpid(), "thread": threading.current_thread().name, **labels})
+
+
+def _write_span(entry):
+    trace_dir = METRICS_DIR or "metrics"
+    os.makedirs(trace_dir, exist_ok=True)
+    # one O_APPEND write per line keeps lines from several processes intact
+    fd = os.open(os.path.join(trace_dir, SPANS_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry) + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def timed(name, **labels):
+    """Observe the duration of a block into histogram `name`."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0, **labels)
+
+
+# --- Prometheus exposition ---
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add_snapshot(values, histograms, snap, gauges=True):
+    for name, labels, value in snap["values"]:
+        if not gauges and METRICS.get(name, ("gauge",))[0] == "gauge":
+            continue
+        key = (name, tuple(map(tuple, labels)))
+        values[key] = values.get(key, 0) + value
+    for name, labels, hist in snap["histograms"]:
+        key = (name, tuple(map(tuple, labels)))
+        if key in histograms:
+            histograms[key] = [a + b for a, b in zip(histograms[key], hist)]
+        else:
+            histograms[key] = list(hist)
+
+
+def _as_snapshot(values, histograms):
+    return {
+        "values": [[n, list(map(list, l)), v] for (n, l), v in values.items()],
+        "histograms": [[n, list(map(list, l)), h] for (n, l), h in histograms.items()],
+    }
+
+
+def _read_snapshot(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _fold_exited(metrics_dir, pid_files):
+    """Add the snapshots of exited processes to exited.json and delete them."""
+    exited_path = os.path.join(metrics_dir, EXITED_FILE)
+    with file_lock(exited_path + ".lock"):
+        values, histograms = {}, {}
+        exited = _read_snapshot(exited_path)
+        if exited is not None:
+            _add_snapshot(values, histograms, exited)
+        folded = []
+        for path in pid_files:
+            snap = _read_snapshot(path)  # None: another scrape folded it already
+            if snap is not None:
+                _add_snapshot(values, histograms, snap, gauges=False)
+                folded.append(path)
+        if not folded:
+            return
+
+        tmp_path = tmp_path_for(exited_path)
+        with open(tmp_path, "w") as f:
+            json.dump(_as_snapshot(values, histograms), f)
+        os.replace(tmp_path, exited_path)
+        for path in folded:
+            os.remove(path)
+
+
+def collect(metrics_dir=None):
+    """Merged (values, histograms) over every process snapshot."""
+    metrics_dir = metrics_dir or METRICS_DIR
+    values, histograms = {}, {}
+    if metrics_dir is None:
+        _add_snapshot(values, histograms, registry.snapshot())
+        return values, histograms
+
+    registry.flush()
+    try:
+        names = os.listdir(metrics_dir)
+    except FileNotFoundError:
+        names = []
+
+    live, dead = [], []
+    for file_name in names:
+        pid = file_name[:-len(".json")]
+        if file_name.endswith(".json") and pid.isdigit():
+            (live if _alive(int(pid)) else dead).append(os.path.join(metrics_dir, file_name))
+    if dead:
+        _fold_exited(metrics_dir, dead)
+
+    for path in live + [os.path.join(metrics_dir, EXITED_FILE)]:
+        snap = _read_snapshot(path)
+        if snap is not None:
+            _add_snapshot(values, histograms, snap)
+    return values, histograms
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render(extra_gauges=(), metrics_dir=None):
+    """
+    Prometheus text format of all processes' metrics plus `extra_gauges`
+    ((name, labels dict, value) computed at scrape time).
+    """
+    values, histograms = collect(metrics_dir)
+    for name, labels, value in extra_gauges:
+        values[(name, _key(labels))] = value
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        series = sorted((k, v) for k, v in values.items() if k[0] == name)
+        hists = sorted((k, h) for k, h in histograms.items() if k[0] == name)
+        if not series and not hists:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+        for (_, labels), value in series:
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (_, labels), hist in hists:
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], hist[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {hist[-1]}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,131 @@
+"""
+Lossless Content-Encoding for model transfers.
+
+Published checkpoints are compressed once, in the background after they
+are published, into sidecars next to the file (global_round_N.pth.gz /
+.zst). Float weights rarely shrink much, so sidecars saving less than
+MIN_SAVING are not kept. Downloads opt in with ?compressed=1 and then get
+a sidecar by Accept-Encoding; everyone else gets the plain file, since
+HTTP libraries send Accept-Encoding by default and clients that save the
+raw stream would store compressed bytes. Uploads sent with
+Content-Encoding are decoded while they stream to disk.
+
+gzip is always available. zstd needs the optional `zstandard` package and
+is preferred when both sides support it.
+"""
+import os
+import gzip
+import zlib
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from utils.locks import tmp_path_for
+from utils.checkpoint_utils import write_checksum
+
+READ_SIZE = 1024 * 1024  # 1 MB
+GZIP_LEVEL = 1  # float weights barely compress better at higher levels, only slower
+ZSTD_LEVEL = 3
+MIN_SAVING = 0.15  # sidecars saving less than 15% are not worth a copy of the model
+MAX_DECODED_BYTES = int(float(os.environ.get("FL_MAX_DECODED_UPLOAD_MB", "8192")) * 1024 * 1024)
+
+SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}  # server preference order
+ENCODINGS = [e for e in SUFFIXES if e != "zstd" or zstandard is not None]
+# corrupt input: gzip raises BadGzipFile (an OSError), EOFError or zlib.error
+DECODE_ERRORS = (OSError, EOFError, ValueError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class EncodingError(Exception):
+    pass
+
+
+class DecodedTooLarge(EncodingError):
+    pass
+
+
+def encoded_path(path, encoding):
+    return path + SUFFIXES[encoding]
+
+
+def available_encodings(path):
+    """Encodings with a sidecar for `path`, in preference order."""
+    return [e for e in ENCODINGS if os.path.exists(encoded_path(path, e))]
+
+
+# --- Precompressed sidecars ---
+def _compressing_writer(f, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(f, closefd=False)
+    return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def precompress(path, encodings=None):
+    """
+    Write one sidecar per encoding (with its .sha256 for ETags). Returns
+    {encoding: compressed size}; encodings that do not pay off are skipped.
+    """
+    size = os.path.getsize(path)
+    written = {}
+    for encoding in encodings or ENCODINGS:
+        target = encoded_path(path, encoding)
+        tmp_path = tmp_path_for(target)
+        with open(path, "rb") as src, open(tmp_path, "wb") as f:
+            with _compressing_writer(f, encoding) as writer:
+                shutil.copyfileobj(src, writer, READ_SIZE)
+
+        if os.path.getsize(tmp_path) > size * (1 - MIN_SAVING):
+            os.remove(tmp_path)
+            continue
+        os.replace(tmp_path, target)
+        write_checksum(target)
+        written[encoding] = os.path.getsize(target)
+
+    if not os.path.exists(path):  # pruned by retention while we compressed
+        remove_sidecars(path)
+        return {}
+    return written
+
+
+def remove_sidecars(path):
+    for suffix in SUFFIXES.values():
+        for sidecar in (path + suffix, path + suffix + ".sha256"):
+            try:
+                os.remove(sidecar)
+            except FileNotFoundError:
+                pass
+
+
+# --- Streaming decode of request bodies ---
+class DecodingStream:
+    """
+    Read-only stream of the decoded body. Raises EncodingError on corrupt
+    data or once more than `limit` decoded bytes come out (zip bombs).
+    """
+
+    def __init__(self, raw, encoding, limit=MAX_DECODED_BYTES):
+        if encoding not in ENCODINGS:
+            raise EncodingError(f"Unsupported Content-Encoding {encoding!r}")
+        if encoding == "zstd":
+            self._reader = zstandard.ZstdDecompressor().stream_reader(raw, read_size=READ_SIZE)
+        else:
+            self._reader = gzip.GzipFile(fileobj=raw, mode="rb")
+        self.limit = limit
+        self.decoded = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(READ_SIZE), b""))
+        try:
+            data = self._reader.read(size)
+        except DECODE_ERRORS as e:
+            raise EncodingError(f"Could not decode the request body: {e}") from e
+        self.decoded += len(data)
+        if self.limit and self.decoded > self.limit:
+            raise DecodedTooLarge(f"Decoded body exceeds {self.limit} bytes")
+        return data
+
+    def close(self):
+        self._reader.close()
@@ -0,0 +1,155 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from utils.delta_codec import base_model_path, load_update, update_layout
+from utils.checkpoint_utils import read_latest_pointer, read_manifest
+from utils.fed_utils import client_weights_path
+from utils.locks import try_file_lock
+from utils.round_ledger import STATUS_INVALID, STATUS_PENDING, STATUS_VALID
+
+MAX_PROBLEMS = 5
+
+
+# --- Schema / value checks ---
+def check_state_dict(state_dict, layout):
+    """List of problems (empty if the upload matches `layout` and is finite)."""
+    problems = []
+
+    expected = set(layout.keys)
+    missing = [k for k in layout.keys if k not in state_dict]
+    unexpected = [k for k in state_dict if k not in expected]
+    if missing:
+        problems.append(f"missing keys: {', '.join(missing[:3])}" + (" ..." if len(missing) > 3 else ""))
+    if unexpected:
+        problems.append(f"unexpected keys: {', '.join(unexpected[:3])}" + (" ..." if len(unexpected) > 3 else ""))
+
+    for key, shape, dtype in zip(layout.keys, layout.shapes, layout.dtypes):
+        if len(problems) >= MAX_PROBLEMS:
+            break
+        tensor = state_dict.get(key)
+        if tensor is None:
+            continue
+        if tuple(tensor.shape) != shape:
+            problems.append(f"{key}: shape {tuple(tensor.shape)}, expected {shape}")
+        elif tensor.dtype != dtype:
+            problems.append(f"{key}: dtype {tensor.dtype}, expected {dtype}")
+        elif tensor.is_floating_point() and not torch.isfinite(tensor).all():
+            problems.append(f"{key}: contains NaN/Inf")
+
+    return problems
+
+
+def expected_layout(global_model_dir):
+    """Layout from the manifest, else from the latest global checkpoint."""
+    layout = read_manifest(global_model_dir)
+    if layout is not None:
+        return layout
+
+    latest = read_latest_pointer(global_model_dir)
+    path = base_model_path(global_model_dir, latest["round"]) if latest else None
+    return update_layout(path) if path else None
+
+
+# --- Background validation pipeline ---
+class UploadValidator:
+    """
+    Checks finished uploads on a small worker pool and stores the verdict in
+    the round ledger. A valid upload is handed to `on_valid` while it is
+    still in memory (the backend folds it into the running sum), so each
+    file is read exactly once after it lands.
+    """
+
+    def __init__(self, ledger, global_model_dir, on_valid=None, workers=2):
+        self.ledger = ledger
+        self.global_model_dir = global_model_dir
+        self.on_valid = on_valid
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="validate")
+        self.lock = threading.Lock()
+        self.pending = {}  # (round, client_id) -> future
+
+    def submit(self, cur_round, client_id, dataset_size, path, sha256):
+        future = self.executor.submit(self._validate, int(cur_round), client_id, dataset_size, path, sha256)
+        with self.lock:
+            self.pending[(int(cur_round), client_id)] = future
+        future.add_done_callback(lambda f: self._done((int(cur_round), client_id), f))
+        return future
+
+    def _done(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    def resume_pending(self, upload_dir):
+        """
+        Re-queue uploads the ledger still marks pending: they were answered
+        200 but the worker checking them may have died (timeout, deploy).
+        Uploads another worker is still checking are skipped in _validate.
+        """
+        resumed = 0
+        for entry in self.ledger.pending_entries():
+            cur_round, client_id = entry["round"], entry["client_id"]
+            path = client_weights_path(upload_dir, client_id, cur_round)
+            if path is None:
+                self.ledger.set_status(cur_round, client_id, STATUS_INVALID, "upload file missing",
+                                       sha256=entry["sha256"])
+                continue
+            self.submit(cur_round, client_id, entry["dataset_size"], path, entry["sha256"])
+            resumed += 1
+        return resumed
+
+    def _validate(self, cur_round, client_id, dataset_size, path, sha256):
+        # one checker per upload across workers, the lock dies with its process
+        lock_path = path + ".validating"
+        with try_file_lock(lock_path) as claimed:
+            if not claimed:
+                return None
+            entry = self.ledger.get_entry(cur_round, client_id)
+            if entry is None or entry["sha256"] != sha256 or entry["status"] != STATUS_PENDING:
+                return None  # replaced, or already checked by another worker
+            try:
+                return self._check(cur_round, client_id, dataset_size, path, sha256)
+            finally:
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+
+    def _check(self, cur_round, client_id, dataset_size, path, sha256):
+        state_dict = None
+        try:
+            layout = expected_layout(self.global_model_dir)
+            state_dict = load_update(path, self.global_model_dir)
+            problems = check_state_dict(state_dict, layout) if layout is not None else []
+        except Exception as e:
+            problems = [f"unreadable upload: {e}"]
+
+        # a newer upload replaced this one while we were checking it
+        entry = self.ledger.get_entry(cur_round, client_id)
+        if entry is None or entry["sha256"] != sha256:
+            return None
+
+        if problems:
+            reason = "; ".join(problems)
+            self.ledger.set_status(cur_round, client_id, STATUS_INVALID, reason, sha256=sha256)
+            print(f"[VALIDATION] Rejected {client_id} R{cur_round}: {reason}")
+            return False
+
+        if self.on_valid is not None:
+            try:
+                self.on_valid(cur_round, client_id, dataset_size, state_dict)
+            except Exception as e:
+                print(f"[WARNING] Could not fold {client_id} into running sum: {e}")
+
+        self.ledger.set_status(cur_round, client_id, STATUS_VALID, sha256=sha256)
+        print(f"[VALIDATION] Accepted {client_id} R{cur_round}")
+        return True
+
+    def wait(self, timeout=None):
+        """Block until every queued validation has finished."""
+        with self.lock:
+            futures = list(self.pending.values())
+        for future in futures:
+            future.result(timeout=timeout)
@@ -0,0 +1,209 @@
+"""
+Flat weight file format: a small JSON header followed by raw tensor bytes.
+
+    [8 bytes magic][8 bytes header length, little endian][JSON header][data]
+
+Tensors are stored contiguously, each aligned to 64 bytes, so a file can be
+memory-mapped and every tensor returned as a zero-copy view. Loading never
+touches pickle. `.pth` stays supported for import/export:
+
+    python -m utils.weight_format model.pth model.flat
+    python -m utils.weight_format model.flat model.pth
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+
+import torch
+
+from utils.locks import tmp_path_for
+from utils.telemetry import span
+
+MAGIC = b"FLWT\x00\x01\x00\x00"
+FLAT_EXT = ".flat"
+ALIGN = 64
+
+_DTYPES = {
+    name: getattr(torch, name)
+    for name in [
+        "float64", "float32", "float16", "bfloat16",
+        "int64", "int32", "int16", "int8", "uint8", "bool",
+    ]
+}
+
+
+def _dtype_name(dtype):
+    name = str(dtype).replace("torch.", "")
+    if name not in _DTYPES:
+        raise ValueError(f"Unsupported dtype for flat weight file: {dtype}")
+    return name
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def is_flat_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+# --- Writing ---
+def save_flat(state_dict, path, metadata=None):
+    save_flat_stream(
+        [(key, t.dtype, t.shape, (lambda t=t: t)) for key, t in state_dict.items()],
+        path,
+        metadata,
+    )
+
+
+def save_flat_stream(specs, path, metadata=None):
+    """
+    Like save_flat, for data that does not fit in memory at once: `specs`
+    is a list of (key, dtype, shape, produce) and each produce() is only
+    called when its tensor is written.
+    """
+    entries = []
+    offset = 0
+    for key, dtype, shape, _ in specs:
+        numel = 1
+        for d in shape:
+            numel *= int(d)
+        nbytes = numel * torch.empty((), dtype=dtype).element_size()
+        entries.append({
+            "key": key,
+            "dtype": _dtype_name(dtype),
+            "shape": [int(d) for d in shape],
+            "offset": offset,
+            "nbytes": nbytes,
+        })
+        offset = _align(offset + nbytes)
+
+    header = json.dumps({"metadata": metadata or {}, "tensors": entries}).encode("utf-8")
+    # pad the header so the data section starts aligned
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    header += b" " * (data_start - len(MAGIC) - 8 - len(header))
+
+    tmp_path = tmp_path_for(path)
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+
+        for entry, (key, dtype, shape, produce) in zip(entries, specs):
+            f.seek(data_start + entry["offset"])
+            if entry["nbytes"]:
+                tensor = produce()
+                if tensor.dtype != dtype or list(tensor.shape) != entry["shape"]:
+                    raise ValueError(f"{key}: produced {tensor.dtype} {tuple(tensor.shape)}, "
+                                     f"expected {dtype} {tuple(entry['shape'])}")
+                data = tensor.detach().to("cpu").contiguous().reshape(-1).view(torch.uint8)
+                f.write(memoryview(data.numpy()))
+        f.truncate(data_start + offset)
+
+    os.replace(tmp_path, path)
+
+
+# --- Reading ---
+def read_header(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a flat weight file")
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+    return header, len(MAGIC) + 8 + header_len
+
+
+def load_flat(path, keys=None):
+    """
+    Returns {key: tensor} where every tensor is a view on a private
+    (copy-on-write) memory map of the file. Writing to a tensor never
+    changes the file. `keys` restricts loading to a subset.
+    """
+    header, data_start = read_header(path)
+    file_size = os.path.getsize(path)
+
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) if file_size else None
+
+    wanted = set(keys) if keys is not None else None
+    state_dict = {}
+    for entry in header["tensors"]:
+        key = entry["key"]
+        if wanted is not None and key not in wanted:
+            continue
+
+        dtype = _DTYPES.get(entry["dtype"])
+        if dtype is None:
+            raise ValueError(f"{path}: unsupported dtype {entry['dtype']!r} for {key}")
+
+        shape = [int(d) for d in entry["shape"]]
+        numel = 1
+        for d in shape:
+            if d < 0:
+                raise ValueError(f"{path}: negative dimension for {key}")
+            numel *= d
+
+        element_size = torch.empty((), dtype=dtype).element_size()
+        start = data_start + int(entry["offset"])
+        if entry["nbytes"] != numel * element_size or start + entry["nbytes"] > file_size:
+            raise ValueError(f"{path}: corrupt or truncated entry for {key}")
+
+        if numel == 0:
+            state_dict[key] = torch.empty(shape, dtype=dtype)
+        else:
+            state_dict[key] = torch.frombuffer(buf, dtype=dtype, count=numel, offset=start).view(shape)
+
+    return state_dict
+
+
+def read_metadata(path):
+    return read_header(path)[0].get("metadata", {})
+
+
+# --- Format-agnostic helpers ---
+def load_weights(path, keys=None):
+    """Load a flat file or a .pth checkpoint, memory-mapped where possible."""
+    if is_flat_file(path):
+        with span("flat.load", path=path):
+            return load_flat(path, keys=keys)
+
+    with span("torch.load", path=path):
+        try:
+            state_dict = torch.load(path, map_location="cpu", mmap=True)
+        except RuntimeError:
+            # legacy (non-zip) checkpoints cannot be memory-mapped
+            state_dict = torch.load(path, map_location="cpu")
+
+    if keys is not None:
+        state_dict = {k: state_dict[k] for k in keys}
+    return state_dict
+
+
+def save_weights(state_dict, path):
+    """Pick the format from the extension: `.flat` or anything else as .pth."""
+    if path.endswith(FLAT_EXT):
+        with span("flat.save", path=path):
+            save_flat(state_dict, path)
+    else:
+        tmp_path = tmp_path_for(path)
+        with span("torch.save", path=path):
+            torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def convert(src, dst):
+    save_weights(load_weights(src), dst)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python -m utils.weight_format SRC DST  (.pth <-> .flat)")
+        sys.exit(1)
+    convert(sys.argv[1], sys.argv[2])
+    print(f"Converted {sys.argv[1]} → {sys.argv[2]}")